@@ -6,10 +6,9 @@ import logging
 from sys import exit
 
 import click
-import requests
 from pkg_resources import resource_stream
 
-from strephit.commons import secrets
+from strephit.commons import http, secrets
 from strephit.commons.logging import log_request_data
 
 logger = logging.getLogger(__name__)
@@ -77,7 +76,7 @@ def create_job(title, instructions, cml, custom_js):
         "job[cml]": cml,
         "job[js]": custom_js,
     }
-    r = requests.post(secrets.CF_JOBS_URL, data=data)
+    r = http.post(secrets.CF_JOBS_URL, data=data)
     log_request_data(r, logger)
     r.raise_for_status()
     return r.json()
@@ -98,7 +97,7 @@ def config_job(job_id):
     headers = {'Content-Type': 'application/x-www-form-urlencoded'}
     data = '&'.join("job[included_countries][]=%s" % c for c in INCLUDED_COUNTRIES) + '&' + \
            '&'.join('%s=%s' % param for param in JOB_SETTINGS.iteritems())
-    r = requests.put(secrets.CF_JOB_CONFIG_URL % job_id, headers=headers, params=params, data=data)
+    r = http.put(secrets.CF_JOB_CONFIG_URL % job_id, headers=headers, params=params, data=data)
     log_request_data(r, logger)
     r.raise_for_status()
     return r.json()
@@ -116,7 +115,7 @@ def upload_units(job_id, csv_data):
     """
     headers = {'Content-Type': 'text/csv'}
     params = {'key': secrets.CF_KEY}
-    r = requests.put(secrets.CF_JOB_UPLOAD_URL % job_id, data=csv_data, headers=headers, params=params)
+    r = http.put(secrets.CF_JOB_UPLOAD_URL % job_id, data=csv_data, headers=headers, params=params)
     log_request_data(r, logger)
     r.raise_for_status()
     return r.json()
@@ -132,7 +131,7 @@ def convert_gold(job_id):
      :rtype: boolean
     """
     params = {'key': secrets.CF_KEY}
-    r = requests.put(secrets.CF_JOB_ACTIVATE_GOLD_URL % job_id, params=params)
+    r = http.put(secrets.CF_JOB_ACTIVATE_GOLD_URL % job_id, params=params)
     log_request_data(r, logger)
     # Inconsistent API: returns 406, but actually sometimes works (!!!)
     if r.status_code == 406:
@@ -152,7 +151,7 @@ def tag_job(job_id, tags):
     """
     params = {'key': secrets.CF_KEY}
     data = {"tags": tags}
-    r = requests.post(secrets.CF_JOB_TAG_URL % job_id, params=params, data=data)
+    r = http.post(secrets.CF_JOB_TAG_URL % job_id, params=params, data=data)
     log_request_data(r, logger)
     r.raise_for_status()
     return r.ok
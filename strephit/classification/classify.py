@@ -7,7 +7,7 @@ import click
 from sklearn.externals import joblib
 
 from strephit.commons.classification import apply_custom_classification_rules, reverse_gazetteer
-from strephit.commons import parallel
+from strephit.commons import io, parallel
 
 logger = logging.getLogger(__name__)
 
@@ -89,12 +89,12 @@ class SentenceClassifier:
 
 
 @click.command()
-@click.argument('sentences', type=click.File('r'))
+@click.argument('sentences', type=io.CompressedFile('r'))
 @click.argument('model', type=click.Path(dir_okay=False, writable=True))
 @click.argument('language')
-@click.option('--outfile', '-o', type=click.File('w'), default='output/supervised_classified.jsonlines')
-@click.option('--processes', '-p', default=0)
-@click.option('--gazetteer', type=click.File('r'))
+@click.option('--outfile', '-o', type=io.CompressedFile('w'), default='output/supervised_classified.jsonlines')
+@click.option('--processes', '-p', default=0, type=parallel.PROCESSES)
+@click.option('--gazetteer', type=io.CompressedFile('r'))
 def main(sentences, model, language, outfile, processes, gazetteer):
     gazetteer = reverse_gazetteer(json.load(gazetteer)) if gazetteer else {}
 
@@ -104,13 +104,13 @@ def main(sentences, model, language, outfile, processes, gazetteer):
     classifier = SentenceClassifier(model, extractor, language, gazetteer)
 
     def worker(batch):
-        data = (json.loads(s) for s in batch)
+        data = (io.json_loads(s) for s in batch)
         for classified in classifier.classify_sentences(data):
-            yield json.dumps(classified)
+            yield io.json_dumps(classified)
 
     count = 0
-    for each in parallel.map(worker, sentences, batch_size=1000,
-                             flatten=True, processes=processes):
+    for each in parallel.map_lines(worker, sentences, batch_size='auto',
+                                   flatten=True, processes=processes, transport='bytes'):
         outfile.write(each)
         outfile.write('\n')
 
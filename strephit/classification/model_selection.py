@@ -9,6 +9,7 @@ from sklearn import metrics
 
 from sklearn.dummy import DummyClassifier
 
+from strephit.commons import io
 from strephit.commons.classification import reverse_gazetteer
 from strephit.classification.feature_extractors import FactExtractorFeatureExtractor
 
@@ -16,10 +17,10 @@ logger = logging.getLogger(__name__)
 
 
 @click.command()
-@click.argument('training-set', type=click.File('r'))
+@click.argument('training-set', type=io.CompressedFile('r'))
 @click.argument('language')
-@click.option('--gold-standard', type=click.File('r'))
-@click.option('--gazetteer', type=click.File('r'))
+@click.option('--gold-standard', type=io.CompressedFile('r'))
+@click.option('--gazetteer', type=io.CompressedFile('r'))
 def main(training_set, language, gold_standard, gazetteer):
     """ Searches for the best hyperparameters """
 
@@ -28,7 +29,7 @@ def main(training_set, language, gold_standard, gazetteer):
     logger.info('Building training set')
     extractor = FactExtractorFeatureExtractor(language)
     for row in training_set:
-        data = json.loads(row)
+        data = io.json_loads(row)
         extractor.process_sentence(data['sentence'], data['fes'],
                                    add_unknown=True, gazetteer=gazetteer)
 
@@ -56,7 +57,7 @@ def main(training_set, language, gold_standard, gazetteer):
 
     logger.info('Evaluating on the gold standard')
     for row in gold_standard:
-        data = json.loads(row)
+        data = io.json_loads(row)
         extractor.process_sentence(data['sentence'], data['fes'])
     x_gold, y_gold = extractor.get_features()
 
@@ -5,6 +5,7 @@ import logging
 import click
 
 
+from strephit.commons import io
 from strephit.commons.classification import reverse_gazetteer
 from sklearn.externals import joblib
 from sklearn.svm import LinearSVC
@@ -14,7 +15,7 @@ logger = logging.getLogger(__name__)
 
 
 @click.command()
-@click.argument('training-set', type=click.File('r'))
+@click.argument('training-set', type=io.CompressedFile('r'))
 @click.argument('language')
 @click.option('-o', '--outfile', type=click.Path(dir_okay=False, writable=True),
               default='output/classifier_model.pkl', help='Where to save the model')
@@ -32,7 +33,7 @@ logger = logging.getLogger(__name__)
 @click.option('--random-state', default=None, type=click.INT,
               help='The seed of the pseudo random number generator to use when shuffling the data.')
 @click.option('--max-iter', default=1000, help='The maximum number of iterations to be run.')
-@click.option('--gazetteer', type=click.File('r'))
+@click.option('--gazetteer', type=io.CompressedFile('r'))
 def main(training_set, language, outfile, gazetteer, **kwargs):
     """ Trains the classifier """
 
@@ -41,7 +42,7 @@ def main(training_set, language, outfile, gazetteer, **kwargs):
 
     logger.info("Building training set from '%s' ..." % training_set.name)
     for row in training_set:
-        data = json.loads(row)
+        data = io.json_loads(row)
         extractor.process_sentence(data['sentence'], data['fes'],
                                    add_unknown=True, gazetteer=gazetteer)
 
@@ -25,10 +25,52 @@ logging.getLogger("requests").setLevel(logging.WARNING)
 @click.pass_context
 @click.option('--log-level', type=(unicode, click.Choice(commons.logging.LEVELS)), multiple=True)
 @click.option('--cache-dir', type=click.Path(file_okay=False, resolve_path=True), default=None)
-def cli(ctxm, log_level, cache_dir):
+@click.option('--cache-backend', type=click.Choice(commons.cache.BACKENDS.keys()), default=None)
+@click.option('--cache-memory-items', type=int, default=None,
+              help='How many cached items each process keeps in memory')
+@click.option('--cache-memory-bytes', type=int, default=None,
+              help='How many bytes of cached items each process keeps in memory')
+@click.option('--json-codec', type=click.Choice(['auto'] + commons.io.JSON_DECODERS.keys()),
+              default='auto', help='Library used to decode JSON documents')
+@click.option('--compression-level', type=click.IntRange(1, 9), default=None,
+              help='Compression level of compressed (.gz, .bz2, .xz) outputs')
+@click.option('--http-pool-size', type=int, default=None,
+              help='How many connections to keep alive for each host')
+@click.option('--http-retries', type=int, default=None,
+              help='How many times to retry failed HTTP requests')
+@click.option('--http-rate-limit', type=(unicode, float), multiple=True,
+              help='Maximum number of requests per second to a host, per process')
+@click.option('--nlp-daemon', type=click.Path(dir_okay=False), default=None,
+              help='Socket of the daemon keeping the NLP resources loaded, see "commons nlp_daemon"')
+@click.option('--tag-store', is_flag=True,
+              help='Keep the POS tags of the sentences in the cache, best with --cache-backend sqlite')
+def cli(ctxm, log_level, cache_dir, cache_backend, cache_memory_items, cache_memory_bytes,
+        json_codec, compression_level, http_pool_size, http_retries, http_rate_limit, nlp_daemon,
+        tag_store):
     commons.logging.setup()
     for module, level in log_level:
         commons.logging.setLogLevel(module, level)
 
     if cache_dir:
         commons.cache.BASE_DIR = cache_dir
+    if cache_backend:
+        commons.cache.BACKEND = cache_backend
+    if cache_memory_items is not None:
+        commons.cache.MEMORY_MAX_ITEMS = cache_memory_items
+    if cache_memory_bytes is not None:
+        commons.cache.MEMORY_MAX_BYTES = cache_memory_bytes
+    commons.io.set_json_codec(json_codec)
+    if compression_level is not None:
+        commons.io.COMPRESSION_LEVEL = compression_level
+
+    if http_pool_size is not None:
+        commons.http.POOL_SIZE = http_pool_size
+    if http_retries is not None:
+        commons.http.RETRIES = http_retries
+    for host, rate in http_rate_limit:
+        commons.http.RATE_LIMITS[host] = rate
+
+    if nlp_daemon:
+        commons.nlp_daemon.SOCKET = nlp_daemon
+    if tag_store:
+        commons.pos_tag.USE_STORE = True
@@ -3,6 +3,8 @@ import cli
 import pos_tag
 import logging
 import cache
+import http
+import nlp_daemon
 import wikidata
 import datetime
 import parallel
@@ -0,0 +1,304 @@
+# -*- encoding: utf-8 -*-
+from __future__ import absolute_import
+
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from difflib import SequenceMatcher
+from itertools import islice
+from SocketServer import ThreadingMixIn
+from time import sleep, time
+
+import click
+import numpy as np
+import requests
+
+from strephit.commons import io, parallel, pos_tag
+
+logger = logging.getLogger(__name__)
+
+
+def _hash_rounds(rounds):
+    """ Synthetic CPU-bound task, its cost grows linearly with `rounds` """
+    digest = str(rounds)
+    for _ in xrange(rounds):
+        digest = hashlib.sha1(digest).hexdigest()
+    return digest
+
+
+def _encoded_results(task):
+    """ Synthetic task producing many small JSON-encoded results """
+    size, count = task
+    return [json.dumps({'id': i, 'text': 'x' * size}) for i in xrange(count)]
+
+
+class _SlowHandler(BaseHTTPRequestHandler):
+    """ Answers every request with a small JSON document after a fixed delay """
+    latency = 0.05
+
+    def do_GET(self):
+        sleep(self.latency)
+        body = json.dumps({'path': self.path})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _start_mock_server(latency):
+    """ Serves :class:`_SlowHandler` on a random local port in a background thread
+
+        :return: the base URL of the server
+    """
+    class Handler(_SlowHandler):
+        pass
+    Handler.latency = latency
+    server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'http://127.0.0.1:%d' % server.server_address[1]
+
+
+def _time_map(function, tasks, **kwargs):
+    """ Consumes the results of :func:`parallel.map` on the given tasks
+
+        :return: tuple (number of results, elapsed seconds)
+    """
+    start = time()
+    count = sum(1 for _ in parallel.map(function, tasks, **kwargs))
+    return count, time() - start
+
+
+@click.group()
+def main():
+    """ Micro-benchmarks of the common utilities
+    """
+    pass
+
+
+@main.command(name='parallel')
+@click.option('--tasks', '-n', default=20000, help='How many tasks to process')
+@click.option('--cost', '-c', default=200, help='Average cost of a task, in sha1 rounds')
+@click.option('--skew', '-s', default=0.01, help='Fraction of tasks which are 100 times slower')
+@click.option('--processes', '-p', default=0, type=parallel.PROCESSES)
+@click.option('--window', '-w', multiple=True, type=int, default=[10, 100, 1000],
+              help='Sizes of the reorder window to try')
+@click.option('--seed', default=0)
+def parallel_map(tasks, cost, skew, processes, window, seed):
+    """ Compares the throughput of the ordered and unordered parallel map
+    """
+    rand = random.Random(seed)
+    workload = [cost * 100 if rand.random() < skew else rand.randint(1, 2 * cost)
+                for _ in xrange(tasks)]
+
+    runs = [('unordered', {})] + [('ordered, window %d' % w, {'ordered': True, 'window': w})
+                                   for w in window]
+    for name, kwargs in runs:
+        count, elapsed = _time_map(_hash_rounds, workload, processes=processes, **kwargs)
+        logger.info('%-22s %d results in %.2f seconds, %.1f tasks/s',
+                    name, count, elapsed, count / elapsed)
+
+
+@main.command()
+@click.option('--tasks', '-n', default=2000, help='How many tasks to process')
+@click.option('--results', '-r', default=500, help='How many results each task produces')
+@click.option('--size', '-s', default=200, help='Approximate size of each result, in bytes')
+@click.option('--processes', '-p', default=0, type=parallel.PROCESSES)
+def transport(tasks, results, size, processes):
+    """ Compares the throughput of the queue and bytes transports of the parallel map
+    """
+    workload = [(size, results)] * tasks
+    for name in ['queue', 'bytes']:
+        count, elapsed = _time_map(_encoded_results, workload, processes=processes,
+                                   flatten=True, transport=name)
+        logger.info('%-6s %d results in %.2f seconds, %.1f results/s',
+                    name, count, elapsed, count / elapsed)
+
+
+@main.command()
+@click.option('--requests', '-n', 'count', default=500, help='How many requests to perform')
+@click.option('--latency', '-l', default=0.05, help='Latency of the mock server, in seconds')
+@click.option('--processes', '-p', default=32, type=parallel.PROCESSES,
+              help='How many workers to use with each backend')
+def http(count, latency, processes):
+    """ Compares the process and thread backends of the parallel map on I/O-bound work
+    """
+    base_url = _start_mock_server(latency)
+
+    def fetch(i):
+        return requests.get('%s/%d' % (base_url, i)).json()['path']
+
+    for backend in ['processes', 'threads']:
+        done, elapsed = _time_map(fetch, xrange(count), processes=processes, backend=backend)
+        logger.info('%-9s %d requests in %.2f seconds, %.1f requests/s',
+                    backend, done, elapsed, done / elapsed)
+
+
+def _children_peak_memory():
+    """ Peak memory usage of the child processes, e.g. TreeTagger, which are
+        still running when the tagger is done. It is read from their `VmHWM`
+        in /proc, since :data:`resource.RUSAGE_CHILDREN` only accounts for
+        the children which terminated and were waited for
+
+        :return: the peak memory in kilobytes of the running children, summed,
+         plus the largest one of the terminated children
+    """
+    total = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if not os.path.isdir('/proc'):
+        return total
+
+    pid = str(os.getpid())
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+
+        try:
+            with open('/proc/%s/stat' % entry) as f:
+                # the name of the process is within parentheses and can contain spaces
+                ppid = f.read().rsplit(')', 1)[1].split()[1]
+            if ppid != pid:
+                continue
+
+            with open('/proc/%s/status' % entry) as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        total += int(line.split()[1])
+        except (IOError, OSError, IndexError, ValueError):
+            continue  # terminated in the meanwhile
+
+    return total
+
+
+def _run_tagger(name, language, documents, options):
+    """ Tags the documents one at a time with the given tagger. Meant to be run in a
+        separate process, so that the memory used by each tagger can be measured
+
+        :return: dict with the tags of each document as pairs (word, pos), the time
+         needed to tag each document and to load the tagger, and the peak memory usage
+         in kilobytes of the process and of its child processes, see :func:`_children_peak_memory`
+    """
+    start = time()
+    tagger = pos_tag.get_pos_tagger(language, name, use_store=False, **options)
+    tagger.tag_one(u'Warm up')
+    load_time = time() - start
+
+    tags, latencies = [], []
+    for document in documents:
+        start = time()
+        tagged = tagger.tag_one(document)
+        latencies.append(time() - start)
+        tags.append([(word, pos) for word, pos, _ in tagged])
+
+    return {
+        'tags': tags,
+        'latencies': latencies,
+        'load_time': load_time,
+        'peak_memory': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'peak_children_memory': _children_peak_memory(),
+    }
+
+
+def _agreement(reference, tagged):
+    """ Compares the tags of a document with the reference ones. Tokens are aligned first,
+        since each tagger has its own tokenization
+
+        :param list reference: Pairs (word, pos) of the reference tagger
+        :param list tagged: Pairs (word, pos) of the tagger to evaluate
+        :return: tuple (aligned, same tag, same coarse tag) counting the tokens of the reference
+         which are also found by the tagger and, among them, those with the same part of speech,
+         exactly or just its first letter, as tagsets differ in the details
+    """
+    matcher = SequenceMatcher(None, [word for word, _ in reference],
+                              [word for word, _ in tagged], autojunk=False)
+    aligned = same = coarse = 0
+    for i, j, size in matcher.get_matching_blocks():
+        for (_, expected), (_, actual) in zip(reference[i:i + size], tagged[j:j + size]):
+            aligned += 1
+            same += expected == actual
+            coarse += expected[:1].upper() == actual[:1].upper()
+    return aligned, same, coarse
+
+
+@main.command(name='pos_tag')
+@click.option('--corpus', '-c', type=click.Path(exists=True), default='samples/corpus.jsonlines')
+@click.option('--document-key', '-d', default='bio')
+@click.option('--language', '-l', default='en')
+@click.option('--tagger', '-t', 'taggers', type=click.Choice(pos_tag.TAGGERS), multiple=True,
+              help='Taggers to compare, by default all of them')
+@click.option('--reference', '-r', type=click.Choice(pos_tag.TAGGERS), default=pos_tag.DEFAULT_TAGGER,
+              help='Tagger whose results are considered correct')
+@click.option('--documents', '-n', default=100, help='How many documents of the corpus to tag')
+@click.option('--tt-home', type=click.Path(exists=True, resolve_path=True),
+              help='home directory for TreeTagger')
+@click.option('--outfile', '-o', type=click.File('w'), help='Also save the results as JSON here')
+def pos_tagger(corpus, document_key, language, taggers, reference, documents, tt_home, outfile):
+    """ Compares the speed, memory usage and accuracy of the POS taggers
+    """
+    texts = [item[document_key] for item in islice(
+        (item for item in io.load_scraped_items(corpus) if item.get(document_key)), documents
+    )]
+    logger.info('Tagging %d documents of %s in %s', len(texts), corpus, language)
+
+    results = {}
+    for name in sorted(set(taggers or pos_tag.TAGGERS.keys()) | {reference}):
+        # a new process for each tagger, so that their memory is not mixed
+        pool = multiprocessing.Pool(1)
+        try:
+            results[name] = pool.apply(_run_tagger, (name, language, texts, {'tt_home': tt_home}))
+        except Exception as e:
+            logger.error('Tagger %s failed, skipping it: %s: %s', name, type(e).__name__, e)
+        finally:
+            pool.terminate()
+
+    report = {}
+    for name, result in sorted(results.iteritems()):
+        tokens = sum(len(tags) for tags in result['tags'])
+        p50, p90, p99 = np.percentile(result['latencies'], [50, 90, 99]) * 1000
+        report[name] = {
+            'tokens': tokens,
+            'tokens_per_second': tokens / max(sum(result['latencies']), 1e-9),
+            'latency_ms': {'p50': p50, 'p90': p90, 'p99': p99},
+            'load_seconds': result['load_time'],
+            'peak_memory_kb': result['peak_memory'],
+            'peak_children_memory_kb': result['peak_children_memory'],
+        }
+
+        if reference in results:
+            counts = [_agreement(expected, tagged) for expected, tagged
+                      in zip(results[reference]['tags'], result['tags'])]
+            aligned, same, coarse = map(sum, zip(*counts)) if counts else (0, 0, 0)
+            reference_tokens = max(sum(len(tags) for tags in results[reference]['tags']), 1)
+            report[name]['agreement'] = {
+                'aligned': float(aligned) / reference_tokens,
+                'exact': float(same) / max(aligned, 1),
+                'coarse': float(coarse) / max(aligned, 1),
+            }
+
+        logger.info('%-6s %8.1f tokens/s, latency p50 %.1f ms, p90 %.1f ms, p99 %.1f ms, '
+                    'loaded in %.2f s, peak memory %d kB (children %d kB)',
+                    name, report[name]['tokens_per_second'], p50, p90, p99, result['load_time'],
+                    result['peak_memory'], result['peak_children_memory'])
+        if 'agreement' in report[name]:
+            logger.info('%-6s agreement with %s: %.1f%% of the tokens aligned, same tag for %.1f%% '
+                        '(%.1f%% ignoring the details)', name, reference,
+                        100 * report[name]['agreement']['aligned'], 100 * report[name]['agreement']['exact'],
+                        100 * report[name]['agreement']['coarse'])
+
+    if outfile:
+        json.dump({'corpus': corpus, 'language': language, 'documents': len(texts),
+                   'reference': reference, 'taggers': report}, outfile, indent=2)
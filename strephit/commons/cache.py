@@ -1,11 +1,64 @@
+from __future__ import absolute_import
+
+import __builtin__
 import tempfile
 import os
+import gzip
 import hashlib
+import heapq
+import inspect
+import errno
+import fcntl
 import json
+import logging
+import re
+import sqlite3
+import threading
+import unicodedata
+import zlib
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from multiprocessing.util import Finalize
+from functools import wraps
+from time import sleep, time
+
+import click
 
+logger = logging.getLogger(__name__)
 
 BASE_DIR = os.path.join(tempfile.gettempdir(), 'strephit-cache')
 ENABLED = True
+BACKEND = 'files'
+MEMORY_MAX_ITEMS = 10000
+MEMORY_MAX_BYTES = 64 * 1024 * 1024
+
+# values larger than this many bytes are stored compressed
+COMPRESSION_THRESHOLD = 1024
+COMPRESSION_LEVEL = 6
+
+# only one process at a time computes the result of a cached function for the
+# same arguments, the others wait up to this many seconds and then use its result
+LOCK_TIMEOUT = 60
+
+# keys of cached functions longer than this use a hash of the arguments
+MAX_ARGUMENTS_LENGTH = 200
+
+DAY = 24 * 60 * 60
+
+# How many seconds items stay valid, by namespace. Items expire according
+# to the longest matching namespace prefix, and never if there is none or
+# the TTL is None. The namespace of cached functions is their full name
+TTL = {
+    # search results change as Wikidata and DBpedia are edited
+    'strephit.commons.wikidata': 30 * DAY,
+    'strephit.commons.entity_linking': 30 * DAY,
+    'strephit.side_projects.wlm': 30 * DAY,
+    # parsing dates does not depend on external services
+    'strephit.commons.wikidata.date_resolver': None,
+    # neither does POS tagging, but the tags are a copy of the
+    # corpus which is not needed anymore once it is processed
+    'strephit.commons.pos_tag': 30 * DAY,
+}
 
 
 def _hash_for(key):
@@ -22,6 +75,613 @@ def _path_for(hashed_key):
     return os.path.join(loc, hashed_key), loc, hashed_key
 
 
+_CACHED_KEY = re.compile(r"^\['([\w.]+)'\](\w+)")
+
+
+def _namespace_of(key, meta):
+    """ Finds the namespace of an item from its metadata or, for items
+        stored before metadata was introduced, from the key used by :func:`cached`
+
+        :return: The namespace, or `None` if unknown
+    """
+    if meta.get('ns'):
+        return meta['ns']
+
+    match = _CACHED_KEY.match(key)
+    return '%s.%s' % match.groups() if match else None
+
+
+def _ttl_for(namespace):
+    """ Finds the TTL of a namespace, see :data:`TTL`
+
+        :return: The TTL in seconds, or `None` if items never expire
+    """
+    if namespace is None:
+        return None
+
+    longest = None
+    for prefix in TTL:
+        if namespace.startswith(prefix) and (longest is None or len(prefix) > len(longest)):
+            longest = prefix
+    return TTL[longest] if longest is not None else None
+
+
+def _encode(value):
+    """ Serializes a value, compressing it if larger than :data:`COMPRESSION_THRESHOLD`
+
+        :return: tuple (uncompressed JSON, stored bytes, codec or `None`)
+    """
+    data = json.dumps(value).encode('utf8')
+    if len(data) > COMPRESSION_THRESHOLD:
+        return data, zlib.compress(data, COMPRESSION_LEVEL), 'zlib'
+    else:
+        return data, data, None
+
+
+def _decompress(raw, meta):
+    """ Undoes the compression of a stored value, according to its metadata
+
+        :return: The uncompressed JSON
+    """
+    codec = meta.get('codec')
+    if codec is None:
+        return raw
+    elif codec == 'zlib':
+        return zlib.decompress(raw)
+    else:
+        raise ValueError('unknown codec %s' % codec)
+
+
+def _is_expired(key, meta, now):
+    """ Checks whether an item is older than the TTL of its namespace
+    """
+    ttl = _ttl_for(_namespace_of(key, meta))
+    return ttl is not None and meta.get('created') is not None and \
+        now - meta['created'] > ttl
+
+
+class FileBackend(object):
+    """ Stores every item in its own file, named after the hash of the key.
+        The first line of the file contains the key, the second one a JSON header
+        with the metadata of the item prefixed by `#`, the rest is the value.
+        Items stored before metadata was introduced have no header.
+        Collisions are resolved by storing the item under the key followed
+        by its hash.
+
+        The last access time of the files is used for eviction, and it is
+        updated at most once every :data:`ACCESS_RESOLUTION` seconds.
+    """
+
+    ACCESS_RESOLUTION = 3600
+    TEMP_PREFIX = '.tmp-'
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+
+    @staticmethod
+    def _read(f, stat):
+        """ Reads the metadata and the value from a file, after the key
+        """
+        line = f.readline()
+        if line.startswith('#'):
+            meta = json.loads(line[1:])
+            value = f.read()
+        else:
+            meta = {'created': stat.st_mtime}
+            value = line + f.read()
+        return value, meta
+
+    @staticmethod
+    def _header(meta):
+        return '#' + json.dumps(meta) + '\n'
+
+    def get(self, key):
+        """ Retrieves the serialized value associated to the key and its metadata
+
+            :return: tuple (value, metadata) or `None`
+        """
+        hashed = _hash_for(key)
+        loc, _, _ = _path_for(hashed)
+        try:
+            stat = os.stat(loc)
+        except OSError:
+            return None
+
+        with open(loc) as f:
+            stored_key = f.readline().decode('utf8')[:-1]
+            if stored_key != key:
+                return self.get(key + hashed)
+            value, meta = self._read(f, stat)
+
+        now = time()
+        if now - stat.st_atime > self.ACCESS_RESOLUTION:
+            try:
+                os.utime(loc, (now, stat.st_mtime))
+            except OSError:
+                pass
+
+        return value, meta
+
+    def get_many(self, keys):
+        """ Retrieves the serialized values associated to many keys, see :meth:`get`
+
+            :return: dict key -> (value, metadata) of the keys which were found
+        """
+        found = {}
+        for key in keys:
+            try:
+                stored = self.get(key)
+            except ValueError:
+                logger.warn('corrupt cache item %s, ignoring it', repr(key))
+                continue
+
+            if stored is not None:
+                found[key] = stored
+        return found
+
+    @staticmethod
+    def _stored_key(loc):
+        """ Reads the key stored in a file
+
+            :return: The key, or `None` if the file does not exist or is corrupt
+        """
+        try:
+            with open(loc) as f:
+                line = f.readline()
+            return line[:-1].decode('utf8') if line.endswith('\n') else None
+        except (IOError, UnicodeDecodeError):
+            return None
+
+    def set(self, key, value, overwrite, meta):
+        """ Stores the serialized value and its metadata under the given key.
+            The item is written to a temporary file which is then moved in place,
+            so that readers never see partially written items. When not overwriting,
+            the item is written only if no other process wrote it in the meantime.
+        """
+        hashed = _hash_for(key)
+        loc, path, fname = _path_for(hashed)
+
+        stored_key = self._stored_key(loc)
+        if stored_key is not None and stored_key != key:
+            return self.set(key + hashed, value, overwrite, meta)
+        elif stored_key is not None and not overwrite:
+            return
+
+        if not os.path.exists(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                pass
+
+        fd, tmp = tempfile.mkstemp(dir=path, prefix=self.TEMP_PREFIX)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(key.encode('utf8') + '\n')
+                f.write(self._header(meta))
+                f.write(value)
+            os.chmod(tmp, 0644)
+
+            if overwrite or stored_key is None and os.path.exists(loc):
+                # also replaces corrupt items
+                os.rename(tmp, loc)
+            else:
+                try:
+                    os.link(tmp, loc)
+                except OSError as ex:
+                    if ex.errno != errno.EEXIST:
+                        raise
+                    # somebody else was faster
+                    stored_key = self._stored_key(loc)
+                    if stored_key is None:
+                        os.rename(tmp, loc)
+                    elif stored_key != key:
+                        self.set(key + hashed, value, overwrite, meta)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def flush(self, keys=None):
+        pass
+
+    def scan(self):
+        """ Iterates over all the items in the cache, without reading the values
+
+            :return: tuples (handle, key, size in bytes, metadata, last access time),
+             where handles can be given to :meth:`remove`
+            :rtype: generator
+        """
+        for path, _, files in os.walk(self.base_dir):
+            for fname in files:
+                if len(fname) != 40:
+                    continue
+
+                loc = os.path.join(path, fname)
+                stat = os.stat(loc)
+                with open(loc) as f:
+                    key = self._original_key(f.readline().decode('utf8', 'replace')[:-1])
+                    line = f.readline()
+
+                try:
+                    meta = json.loads(line[1:]) if line.startswith('#') else {}
+                except ValueError:
+                    meta = {}  # corrupt, see the verify command
+                meta.setdefault('created', stat.st_mtime)
+                yield loc, key, stat.st_size, meta, stat.st_atime
+
+    def remove(self, handles):
+        for handle in handles:
+            try:
+                os.remove(handle)
+            except OSError:
+                pass
+
+    def compact(self):
+        """ Removes empty directories and temporary files left by killed processes
+        """
+        now = time()
+        for path, _, files in os.walk(self.base_dir, topdown=False):
+            for fname in files:
+                loc = os.path.join(path, fname)
+                if fname.startswith(self.TEMP_PREFIX) and now - os.path.getmtime(loc) > 3600:
+                    try:
+                        os.remove(loc)
+                    except OSError:
+                        pass
+
+            if path != self.base_dir and not os.listdir(path):
+                try:
+                    os.rmdir(path)
+                except OSError:
+                    pass
+
+    def items(self):
+        """ Iterates over all the items in the cache
+
+            :return: tuples (key, serialized value, metadata)
+            :rtype: generator
+        """
+        for path, _, files in os.walk(self.base_dir):
+            for fname in files:
+                if len(fname) != 40:
+                    continue
+
+                loc = os.path.join(path, fname)
+                try:
+                    with open(loc) as f:
+                        key = self._original_key(f.readline().decode('utf8')[:-1])
+                        value, meta = self._read(f, os.fstat(f.fileno()))
+                except ValueError:
+                    logger.warn('skipping corrupt item %s', loc)
+                    continue
+                yield key, value, meta
+
+    @staticmethod
+    def _original_key(key):
+        """ Undoes the collision resolution """
+        while len(key) > 40 and _hash_for(key[:-40]) == key[-40:]:
+            key = key[:-40]
+        return key
+
+
+class SQLiteBackend(object):
+    """ Stores all the items in a single SQLite database in WAL mode, so that
+        workers can read concurrently while another one is writing.
+        Writes and access times are buffered and committed in batches of
+        :data:`WRITE_BATCH_SIZE`, and when the process exits.
+    """
+
+    FILE_NAME = 'cache.sqlite'
+    WRITE_BATCH_SIZE = 100
+    READ_BATCH_SIZE = 500  # SQLite allows at most 999 parameters per query
+    COLUMNS = [('namespace', 'TEXT'), ('created', 'REAL'), ('accessed', 'REAL'), ('codec', 'TEXT')]
+
+    def __init__(self, base_dir):
+        if not os.path.exists(base_dir):
+            try:
+                os.makedirs(base_dir)
+            except OSError:
+                pass
+
+        self.path = os.path.join(base_dir, self.FILE_NAME)
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.accessed = {}
+
+        self.connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, '
+                                    'value BLOB, %s)' % ', '.join(' '.join(c) for c in self.COLUMNS))
+
+            # databases created before metadata was introduced lack these
+            existing = {row[1] for row in self.connection.execute('PRAGMA table_info(cache)')}
+            for name, kind in self.COLUMNS:
+                if name not in existing:
+                    try:
+                        self.connection.execute('ALTER TABLE cache ADD COLUMN %s %s' % (name, kind))
+                    except sqlite3.OperationalError:
+                        pass  # added by another process in the meantime
+
+        # also run when forked workers exit, unlike atexit handlers
+        Finalize(self, self.flush, exitpriority=10)
+
+    def get(self, key):
+        """ Retrieves the serialized value associated to the key and its metadata
+
+            :return: tuple (value, metadata) or `None`
+        """
+        with self.lock:
+            if key in self.pending:
+                value, _, meta = self.pending[key]
+                return value, meta
+
+            row = self.connection.execute('SELECT value, namespace, created, codec FROM cache '
+                                          'WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+
+            self.accessed[key] = time()
+            full = len(self.pending) + len(self.accessed) >= self.WRITE_BATCH_SIZE
+
+        if full:
+            self.flush()
+
+        value, namespace, created, codec = row
+        return str(value), self._meta(namespace, created, codec)
+
+    def get_many(self, keys):
+        """ Retrieves the serialized values associated to many keys with
+            few queries, see :meth:`get`
+
+            :return: dict key -> (value, metadata) of the keys which were found
+        """
+        found = {}
+        with self.lock:
+            missing = []
+            for key in keys:
+                if key in self.pending:
+                    value, _, meta = self.pending[key]
+                    found[key] = value, meta
+                else:
+                    missing.append(key)
+
+            now = time()
+            for start in xrange(0, len(missing), self.READ_BATCH_SIZE):
+                chunk = missing[start:start + self.READ_BATCH_SIZE]
+                rows = self.connection.execute(
+                    'SELECT key, value, namespace, created, codec FROM cache WHERE key IN (%s)'
+                    % ', '.join('?' * len(chunk)), chunk
+                )
+                for key, value, namespace, created, codec in rows:
+                    found[key] = str(value), self._meta(namespace, created, codec)
+                    self.accessed[key] = now
+            full = len(self.pending) + len(self.accessed) >= self.WRITE_BATCH_SIZE
+
+        if full:
+            self.flush()
+        return found
+
+    def set(self, key, value, overwrite, meta):
+        """ Buffers the serialized value, flushing the buffer when full
+        """
+        with self.lock:
+            if overwrite or key not in self.pending:
+                self.pending[key] = value, overwrite, meta
+            full = len(self.pending) + len(self.accessed) >= self.WRITE_BATCH_SIZE
+
+        if full:
+            self.flush()
+
+    def flush(self, keys=None):
+        """ Commits the buffered writes
+
+            :param keys: Only commit the writes of these keys, leaving the others
+             and the access times in the buffer
+        """
+        with self.lock:
+            if keys is None:
+                pending, accessed = self.pending, self.accessed
+            else:
+                pending = {key: self.pending[key] for key in keys if key in self.pending}
+                accessed = {}
+            if not pending and not accessed:
+                return
+
+            replace, ignore = [], []
+            for key, (value, overwrite, meta) in pending.iteritems():
+                row = (key, sqlite3.Binary(value), meta.get('ns'),
+                       meta.get('created'), meta.get('created'), meta.get('codec'))
+                (replace if overwrite else ignore).append(row)
+
+            with self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO cache '
+                                            '(key, value, namespace, created, accessed, codec) '
+                                            'VALUES (?, ?, ?, ?, ?, ?)', replace)
+                self.connection.executemany('INSERT OR IGNORE INTO cache '
+                                            '(key, value, namespace, created, accessed, codec) '
+                                            'VALUES (?, ?, ?, ?, ?, ?)', ignore)
+                self.connection.executemany('UPDATE cache SET accessed = ? WHERE key = ?',
+                                            [(t, k) for k, t in accessed.iteritems()])
+
+            if keys is None:
+                self.pending = {}
+                self.accessed = {}
+            else:
+                for key in pending:
+                    del self.pending[key]
+
+    def scan(self):
+        """ Iterates over all the items in the cache, without reading the values
+
+            :return: tuples (handle, key, size in bytes, metadata, last access time),
+             where handles can be given to :meth:`remove`
+            :rtype: generator
+        """
+        self.flush()
+        rows = self.connection.execute('SELECT key, length(key) + length(value), namespace, '
+                                       'created, codec, accessed FROM cache').fetchall()
+        for key, size, namespace, created, codec, accessed in rows:
+            yield key, key, size, self._meta(namespace, created, codec), accessed or created or 0
+
+    def remove(self, handles):
+        with self.lock:
+            with self.connection:
+                self.connection.executemany('DELETE FROM cache WHERE key = ?',
+                                            ((handle,) for handle in handles))
+
+    def compact(self):
+        """ Gives the space freed by removed items back to the file system
+        """
+        self.flush()
+        with self.lock:
+            self.connection.execute('VACUUM')
+            self.connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def items(self):
+        """ Iterates over all the items in the cache
+
+            :return: tuples (key, serialized value, metadata)
+            :rtype: generator
+        """
+        self.flush()
+        for key, value, namespace, created, codec in self.connection.execute(
+                'SELECT key, value, namespace, created, codec FROM cache'):
+            yield key, str(value), self._meta(namespace, created, codec)
+
+    @staticmethod
+    def _meta(namespace, created, codec):
+        meta = {'created': created}
+        if namespace is not None:
+            meta['ns'] = namespace
+        if codec is not None:
+            meta['codec'] = codec
+        return meta
+
+
+BACKENDS = {
+    'files': FileBackend,
+    'sqlite': SQLiteBackend,
+}
+
+
+class MemoryCache(object):
+    """ Least recently used items of this process, kept in memory in front of
+        the backend. Its size is bounded by :data:`MEMORY_MAX_ITEMS` and
+        :data:`MEMORY_MAX_BYTES`, the latter measured on the serialized values.
+
+        Lists and dicts are decoded again from their serialized form on every hit,
+        so that callers cannot modify the cached copy.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = self.misses = 0
+
+        Finalize(self, self.log_stats, exitpriority=5)
+
+    def get(self, key):
+        """ Retrieves the value associated to the key, or `None`
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries[key] = entry
+            self.hits += 1
+
+        value, raw, _ = entry
+        return json.loads(raw.decode('utf8')) if raw is not None else value
+
+    def set(self, key, raw, value=None):
+        """ Stores the value, evicting the least recently used items if needed
+
+            :param raw: The serialized value
+            :param value: The deserialized value, if already available
+        """
+        size = len(key) + len(raw)
+        if size > MEMORY_MAX_BYTES:
+            self.discard(key)
+            return
+
+        if value is None:
+            value = json.loads(raw.decode('utf8'))
+
+        if isinstance(value, (list, dict)):
+            entry = None, raw, size
+        else:
+            entry = value, None, size
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[2]
+
+            self.entries[key] = entry
+            self.size += size
+            while len(self.entries) > MEMORY_MAX_ITEMS or self.size > MEMORY_MAX_BYTES:
+                _, (_, _, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+
+    def discard(self, key):
+        """ Removes the key, if present
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[2]
+
+    def log_stats(self):
+        lookups = self.hits + self.misses
+        if lookups:
+            logger.info('In-memory cache: %d hits, %d misses (%.1f%% hit rate), '
+                        '%d items using %d bytes', self.hits, self.misses,
+                        100.0 * self.hits / lookups, len(self.entries), self.size)
+
+
+_instance = None
+_inherited = []
+
+
+def _current():
+    """ Returns the backend and in-memory cache currently in use, creating them
+        if the configuration changed or if this is a newly forked process
+
+        :return: tuple (backend, memory cache)
+    """
+    global _instance
+
+    config = BACKEND, BASE_DIR, os.getpid()
+    if _instance is None or _instance[0] != config:
+        if _instance is not None and _instance[0][2] == config[2]:
+            _instance[1].flush()
+        elif _instance is not None:
+            # the parent is still using it, so just make sure it
+            # is not garbage-collected (and closed) in this process
+            _inherited.append(_instance[1])
+        _instance = config, BACKENDS[BACKEND](BASE_DIR), MemoryCache()
+    return _instance[1:]
+
+
+def _backend():
+    """ Returns the backend currently in use, see :func:`_current`
+    """
+    return _current()[0]
+
+
+def memory_stats():
+    """ Statistics of the in-memory cache of this process
+
+        :return: dict with the number of hits, misses, items and their size in bytes
+    """
+    _, memory = _current()
+    return {'hits': memory.hits, 'misses': memory.misses,
+            'items': len(memory.entries), 'bytes': memory.size}
+
+
 def get(key, default=None):
     """ Retrieves an item from the cache
 
@@ -45,20 +705,83 @@ def get(key, default=None):
     if not ENABLED:
         return default
 
-    hashed = _hash_for(key)
-    loc, _, _ = _path_for(hashed)
-    if os.path.exists(loc):
-        with open(loc) as f:
-            stored_key = f.readline().decode('utf8')[:-1]
-            if stored_key == key:
-                return json.loads(f.read().decode('utf8'))
-            else:
-                return get(key + hashed, default)
-    else:
+    backend, memory = _current()
+    value = memory.get(key)
+    if value is not None:
+        return value
+    return _get_stored(key, backend, memory, default)
+
+
+def _get_stored(key, backend, memory, default=None):
+    """ Retrieves an item from the backend, skipping the in-memory cache
+        and its statistics, and keeps it in memory
+    """
+    try:
+        stored = backend.get(key)
+    except ValueError:
+        logger.warn('corrupt cache item %s, ignoring it', repr(key))
+        return default
+
+    if stored is None:
+        return default
+    return _load(key, stored, memory, time(), default)
+
+
+def _load(key, stored, memory, now, default):
+    """ Decodes an item retrieved from the backend and keeps it in memory
+
+        :param stored: tuple (serialized value, metadata) given by the backend
+        :return: the value, or the default if expired or corrupt
+    """
+    raw, meta = stored
+    if _is_expired(key, meta, now):
+        return default
+
+    try:
+        data = _decompress(raw, meta)
+        value = json.loads(data.decode('utf8'))
+    except (ValueError, zlib.error):
+        logger.warn('corrupt cache item %s, ignoring it', repr(key))
         return default
 
+    memory.set(key, data, value)
+    return value
+
+
+def get_many(keys, default=None):
+    """ Retrieves many items from the cache at once, which is much faster
+        than calling :func:`get` for each of them with the SQLite backend
 
-def set(key, value, overwrite=True):
+        :param list keys: Keys of the items
+        :param default: Value returned for the keys which are not in the cache
+        :return: The items associated with the given keys, in the same order
+        :rtype: list
+
+        Sample usage:
+
+        >>> from strephit.commons import cache
+        >>> cache.set_many([('k1', 1), ('k2', 2)])
+        >>> cache.get_many(['k1', 'k3', 'k2'])
+        [1, None, 2]
+    """
+    keys = list(keys)
+    if not ENABLED:
+        return [default] * len(keys)
+
+    backend, memory = _current()
+    values = [memory.get(key) for key in keys]
+    missing = [key for key, value in zip(keys, values) if value is None]
+    if not missing:
+        return values
+
+    stored, now = backend.get_many(missing), time()
+    for i, key in enumerate(keys):
+        if values[i] is None:
+            values[i] = _load(key, stored[key], memory, now, default) if key in stored else default
+    return values
+
+
+def set(key, value, overwrite=True, namespace=None):
     """ Stores an item in the cache under the given key
 
         :param key: Unique key used to identify the idem.
@@ -66,6 +789,8 @@ def set(key, value, overwrite=True):
          JSON-dumpable
         :param overwrite: Whether to overwrite the previous
          value associated with the key (if any)
+        :param namespace: Group of the item, used to decide
+         when it expires, see :data:`TTL`
         :return: Nothing
 
         Sample usage:
@@ -82,32 +807,202 @@ def set(key, value, overwrite=True):
     if not ENABLED:
         return
 
-    hashed = _hash_for(key)
-    loc, path, fname = _path_for(hashed)
-    if not os.path.exists(loc):
-        if not os.path.exists(path):
+    backend, memory = _current()
+    data, raw, codec = _encode(value)
+    meta = {'created': time()}
+    if namespace:
+        meta['ns'] = namespace
+    if codec:
+        meta['codec'] = codec
+    backend.set(key, raw, overwrite, meta)
+    if overwrite:
+        # strings and tuples are decoded as unicode and lists, let the memory cache decode
+        # them. Lists and dicts are kept serialized, so that the caller's copy is not shared
+        memory.set(key, data, value if not isinstance(value, (str, tuple)) else None)
+    else:
+        # the backend might be keeping a different value
+        memory.discard(key)
+
+
+def set_many(items, overwrite=True, namespace=None):
+    """ Stores many items in the cache, see :func:`set`
+
+        :param items: pairs (key, value)
+        :param overwrite: Whether to overwrite the previous values
+        :param namespace: Group of the items
+    """
+    for key, value in items:
+        set(key, value, overwrite, namespace)
+
+
+def flush(keys=None):
+    """ Makes sure that all the items stored so far are written
+        to the backend. Buffered writes are flushed automatically
+        when the process exits.
+
+        :param keys: Only write the items with these keys
+    """
+    if ENABLED:
+        _backend().flush(keys)
+
+
+def _canonical(obj):
+    """ Converts an object to a canonical form, normalizing strings to unicode
+        NFC and collections to lists, with sets sorted. Dict keys which are
+        collections, e.g. tuples, are replaced by their canonical JSON
+    """
+    if isinstance(obj, str):
+        obj = obj.decode('utf8', 'replace')
+
+    if isinstance(obj, unicode):
+        return unicodedata.normalize('NFC', obj)
+    elif isinstance(obj, dict):
+        canonical = {}
+        for k, v in obj.iteritems():
+            k = _canonical(k)
+            if isinstance(k, (list, dict)):
+                k = _serialize(k)
+            canonical[k] = _canonical(v)
+        return canonical
+    elif isinstance(obj, (list, tuple)):
+        return [_canonical(each) for each in obj]
+    elif isinstance(obj, (__builtin__.set, frozenset)):
+        return sorted(_canonical(each) for each in obj)
+    else:
+        return obj
+
+
+def _stable_repr(obj):
+    """ Representation of objects which are not JSON-serializable, only for those
+        defining their own `repr`. The default one contains the memory address of
+        the object, which would make a different key at each call
+    """
+    if type(obj).__repr__ is object.__repr__:
+        raise TypeError('%s objects are not JSON serializable and have no stable repr'
+                        % type(obj).__name__)
+    return repr(obj)
+
+
+def _serialize(canonical):
+    """ Compact JSON representation of an object in canonical form
+    """
+    return json.dumps(canonical, sort_keys=True, ensure_ascii=False,
+                      separators=(',', ':'), default=_stable_repr)
+
+
+def key_for(namespace, arguments):
+    """ Builds the key of a call to a cached function from the canonical JSON
+        representation of its arguments, replaced by its hash when too long.
+        Use it to build the keys of items stored with :func:`set` as well
+
+        :param str namespace: Namespace of the item
+        :param arguments: JSON-serializable arguments identifying the item
+        :rtype: unicode
+        :raises TypeError: If some arguments cannot be serialized to JSON and do
+         not define their own `repr`. Exclude them or give a `key` function
+         to :func:`cached`
+    """
+    try:
+        serialized = _serialize(_canonical(arguments))
+    except TypeError as e:
+        raise TypeError('cannot build the cache key of %s: %s' % (namespace, e))
+
+    if len(serialized) > MAX_ARGUMENTS_LENGTH:
+        serialized = '#' + hashlib.sha1(serialized.encode('utf8')).hexdigest()
+    return u'%s %s' % (namespace, serialized)
+
+
+def _lock_paths(key):
+    """ Paths of the lock file of a key and of the file telling that somebody is waiting for it
+    """
+    base = os.path.join(BASE_DIR, '.locks', _hash_for(key))
+    return base + '.lock', base + '.wait'
+
+
+@contextmanager
+def _key_lock(key):
+    """ Exclusive lock on a key, shared by all the processes and threads using the
+        cache. Lock files are removed after use, so the lock is acquired only if the
+        file is still the same after locking it. Gives up after :data:`LOCK_TIMEOUT`
+        seconds, or right away when the lock file cannot be created. Those who wait
+        leave a mark which the holder can see with :func:`_lock_waited`.
+
+        :return: Whether the lock was acquired
+    """
+    path, waiting = _lock_paths(key)
+    deadline = time() + LOCK_TIMEOUT
+    delay = 0.01
+    fd = None
+    while fd is None and time() < deadline:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_RDWR, 0644)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                logger.warn('cannot create the lock file %s, going on without it: %s', path, e)
+                break
+
+            # the directory is missing, e.g. removed by the gc command
             try:
-                os.makedirs(path)
+                os.makedirs(os.path.dirname(path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    logger.warn('cannot create the lock file %s, going on without it: %s', path, e)
+                    break
+            continue
+
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if os.fstat(fd).st_ino != os.stat(path).st_ino:
+                raise OSError(errno.ENOENT, 'lock file removed by its previous holder')
+        except (IOError, OSError):
+            os.close(fd)
+            fd = None
+            try:
+                os.close(os.open(waiting, os.O_CREAT | os.O_RDWR, 0644))
             except OSError:
                 pass
+            sleep(delay)
+            delay = min(2 * delay, 0.5)
 
-        with open(loc, 'w') as f:
-            f.write(key.encode('utf8') + '\n')
-            f.write(json.dumps(value).encode('utf8'))
-    else:
-        with open(loc, 'r+') as f:
-            stored_key = f.readline().decode('utf8')[:-1]
-            if stored_key == key:
-                if overwrite:
-                    f.write(json.dumps(value).encode('utf8'))
-                    f.truncate()
-                return
-        set(key + hashed, value, overwrite)
+    if fd is None:
+        logger.debug('going on without the lock on %s', repr(key))
 
+    try:
+        yield fd is not None
+    finally:
+        if fd is not None:
+            for each in [waiting, path]:
+                try:
+                    os.remove(each)
+                except OSError:
+                    pass
+            os.close(fd)
 
-def cached(function):
+
+def _lock_waited(key):
+    """ Whether somebody tried to acquire the lock on the key while it was held
+    """
+    return os.path.exists(_lock_paths(key)[1])
+
+
+def cached(function=None, key=None, exclude=None):
     """ Decorator to cache function results based on its arguments
 
+        Arguments are bound to the parameters of the function, so the key does not
+        depend on whether they are passed by position or by name, nor on the order
+        of dicts and sets. Strings are normalized to unicode NFC.
+
+        When several processes call the function with the same arguments at the
+        same time, only one of them computes the result while the others wait
+        for it, see :data:`LOCK_TIMEOUT`.
+
+        :param function: The function to cache, when used without arguments
+        :param key: Function called with the same arguments of the cached function
+         which returns what to use as the key instead of the arguments. Needed
+         when the arguments cannot be serialized to JSON, see :func:`key_for`
+        :param exclude: Names of the parameters which do not affect the result and
+         should not be part of the key, for example `kwargs` for `**kwargs`
+
     Sample usage:
 
     >>> from strephit.commons import cache
@@ -121,14 +1016,266 @@ def cached(function):
     20
     >>> f(10)
     20
+    >>> @cache.cached(exclude=['verbose'])
+    ... def g(x, verbose=False):
+    ...     print 'inside g'
+    ...     return 2 * x
+    ...
+    >>> g(10)
+    inside g
+    20
+    >>> g(x=10, verbose=True)
+    20
 
     """
+    if function is None:
+        return lambda function: cached(function, key, exclude)
+
+    namespace = '%s.%s' % (function.__module__, function.__name__)
+    exclude = exclude or []
+
+    @wraps(function)
     def wrapper(*args, **kwargs):
-        key = str([function.__module__]) + function.__name__ + str(args) + str(kwargs)
-        res = get(key)
-        if res is None:
+        if key is not None:
+            arguments = key(*args, **kwargs)
+        else:
+            arguments = inspect.getcallargs(function, *args, **kwargs)
+            for name in exclude:
+                arguments.pop(name, None)
+
+        item_key = key_for(namespace, arguments)
+        res = get(item_key)
+        if res is None and ENABLED:
+            with _key_lock(item_key) as locked:
+                # somebody else might have computed it while we were waiting
+                backend, memory = _current()
+                res = _get_stored(item_key, backend, memory)
+                if res is None:
+                    res = function(*args, **kwargs)
+                    if res is not None:
+                        # nobody else writes the key while we hold the lock,
+                        # so the value can also be kept in memory
+                        set(item_key, res, overwrite=locked, namespace=namespace)
+                        if locked and _lock_waited(item_key):
+                            flush([item_key])  # make it visible to whoever is waiting
+        elif res is None:
             res = function(*args, **kwargs)
-            if res is not None:
-                set(key, res)
         return res
     return wrapper
+
+
+class SizeParamType(click.ParamType):
+    """ Size in bytes, optionally followed by a unit among K, M, G and T
+    """
+    name = 'size'
+    UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, (int, long)):
+            return value
+
+        match = re.match(r'^(\d+(?:\.\d+)?)\s*([KMGT]?)B?$', value.strip().upper())
+        if not match:
+            self.fail('%s is not a valid size' % value, param, ctx)
+        number, unit = match.groups()
+        return int(float(number) * self.UNITS[unit])
+
+
+SIZE = SizeParamType()
+
+
+@click.group()
+def main():
+    """ Manages the cache
+    """
+    pass
+
+
+@main.command()
+@click.argument('source', type=click.Choice(BACKENDS.keys()))
+@click.argument('target', type=click.Choice(BACKENDS.keys()))
+@click.option('--overwrite/--no-overwrite', default=False,
+              help='Whether to replace the items already in the target backend')
+def migrate(source, target, overwrite):
+    """ Copies all the items from a backend to another
+    """
+    if source == target:
+        raise click.BadParameter('source and target backends must differ')
+
+    source = BACKENDS[source](BASE_DIR)
+    target = BACKENDS[target](BASE_DIR)
+
+    count = 0
+    for key, value, meta in source.items():
+        target.set(key, value, overwrite, meta)
+        count += 1
+        if count % 10000 == 0:
+            logger.info('Migrated %d items so far', count)
+    target.flush()
+
+    logger.info('Done, migrated %d items', count)
+
+
+@main.command()
+@click.option('--max-size', type=SIZE, help='Evict the least recently used items until '
+                                            'the cache is smaller than this, e.g. 10G')
+@click.option('--ttl', type=(unicode, float), multiple=True, metavar='NAMESPACE DAYS',
+              help='Override the TTL of the items in a namespace')
+@click.option('--dry-run', is_flag=True, help='Only report what would be removed')
+def gc(max_size, ttl, dry_run):
+    """ Removes the expired items and enforces the maximum size of the cache
+    """
+    for namespace, days in ttl:
+        TTL[namespace] = days * DAY
+
+    backend = _backend()
+    now = time()
+
+    expired, alive = [], []
+    expired_size = alive_size = 0
+    for handle, key, size, meta, accessed in backend.scan():
+        if _is_expired(key, meta, now):
+            expired.append(handle)
+            expired_size += size
+        else:
+            alive.append((accessed, size, handle))
+            alive_size += size
+
+    evicted = []
+    if max_size is not None and alive_size > max_size:
+        alive.sort()
+        for accessed, size, handle in alive:
+            if alive_size <= max_size:
+                break
+            evicted.append(handle)
+            alive_size -= size
+
+    logger.info('%d items expired (%d bytes), %d items evicted, %d items left (%d bytes)',
+                len(expired), expired_size, len(evicted), len(alive) - len(evicted), alive_size)
+
+    if not dry_run:
+        backend.remove(expired)
+        backend.remove(evicted)
+        backend.compact()
+
+
+def _shorten(text, length):
+    return text if len(text) <= length else text[:length - 3] + '...'
+
+
+@main.command()
+def stats():
+    """ Shows how many items each namespace has and how much space they use
+    """
+    now = time()
+    items, sizes, expired = defaultdict(int), defaultdict(int), defaultdict(int)
+    for _, key, size, meta, _ in _backend().scan():
+        namespace = _namespace_of(key, meta) or '(unknown)'
+        items[namespace] += 1
+        sizes[namespace] += size
+        if _is_expired(key, meta, now):
+            expired[namespace] += 1
+
+    total_items, total_size = sum(items.itervalues()), sum(sizes.itervalues())
+    click.echo('%-60s %10s %10s %14s %6s' % ('namespace', 'items', 'expired', 'bytes', '%'))
+    for namespace in sorted(sizes, key=sizes.get, reverse=True):
+        click.echo('%-60s %10d %10d %14d %6.2f' % (
+            _shorten(namespace, 60), items[namespace], expired[namespace], sizes[namespace],
+            100.0 * sizes[namespace] / total_size
+        ))
+    click.echo('%-60s %10d %10d %14d' % ('total', total_items, sum(expired.itervalues()), total_size))
+
+
+@main.command(name='top-keys')
+@click.option('--limit', '-n', default=20, help='How many keys to show')
+@click.option('--namespace', help='Only show keys in namespaces with this prefix')
+def top_keys(limit, namespace):
+    """ Shows the largest items in the cache
+    """
+    def scan():
+        for _, key, size, meta, _ in _backend().scan():
+            item_namespace = _namespace_of(key, meta) or '(unknown)'
+            if not namespace or item_namespace.startswith(namespace):
+                yield size, item_namespace, key
+
+    click.echo('%12s  %-40s %s' % ('bytes', 'namespace', 'key'))
+    for size, item_namespace, key in heapq.nlargest(limit, scan()):
+        click.echo(u'%12d  %-40s %s' % (size, _shorten(item_namespace, 40), _shorten(key, 80)))
+
+
+@main.command()
+@click.argument('bundle', type=click.Path(dir_okay=False, writable=True))
+@click.option('--namespace', multiple=True, help='Only export the items in namespaces '
+                                                 'with this prefix, can be given multiple times')
+@click.option('--include-expired', is_flag=True, help='Export expired items as well')
+def export(bundle, namespace, include_expired):
+    """ Exports the cache to a portable gzipped JSON lines bundle, which can
+        be imported in another cache regardless of its backend
+    """
+    now = time()
+    count = 0
+    with gzip.open(bundle, 'wb') as f:
+        for key, raw, meta in _backend().items():
+            item_namespace = _namespace_of(key, meta) or ''
+            if namespace and not any(item_namespace.startswith(each) for each in namespace):
+                continue
+            elif not include_expired and _is_expired(key, meta, now):
+                continue
+
+            f.write(json.dumps({
+                'key': key,
+                'value': json.loads(_decompress(raw, meta).decode('utf8')),
+                'meta': {k: v for k, v in meta.iteritems() if k != 'codec'},
+            }) + '\n')
+            count += 1
+
+    logger.info("Exported %d items to '%s'", count, bundle)
+
+
+@main.command(name='import')
+@click.argument('bundle', type=click.Path(exists=True, dir_okay=False))
+@click.option('--overwrite/--no-overwrite', default=False,
+              help='Whether to replace the items already in the cache')
+def import_(bundle, overwrite):
+    """ Imports a bundle created by the export command
+    """
+    backend = _backend()
+    count = 0
+    with gzip.open(bundle, 'rb') as f:
+        for line in f:
+            item = json.loads(line)
+            _, raw, codec = _encode(item['value'])
+            meta = item['meta']
+            if codec:
+                meta['codec'] = codec
+            backend.set(item['key'], raw, overwrite, meta)
+            count += 1
+    backend.flush()
+
+    logger.info("Imported %d items from '%s'", count, bundle)
+
+
+@main.command()
+@click.option('--repair', is_flag=True, help='Remove the corrupt items')
+def verify(repair):
+    """ Checks that all the items in the cache can be read
+    """
+    backend = _backend()
+    count, corrupt = 0, []
+    for handle, key, _, _, _ in backend.scan():
+        count += 1
+        try:
+            stored = backend.get(key)
+            if stored is None:
+                raise ValueError('cannot find the item from its key')
+            raw, meta = stored
+            json.loads(_decompress(raw, meta).decode('utf8'))
+        except (ValueError, zlib.error) as ex:
+            logger.warn('corrupt item %s: %s', handle, ex)
+            corrupt.append(handle)
+
+    logger.info('Checked %d items, %d are corrupt', count, len(corrupt))
+    if repair:
+        backend.remove(corrupt)
+        backend.compact()
+        logger.info('Removed the corrupt items')
@@ -0,0 +1,229 @@
+# -*- encoding: utf-8 -*-
+from __future__ import absolute_import
+
+import json
+import logging
+import os
+
+import click
+
+from strephit.commons import io, parallel
+
+logger = logging.getLogger(__name__)
+
+
+def _unsupported_output(name):
+    """ Why the output with the given name cannot be checkpointed, `None` if it can """
+    if name == '-':
+        return 'cannot checkpoint the standard output'
+    elif io.compression_of(name):
+        return 'cannot checkpoint the compressed output %s' % name
+    return None
+
+
+def check_options(path, resume, *outputs):
+    """ Validates the checkpointing options of a command, so that it fails
+        before starting rather than with an exception midway
+
+        :param str path: Value of the `--checkpoint` option
+        :param bool resume: Value of the `--resume` option
+        :param outputs: pairs (option name, output) with the outputs of the
+         command which will be checkpointed
+        :raises click.UsageError: if the options cannot be used together
+    """
+    if resume and not path:
+        raise click.UsageError('--resume requires --checkpoint')
+    elif not path:
+        return
+
+    for option, outfile in outputs:
+        reason = _unsupported_output(outfile.name) if outfile is not None else None
+        if reason:
+            raise click.BadParameter(reason, param_hint=option)
+
+
+class Checkpoint(object):
+    """ Journal of the progress of a long-running stage, so that it can be resumed
+        after a crash instead of starting over.
+
+        Input items are identified by their position in the input, which must
+        therefore be the same across runs. After the results of an item have been
+        written to the outputs, the item is marked as done. Every once in a while
+        the outputs are flushed to disk and their size, together with the items
+        processed so far, is atomically saved in the journal. When resuming, the
+        outputs are truncated to the size they had at the last commit, so that
+        partially written results are discarded, and the items already processed
+        are skipped.
+
+        A checkpoint without a path does nothing, so that stages can use it
+        unconditionally.
+    """
+
+    def __init__(self, path=None, resume=False, every=1000):
+        """ Initializes the checkpoint, loading the journal if resuming
+
+            :param str path: Where to store the journal, `None` to disable checkpointing
+            :param bool resume: Whether to continue from the journal, if it exists, or
+             start from scratch
+            :param int every: Commit the progress every this many items
+        """
+        if resume and not path:
+            raise ValueError('cannot resume without a checkpoint file')
+
+        self.path = path
+        self.every = every
+        self.state = {}
+        self.outputs = []
+
+        self._low = 0           # all items before this one are done
+        self._done = set()      # items after `_low` which are done
+        self._offsets = {}
+        self._uncommitted = 0
+
+        if path and resume and os.path.exists(path):
+            with open(path) as f:
+                journal = json.load(f)
+            self._low = journal['low']
+            self._done = set(journal['done'])
+            self._offsets = journal['offsets']
+            self.state = journal['state']
+            logger.info('Resuming from checkpoint %s, %d items already processed',
+                        path, self.processed)
+        elif path and resume:
+            logger.warn('Checkpoint %s does not exist, starting from scratch', path)
+
+    @property
+    def processed(self):
+        """ How many input items have been processed so far """
+        return self._low + len(self._done)
+
+    def open(self, outfile):
+        """ Opens an output of the stage so that it can be checkpointed
+
+            :param outfile: The output, opened lazily by click (`lazy=True`),
+             since it must not be truncated before knowing whether to resume. Can
+             be `None` for optional outputs. Compressed outputs cannot be
+             truncated, hence they are not supported, see :func:`check_options`
+            :return: the output to write to
+        """
+        if not self.path or outfile is None:
+            return outfile
+
+        reason = _unsupported_output(outfile.name)
+        if reason:
+            raise ValueError(reason)
+
+        offset = self._offsets.get(outfile.name)
+        if offset is not None:
+            out = open(outfile.name, 'r+b')
+            out.truncate(offset)
+            out.seek(offset)
+        else:
+            out = open(outfile.name, 'wb')
+
+        self.outputs.append(out)
+        return out
+
+    def pending(self, iterable):
+        """ Enumerates the input items which still need to be processed
+
+            :param iterable: The input of the stage
+            :return: pairs (index, item)
+            :rtype: generator
+        """
+        for i, item in enumerate(iterable):
+            if i >= self._low and i not in self._done:
+                yield i, item
+
+    def map(self, function, iterable, flatten=False, **kwargs):
+        """ Processes the pending items with :func:`parallel.map`, keeping track
+            of the index of each item. Items which produce no result or raise an
+            exception are reported too, so that they can be marked as done.
+
+            When checkpointing is disabled the items are not enumerated, so that
+            a file or directory can be read directly by the workers with
+            :func:`parallel.map_lines`, and their index is `None`.
+
+            :param function: The function to apply to each item
+            :param iterable: The input of the stage
+            :param bool flatten: Collect the results of `function` in a list
+            :param kwargs: Other arguments passed to :func:`parallel.map`
+            :return: pairs (index, result)
+            :rtype: generator
+        """
+        def indexed((i, item)):
+            try:
+                result = function(item)
+                if flatten and result is not None:
+                    result = list(result)
+            except KeyboardInterrupt:
+                raise
+            except:
+                logger.exception('caught exception while processing item %s', i)
+                result = None
+            return i, result
+
+        if not self.path:
+            return parallel.map_lines(lambda item: indexed((None, item)), iterable, **kwargs)
+        return parallel.map(indexed, self.pending(iterable), **kwargs)
+
+    def done(self, index):
+        """ Marks an item as processed. Its results must have been written
+            to the outputs already.
+
+            :param int index: Index of the item, as given by :meth:`pending`
+        """
+        if not self.path:
+            return
+
+        self._done.add(index)
+        while self._low in self._done:
+            self._done.remove(self._low)
+            self._low += 1
+
+        self._uncommitted += 1
+        if self._uncommitted >= self.every:
+            self.commit()
+
+    def commit(self):
+        """ Flushes the outputs and atomically saves the progress in the journal
+        """
+        if not self.path:
+            return
+
+        for out in self.outputs:
+            out.flush()
+            os.fsync(out.fileno())
+
+        journal = {
+            'low': self._low,
+            'done': sorted(self._done),
+            'offsets': {out.name: out.tell() for out in self.outputs},
+            'state': self.state,
+        }
+
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(journal, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+
+        self._offsets = journal['offsets']
+        self._uncommitted = 0
+        logger.debug('Checkpoint committed, %d items processed', self.processed)
+
+    def close(self):
+        """ Commits the progress and closes the outputs
+        """
+        self.commit()
+        for out in self.outputs:
+            out.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # only finished items are marked as done, so the progress
+        # can be committed even when the stage was interrupted
+        self.close()
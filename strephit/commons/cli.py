@@ -1,6 +1,7 @@
 import click
 
-from strephit.commons import tokenize, pos_tag, entity_linking, split_sentences, download, serialize
+from strephit.commons import tokenize, pos_tag, entity_linking, split_sentences, download, serialize, \
+    benchmark, cache, index, nlp_daemon
 
 CLI_COMMANDS = {
     'tokenize': tokenize.main,
@@ -9,6 +10,10 @@ CLI_COMMANDS = {
     'split_sentences': split_sentences.main,
     'download': download.main,
     'serialize': serialize.main,
+    'benchmark': benchmark.main,
+    'cache': cache.main,
+    'index': index.main,
+    'nlp_daemon': nlp_daemon.main,
 }
 
 
@@ -5,6 +5,8 @@ import re
 import os
 import logging
 
+from strephit.commons import nlp_daemon
+
 logger = logging.getLogger(__name__)
 
 
@@ -24,18 +26,39 @@ class DateNormalizer(object):
     if the corresponding regular expression matches. the pattern transformation
     will have access to all the meta functions and meta variables defined and
     to a variable named 'match' containing the regex match found
+
+    the rules of the pre-set languages are compiled on first use, and are not
+    needed at all when the NLP daemon is available, see :mod:`strephit.commons.nlp_daemon`.
+    they are compiled anyway if the daemon fails
     """
 
     def __init__(self, language=None, specs=None):
         assert language or specs, 'please specify either one of the pre-set ' \
                                   'languages or provide a custom rule set'
-        if specs is None:
+        self.language = language
+        self.regexes = None
+        if specs is not None:
+            self._compile(specs)
+
+    def _use_daemon(self):
+        """ Whether to normalize with the NLP daemon rather than with the local rules """
+        return self.regexes is None and nlp_daemon.available()
+
+    def _load(self):
+        """ Compiles the rules of the language, if not done yet """
+        if self.regexes is None:
             path = os.path.join(os.path.dirname(__file__), 'resources',
-                                'normalization_rules_%s.yml' % language)
+                                'normalization_rules_%s.yml' % self.language)
 
             with open(path) as f:
-                specs = yaml.load(f)
+                self._compile(yaml.load(f))
+
+    def _compile(self, specs):
+        """ Compiles the regular expressions of the specification
 
+        :param dict specs: The specifications loaded from the file
+        :return: None
+        """
         self._meta_init(specs)
         basic_r = {name: pattern for name, pattern in self.meta_vars.iteritems()}
 
@@ -98,6 +121,16 @@ class DateNormalizer(object):
         >>> DateNormalizer('en').normalize_one('Today is the 1st of June, 2016')
         ((13, 30), 'Time', {'month': 6, 'day': 1, 'year': 2016})
         """
+        if self._use_daemon():
+            try:
+                span, category, result = nlp_daemon.call('normalize_one', self.language,
+                                                         expression, conflict)
+            except nlp_daemon.DaemonError as e:
+                logger.warn('the NLP daemon cannot normalize the expression, '
+                            'normalizing it locally: %s', e)
+            else:
+                return tuple(span), category, result
+        self._load()
 
         best_match = None
         expression = expression.lower()
@@ -136,6 +169,17 @@ class DateNormalizer(object):
          ((39, 55), 'Time', {'day': 18, 'month': 4, 'year': 2016})]
 
         """
+        if self._use_daemon():
+            try:
+                matches = nlp_daemon.call('normalize_many', self.language, expression)
+            except nlp_daemon.DaemonError as e:
+                logger.warn('the NLP daemon cannot normalize the expression, '
+                            'normalizing it locally: %s', e)
+            else:
+                for span, category, result in matches:
+                    yield tuple(span), category, result
+                return
+        self._load()
 
         # start matching from here, and move forward as new matches
         # are found so to avoid overlapping matches and return
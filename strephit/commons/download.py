@@ -5,7 +5,8 @@ import os
 import logging
 
 import click
-import requests
+
+from strephit.commons import http
 
 try:
     from cStringIO import StringIO
@@ -33,7 +34,7 @@ def stanford_corenlp(extract_to, zip_url):
     except OSError:
         pass
 
-    with contextlib.closing(requests.get(zip_url, stream=True)) as r:
+    with contextlib.closing(http.get(zip_url, stream=True)) as r:
         with zipfile.ZipFile(StringIO(r.content)) as arch:
             for finfo in arch.infolist():
                 fname = os.path.basename(finfo.filename)
@@ -3,13 +3,11 @@
 from __future__ import absolute_import
 
 import logging
-import json
 from sys import exit
 
 import click
-import requests
 
-from strephit.commons import secrets, cache, parallel
+from strephit.commons import io, http, secrets, cache, parallel
 
 logger = logging.getLogger(__name__)
 
@@ -47,7 +45,7 @@ def link(text, min_confidence, language):
             "Check if your 'strephit/commons/secret_keys.py' file "
             "contains 'NEX_TOKEN', or 'NEX_ID' and 'NEX_KEY'"
          )
-    r = requests.post(secrets.NEX_URL, data=nex_data)
+    r = http.post(secrets.NEX_URL, data=nex_data)
     r.raise_for_status()
     response = r.json()
     logger.debug("Response: %s " % response)
@@ -80,12 +78,14 @@ def extract_entities(response_json):
 
 
 @click.command()
-@click.argument('sentences', type=click.File('r'))
+@click.argument('sentences', type=io.CompressedFile('r'))
 @click.argument('language')
-@click.option('--processes', '-p', default=0)
-@click.option('--outfile', '-o', type=click.File('w'), default='output/entity_linked.jsonlines')
+@click.option('--processes', '-p', default=0, type=parallel.PROCESSES)
+@click.option('--outfile', '-o', type=io.CompressedFile('w'), default='output/entity_linked.jsonlines')
 @click.option('--confidence', '-c', default=0.25, help='Minimum confidence score, defaults to 0.25.')
-def main(sentences, language, outfile, confidence, processes):
+@click.option('--backend', type=click.Choice(['processes', 'threads']), default='threads',
+              help='Mostly waiting for web APIs, so threads are used by default')
+def main(sentences, language, outfile, confidence, processes, backend):
     """ Perform entity linking over a set of input sentences.
         The service is Dandelion Entity Extraction API:
         https://dandelion.eu/docs/api/datatxt/nex/v1/ .
@@ -94,14 +94,14 @@ def main(sentences, language, outfile, confidence, processes):
     """
 
     def worker(row):
-        sentence = json.loads(row)
+        sentence = io.json_loads(row)
         text = sentence.get('text')
         if text:
             sentence['linked_entities'] = link(text, confidence, language)
-            return json.dumps(sentence)
+            return io.json_dumps(sentence)
 
     count = 0
-    for each in parallel.map(worker, sentences, processes):
+    for each in parallel.map(worker, sentences, processes, transport='bytes', backend=backend):
         outfile.write(each)
         outfile.write('\n')
 
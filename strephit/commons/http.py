@@ -0,0 +1,171 @@
+# -*- encoding: utf-8 -*-
+from __future__ import absolute_import
+
+import logging
+import os
+import threading
+import time
+from email.utils import mktime_tz, parsedate_tz
+from urlparse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# How many connections to keep alive for each host, should be at least
+# as large as the number of threads performing requests concurrently
+POOL_SIZE = 32
+
+# How many times to retry failed requests, and how long to wait before
+# the n-th retry: BACKOFF_FACTOR * 2 ** n seconds, at most MAX_BACKOFF
+RETRIES = 5
+BACKOFF_FACTOR = 0.5
+MAX_BACKOFF = 120
+
+# Seconds to wait for the server to accept the connection or send some data
+TIMEOUT = 60
+
+# Responses with these statuses are retried. The request might have been processed
+# by the server before failing with the statuses in RETRY_IDEMPOTENT_STATUSES,
+# so those are retried only for idempotent methods
+RETRY_STATUSES = {429, 503}
+RETRY_IDEMPOTENT_STATUSES = {500, 502, 504}
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'}
+
+# Maximum number of requests per second to each host, per process
+RATE_LIMITS = {}
+
+# Value of the maxlag parameter sent to MediaWiki APIs, so that the requests are
+# rejected when the replication lag is too high and retried later, see
+# https://www.mediawiki.org/wiki/Manual:Maxlag_parameter
+MAXLAG = {
+    'www.wikidata.org': 5,
+}
+
+_local = {'pid': None, 'session': None, 'config': None}
+_lock = threading.Lock()
+_last_request = {}
+
+
+def session():
+    """ Returns the session of the current process, which keeps the connections
+        alive across requests. It is created again when the pool size changes
+        and in forked processes, since connections cannot be shared with the parent
+
+        :rtype: :class:`requests.Session`
+    """
+    with _lock:
+        if _local['pid'] != os.getpid() or _local['config'] != POOL_SIZE:
+            s = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            s.mount('http://', adapter)
+            s.mount('https://', adapter)
+            _local.update(pid=os.getpid(), session=s, config=POOL_SIZE)
+        return _local['session']
+
+
+def _wait_rate_limit(host):
+    """ Waits until a request to the host can be performed without exceeding its rate limit
+    """
+    rate = RATE_LIMITS.get(host)
+    if not rate:
+        return
+
+    with _lock:
+        now = time.time()
+        scheduled = max(now, _last_request.get(host, 0) + 1.0 / rate)
+        _last_request[host] = scheduled
+    if scheduled > now:
+        time.sleep(scheduled - now)
+
+
+def _retry_after(response):
+    """ Seconds to wait before retrying as requested by the server, or `None`
+    """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    elif value.isdigit():
+        return int(value)
+
+    date = parsedate_tz(value)
+    return max(mktime_tz(date) - time.time(), 0) if date else None
+
+
+def _should_retry(method, response):
+    if response.headers.get('MediaWiki-API-Error') == 'maxlag':
+        return True
+    elif response.status_code in RETRY_STATUSES:
+        return True
+    else:
+        return response.status_code in RETRY_IDEMPOTENT_STATUSES and method in IDEMPOTENT_METHODS
+
+
+def request(method, url, **kwargs):
+    """ Performs an HTTP request with the pooled session of the current process.
+        Requests are delayed to respect the rate limit of the host, see :data:`RATE_LIMITS`,
+        and retried with exponential backoff on connection errors and on the statuses
+        in :data:`RETRY_STATUSES`, honouring the `Retry-After` header. Requests to the
+        hosts in :data:`MAXLAG` are sent with the `maxlag` parameter and retried when
+        the server is lagged.
+
+        Requests whose body is a stream are not retried, since it cannot be read again.
+
+        :param str method: The HTTP method
+        :param str url: The URL to request
+        :param kwargs: Other arguments of :func:`requests.request`. The timeout
+         defaults to :data:`TIMEOUT`
+        :return: The last response. HTTP errors are not raised, use `raise_for_status`
+        :rtype: :class:`requests.Response`
+        :raises requests.HTTPError: If the server is still lagged after all the retries,
+         since the response does not contain any data
+    """
+    method = method.upper()
+    host = urlparse(url).netloc
+    kwargs.setdefault('timeout', TIMEOUT)
+    if host in MAXLAG:
+        kwargs['params'] = dict(kwargs.get('params') or {}, maxlag=MAXLAG[host])
+    retries = 0 if hasattr(kwargs.get('data'), 'read') else RETRIES
+
+    for attempt in xrange(retries + 1):
+        _wait_rate_limit(host)
+        delay = min(BACKOFF_FACTOR * 2 ** attempt, MAX_BACKOFF)
+        try:
+            response = session().request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == retries:
+                raise
+            logger.debug('%s %s failed with %s, retrying in %.1f seconds',
+                         method, url, e, delay)
+        else:
+            if not _should_retry(method, response):
+                return response
+            elif attempt == retries:
+                if response.headers.get('MediaWiki-API-Error') == 'maxlag':
+                    raise requests.HTTPError('%s is lagged, gave up after %d retries'
+                                             % (host, retries), response=response)
+                return response
+
+            retry_after = _retry_after(response)
+            if retry_after is not None:
+                delay = min(retry_after, MAX_BACKOFF)
+            logger.debug('%s %s returned %d, retrying in %.1f seconds',
+                         method, url, response.status_code, delay)
+            response.close()
+        time.sleep(delay)
+
+
+def get(url, **kwargs):
+    """ Performs a GET request, see :func:`request` """
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    """ Performs a POST request, see :func:`request` """
+    return request('POST', url, **kwargs)
+
+
+def put(url, **kwargs):
+    """ Performs a PUT request, see :func:`request` """
+    return request('PUT', url, **kwargs)
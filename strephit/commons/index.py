@@ -0,0 +1,44 @@
+# -*- encoding: utf-8 -*-
+from __future__ import absolute_import
+
+import logging
+
+import click
+
+from strephit.commons import io
+
+logger = logging.getLogger(__name__)
+
+
+@click.group()
+def main():
+    """ Random access to the items of jsonlines corpora by their id
+    """
+    pass
+
+
+@main.command()
+@click.argument('location', type=click.Path(exists=True))
+@click.option('--id-key', default='id', help='Key of the items holding their id')
+def build(location, id_key):
+    """ Indexes a jsonlines file or all the jsonlines files in a directory
+    """
+    count = io.index_corpus(location, id_key)
+    logger.info('Done, indexed %d items', count)
+
+
+@main.command()
+@click.argument('location', type=click.Path(exists=True))
+@click.argument('ids', nargs=-1, required=True)
+@click.option('--id-key', default='id', help='Key of the items holding their id')
+@click.option('--outfile', '-o', type=io.CompressedFile('w'), default='-')
+def get(location, ids, id_key, outfile):
+    """ Retrieves the items with the given ids, indexing the corpus if needed
+    """
+    found = 0
+    for item in io.load_by_ids(location, ids, id_key):
+        outfile.write(io.json_dumps(item) + '\n')
+        found += 1
+
+    if found < len(ids):
+        logger.warn('%d items not found', len(ids) - found)
@@ -1,59 +1,571 @@
 #!/usr/bin/env python
 # -*- encoding: utf-8 -*-
 from __future__ import absolute_import
+import bisect
+import bz2
+import gzip
+import hashlib
+import itertools
 import json
+import mmap
 import os
 import logging
+import multiprocessing as mp
+import struct
+import sys
 import tarfile
+import tempfile
+import threading
+from collections import OrderedDict, deque
+from Queue import Queue, Empty
 
-import requests
+import click
 
-from strephit.commons import cache
+from strephit.commons import cache, http
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    from backports import lzma
+except ImportError:
+    lzma = None
 
 logger = logging.getLogger(__name__)
 
 
-def load_scraped_items(location):
-    """ Loads all the items from a directory or file.
+def _ujson_loads(s):
+    try:
+        return ujson.loads(s, precise_float=True)
+    except (ValueError, OverflowError):
+        # ujson does not handle some valid documents, e.g. with huge
+        # integers, let the standard library decide
+        return json.loads(s)
 
-    :param location: Where is the corpus.
 
-        * If it is a directory, all files with extension jsonlines will be loaded.
-        * if it is a file, it can be either a jsonlines of a tar compressed file.
+# Functions used to decode JSON documents. Documents are always encoded with the
+# standard library, which is already backed by C code and whose output would be
+# slightly different with other libraries
+JSON_DECODERS = {
+    'json': json.loads,
+    'ujson': _ujson_loads,
+}
+
+_json_decoder = _ujson_loads if ujson is not None else json.loads
+
+
+def set_json_codec(name):
+    """ Chooses the library used to decode JSON documents
+
+        :param name: One of :data:`JSON_DECODERS` or `auto` to use
+         the fastest one which is installed
+    """
+    global _json_decoder
+    if name == 'auto':
+        name = 'ujson' if ujson is not None else 'json'
+    elif name == 'ujson' and ujson is None:
+        raise ValueError('ujson is not installed')
+    _json_decoder = JSON_DECODERS[name]
+
+
+def json_loads(s):
+    """ Decodes a JSON document, see :func:`set_json_codec`
+    """
+    return _json_decoder(s)
+
+
+def json_dumps(obj):
+    """ Encodes an object to JSON, exactly as :func:`json.dumps` does
+    """
+    return json.dumps(obj)
+
+
+def _open_xz(path, mode, level):
+    if lzma is None:
+        raise ValueError('cannot open %s, install backports.lzma to handle xz files' % path)
+    elif 'r' in mode:
+        return lzma.LZMAFile(path, mode)
+    else:
+        return lzma.LZMAFile(path, mode, preset=level)
+
+
+# Supported compression formats: extension -> (magic bytes, opener)
+COMPRESSIONS = {
+    '.gz': ('\x1f\x8b', lambda path, mode, level: gzip.GzipFile(path, mode, level)),
+    '.bz2': ('BZh', lambda path, mode, level: bz2.BZ2File(path, mode, compresslevel=level)),
+    '.xz': ('\xfd7zXZ\x00', _open_xz),
+}
+
+# Default compression level of compressed outputs
+COMPRESSION_LEVEL = 6
+
+
+def compression_of(path):
+    """ Finds the compression format of a file from its extension
+
+        :return: the extension of the format or `None` for uncompressed files
+    """
+    extension = os.path.splitext(path)[1].lower()
+    return extension if extension in COMPRESSIONS else None
+
+
+def sniff_compression(path):
+    """ Finds the compression format of an existing file from its first bytes
+
+        :return: the extension of the format or `None` for uncompressed files
+    """
+    with open(path, 'rb') as f:
+        head = f.read(8)
+    for extension, (magic, _) in COMPRESSIONS.iteritems():
+        if head.startswith(magic):
+            return extension
+    return None
+
+
+class _BackgroundReader(object):
+    """ Reads lines from a compressed file, decompressing it in a background
+        thread so that decompression overlaps with the processing of the lines
+    """
+    CHUNK_SIZE = 1 << 16
+
+    def __init__(self, fileobj, name, queue_size=16):
+        self.name = name
+        self.closed = False
+        self._file = fileobj
+        self._queue = Queue(queue_size)
+        self._thread = threading.Thread(target=self._decompress)
+        self._thread.daemon = True
+        self._thread.start()
+        self._lines = self._read_lines()
+
+    def _decompress(self):
+        try:
+            while not self.closed:
+                chunk = self._file.read(self.CHUNK_SIZE)
+                self._queue.put(chunk)
+                if not chunk:
+                    break
+        except Exception:
+            self._queue.put(sys.exc_info())
+
+    def _read_lines(self):
+        pending = ''
+        while True:
+            chunk = self._queue.get()
+            if isinstance(chunk, tuple):
+                raise chunk[0], chunk[1], chunk[2]
+            elif not chunk:
+                break
+
+            lines = (pending + chunk).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line + '\n'
+
+        if pending:
+            yield pending
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return next(self._lines)
+
+    def readline(self):
+        return next(self._lines, '')
+
+    def read(self):
+        return ''.join(self._lines)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        # unblock the background thread, if it is waiting for room in the queue
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except Empty:
+                pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class _BackgroundWriter(object):
+    """ Writes to a compressed file, compressing the data in a background thread
+        so that compression overlaps with the production of the data. Small writes
+        are buffered and handed to the thread in chunks.
+    """
+    CHUNK_SIZE = 1 << 16
+
+    def __init__(self, fileobj, name, queue_size=16):
+        self.name = name
+        self.closed = False
+        self._file = fileobj
+        self._buffer = []
+        self._buffered = 0
+        self._error = None
+        self._queue = Queue(queue_size)
+        self._thread = threading.Thread(target=self._compress)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _compress(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                break
+            elif self._error is None:
+                try:
+                    self._file.write(chunk)
+                except Exception:
+                    # keep consuming the queue so that writers do not block
+                    self._error = sys.exc_info()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        self._raise_error()
+
+        if isinstance(data, unicode):
+            data = data.encode('utf8')
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.CHUNK_SIZE:
+            self.flush()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        """ Hands the buffered data to the background thread """
+        if self._buffer:
+            self._queue.put(''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        self.closed = True
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def open_file(path, mode='r', level=None):
+    """ Opens a file, transparently decompressing it when reading or
+        compressing it when writing. The compression format of inputs is
+        detected from their content, the one of outputs from their extension,
+        see :data:`COMPRESSIONS`. Compressed files are processed in a background
+        thread and can only be iterated line by line or read as a whole.
+
+        :param str path: Path of the file
+        :param str mode: Mode to open the file with, appending to
+         compressed files is not supported
+        :param int level: Compression level of outputs, defaults to :data:`COMPRESSION_LEVEL`
+        :return: the opened file
     """
-    def list_files():
-        if os.path.isfile(location):
-            if tarfile.is_tarfile(location):
-                tar = tarfile.open(location)
-                for file in tar:
-                    yield file.name, tar.extractfile(file)
+    if 'r' in mode:
+        compression = sniff_compression(path)
+    else:
+        compression = compression_of(path)
+
+    if compression is None:
+        return open(path, mode)
+    elif 'a' in mode or '+' in mode:
+        raise ValueError('cannot append to compressed file %s' % path)
+
+    opener = COMPRESSIONS[compression][1]
+    level = level if level is not None else COMPRESSION_LEVEL
+    if 'r' in mode:
+        return _BackgroundReader(opener(path, 'rb', level), path)
+    else:
+        return _BackgroundWriter(opener(path, 'wb', level), path)
+
+
+class _LazyFile(object):
+    """ Opens a file the first time it is used """
+
+    def __init__(self, name, open_file):
+        self.name = name
+        self._open_file = open_file
+        self._file = None
+
+    def __getattr__(self, name):
+        if self._file is None:
+            self._file = self._open_file()
+        return getattr(self._file, name)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+class CompressedFile(click.File):
+    """ Like :class:`click.File`, but transparently handles compressed files
+        with :func:`open_file`. Compressed outputs are closed together with the
+        click context, so that the background thread finishes writing them.
+    """
+    def __init__(self, mode='r', level=None, **kwargs):
+        super(CompressedFile, self).__init__(mode, **kwargs)
+        self.level = level
+
+    def convert(self, value, param, ctx):
+        if value == '-' or hasattr(value, 'read') or hasattr(value, 'write'):
+            return super(CompressedFile, self).convert(value, param, ctx)
+
+        if 'r' in self.mode:
+            compressed = os.path.isfile(value) and sniff_compression(value)
+        else:
+            compressed = compression_of(value)
+        if not compressed:
+            return super(CompressedFile, self).convert(value, param, ctx)
+
+        try:
+            if 'a' in self.mode:
+                raise ValueError('cannot append to a compressed file')
+            elif 'r' in self.mode or self.lazy is False:
+                f = open_file(value, self.mode, self.level)
             else:
-                yield location, location
+                # like click, open outputs lazily by default
+                f = _LazyFile(value, lambda: open_file(value, self.mode, self.level))
+        except (IOError, OSError, ValueError) as e:
+            self.fail('Could not open file: %s: %s' % (click.format_filename(value), e),
+                      param, ctx)
+
+        if ctx is not None:
+            ctx.call_on_close(f.close)
+        return f
+
+
+def is_jsonlines(name):
+    """ Whether the file is a (possibly compressed) jsonlines file """
+    compression = compression_of(name)
+    if compression:
+        name = name[:-len(compression)]
+    return name.endswith('.jsonl') or name.endswith('.jsonlines')
+
+
+def _scraped_files(location):
+    """ Lists the files with the items of a corpus, see :func:`load_scraped_items`
+
+        :return: pairs (name, function opening the file). Files in a tar archive
+         must be opened before moving to the next one, since the archive is streamed
+        :rtype: generator
+    """
+    if os.path.isfile(location):
+        if tarfile.is_tarfile(location):
+            tar = tarfile.open(location, 'r|*')
+            try:
+                for member in tar:
+                    if member.isfile():
+                        yield member.name, lambda member=member: tar.extractfile(member)
+            finally:
+                tar.close()
         else:
-            for name in os.listdir(location):
-                if name.endswith('.jsonl') or name.endswith('.jsonlines'):
-                    yield name, os.path.join(location, name)
-
-    def process_stream(name, stream):
-        logger.info("Loaded input file '%s'" % name)
-        for n, line in enumerate(stream):
-            logger.debug("Processing item #%d ..." % n)
+            yield location, lambda: open_file(location)
+    else:
+        for name in sorted(os.listdir(location)):
+            if is_jsonlines(name):
+                path = os.path.join(location, name)
+                yield name, lambda path=path: open_file(path)
+
+
+def _decode_items(name, lines, start=0):
+    """ Decodes the items in the given lines of a file, `start` being the row of the first one """
+    for n, line in enumerate(lines, start):
+        logger.debug("Processing item #%d ..." % n)
+        try:
+            yield json_loads(line)
+        except ValueError:
+            logger.warn('cannot load item at row %d of file %s' % (n, name))
+
+
+def _read_items(name, stream):
+    """ Decodes the items in a file, one per line, and closes it """
+    logger.info("Loaded input file '%s'" % name)
+    try:
+        for item in _decode_items(name, stream):
+            yield item
+    finally:
+        stream.close()
+
+
+def _read_files_worker(location, worker, workers, queue, batch_size):
+    """ Reads the files of the corpus assigned to this worker, i.e. one every
+        `workers`, and sends their items in batches (file index, items) through
+        the queue, followed by (`None`, worker) when done
+    """
+    try:
+        for i, (name, open_stream) in enumerate(_scraped_files(location)):
+            if i % workers != worker:
+                continue
+
             try:
-                yield json.loads(line)
-            except ValueError:
-                logger.warn('cannot load item at row %d of file %s' % (n, name))
+                batch = []
+                for item in _read_items(name, open_stream()):
+                    batch.append(item)
+                    if len(batch) >= batch_size:
+                        queue.put((i, batch))
+                        batch = []
+                if batch:
+                    queue.put((i, batch))
+            except Exception:
+                logger.exception('cannot read file %s', name)
+    finally:
+        queue.put((None, worker))
 
-    for name, file in list_files():
-        if hasattr(file, 'read'):
+
+def _read_tar_worker(location, queues, batch_size):
+    """ Streams the files of a tar archive, so that it is decompressed only once, and
+        sends their lines in batches (file index, name, row of the first line, lines)
+        to the decoding workers, each file to the queue `index % len(queues)`, followed
+        by `None` to each queue when done
+    """
+    try:
+        for i, (name, open_stream) in enumerate(_scraped_files(location)):
+            logger.info("Loaded input file '%s'" % name)
+            queue, stream, row = queues[i % len(queues)], open_stream(), 0
             try:
-                for each in process_stream(name, file):
-                    yield each
+                while True:
+                    lines = list(itertools.islice(stream, batch_size))
+                    if not lines:
+                        break
+                    queue.put((i, name, row, lines))
+                    row += len(lines)
+            except Exception:
+                logger.exception('cannot read file %s', name)
             finally:
-                file.close()
-        else:
-            with open(file) as f:
-                for each in process_stream(name, f):
-                    yield each
+                stream.close()
+    finally:
+        for queue in queues:
+            queue.put(None)
+
+
+def _decode_lines_worker(worker, lines_queue, queue):
+    """ Decodes the batches of lines sent by :func:`_read_tar_worker` and sends
+        the items (file index, items) through the queue, followed by (`None`, worker)
+    """
+    try:
+        for i, name, row, lines in iter(lines_queue.get, None):
+            queue.put((i, list(_decode_items(name, lines, row))))
+    finally:
+        queue.put((None, worker))
+
+
+def _load_parallel(location, processes, interleave, batch_size=500, read_ahead=20):
+    """ Loads the items of a corpus reading its files in parallel, see :func:`load_scraped_items`
+    """
+    queue = mp.Queue(2 * processes)
+    if os.path.isfile(location) and tarfile.is_tarfile(location):
+        # the members of an archive can only be reached by decompressing all the
+        # preceding ones, so a single process reads it and the others decode the items
+        lines_queues = [mp.Queue(2) for _ in xrange(processes)]
+        workers = [mp.Process(target=_read_tar_worker, args=(location, lines_queues, batch_size))]
+        workers.extend(mp.Process(target=_decode_lines_worker, args=(i, lines_queues[i], queue))
+                       for i in xrange(processes))
+    else:
+        workers = [mp.Process(target=_read_files_worker,
+                              args=(location, i, processes, queue, batch_size))
+                   for i in xrange(processes)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+
+    running = set(xrange(processes))
+    buffers = OrderedDict()     # file index -> items waiting to be emitted
+    buffered = 0
+    limit = read_ahead * batch_size
+    try:
+        while running or buffers:
+            # when interleaving, wait until every worker sent some items,
+            # unless too many items are waiting already
+            waiting = running.difference(source % processes for source in buffers)
+            message = None
+            if running and (not buffers or waiting and buffered < limit):
+                message = queue.get()
+            elif running and buffered < limit:
+                try:
+                    message = queue.get_nowait()
+                except Empty:
+                    pass
+
+            if message is not None:
+                source, items = message
+                if source is None:
+                    running.discard(items)
+                elif not interleave:
+                    for item in items:
+                        yield item
+                else:
+                    buffers.setdefault(source, deque()).extend(items)
+                    buffered += len(items)
+                continue
+
+            # one item from each file being read, in turn
+            for source in buffers.keys():
+                yield buffers[source].popleft()
+                buffered -= 1
+                if not buffers[source]:
+                    del buffers[source]
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+
+def load_scraped_items(location, processes=1, interleave=False):
+    """ Loads all the items from a directory or file.
+
+    :param location: Where is the corpus.
+
+        * If it is a directory, all files with extension jsonlines will be loaded.
+        * if it is a file, it can be either a jsonlines of a tar compressed file.
+
+        jsonlines files can be compressed, see :func:`open_file`
+    :param int processes: How many files of a directory or tar archive to read
+     concurrently, each in its own process which decompresses and decodes it.
+     Use zero or a negative number to use all the available processors. Note that
+     files in a compressed archive cannot be accessed directly, so an additional
+     process decompresses the whole archive once and sends the lines of its files
+     to the others, which only decode them.
+    :param bool interleave: Only when `processes` is not 1, emit the items of the
+     files being read in turn, one from each, rather than in batches as they are
+     read, so that the items at the beginning do not come from a single source
+    """
+    if processes <= 0:
+        processes = mp.cpu_count()
+
+    if processes > 1:
+        items = _load_parallel(location, processes, interleave)
+    else:
+        items = (item for name, open_stream in _scraped_files(location)
+                 for item in _read_items(name, open_stream()))
+
+    for each in items:
+        yield each
 
     logger.debug('all items loaded')
 
@@ -89,7 +601,7 @@ def load_corpus(location, document_key, text_only=False):
 def load_dumped_corpus(dump_file_handle, document_key, text_only=False):
     """ Load a previously dumped corpus file, in a memory-efficient way. """
     for line in dump_file_handle:
-        item = json.loads(line)
+        item = json_loads(line)
         # The document key should always exist here, so raise KeyError if not
         document = _join_text(item[document_key])
         if text_only:
@@ -103,10 +615,178 @@ def dump_corpus(corpus, dump_file_handle):
     """ Dump a loaded corpus to a file with one JSON object per line ."""
     logger.info("Will dump corpus to '%s' ... Format: JSON objects with metadata, one per line" % dump_file_handle.name)
     for item in corpus:
-        dump_file_handle.write(json.dumps(item) + '\n')
+        dump_file_handle.write(json_dumps(item) + '\n')
     return 0
 
 
+# The index of a jsonlines file is stored next to it, in a file with this extension.
+# It starts with a header (magic, size of the indexed file, number of items) followed by
+# one record (hash of the id, offset, length) per item, sorted by hash
+INDEX_EXTENSION = '.idx'
+_INDEX_MAGIC = 'SIX1'
+_INDEX_HEADER = struct.Struct('<4sQQ')
+_INDEX_RECORD = struct.Struct('<8sQI')
+
+
+def _id_hash(item_id):
+    return hashlib.sha1(unicode(item_id).encode('utf8')).digest()[:8]
+
+
+def _mmap_or_read(f, size):
+    """ Maps a file in memory, or reads it whole when it cannot be mapped """
+    try:
+        return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    except (ValueError, EnvironmentError):
+        return f.read(size)
+
+
+class _IndexHashes(object):
+    """ Sequence of the hashes of an index, to be searched with :mod:`bisect` """
+
+    def __init__(self, data, count):
+        self.data = data
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        start = _INDEX_HEADER.size + i * _INDEX_RECORD.size
+        return self.data[start:start + 8]
+
+    def record(self, i):
+        return _INDEX_RECORD.unpack_from(self.data, _INDEX_HEADER.size + i * _INDEX_RECORD.size)
+
+
+def build_index(path, id_key='id'):
+    """ Indexes the items of a jsonlines file by their id, so that they can be
+        loaded with :func:`load_by_ids` without scanning the whole file.
+        Compressed files cannot be indexed.
+
+        :param str path: The jsonlines file to index
+        :param str id_key: Key of the items holding their id
+        :return: The number of items indexed
+        :rtype: int
+    """
+    if sniff_compression(path):
+        raise ValueError('cannot index the compressed file %s' % path)
+
+    records = []
+    offset = 0
+    with open(path, 'rb') as f:
+        for n, line in enumerate(f):
+            try:
+                item_id = json_loads(line)[id_key]
+            except (ValueError, KeyError, TypeError):
+                logger.debug('no id for item at row %d of file %s', n, path)
+            else:
+                records.append((_id_hash(item_id), offset, len(line)))
+            offset += len(line)
+    records.sort()
+
+    # write the index atomically, so that readers never see a partial one
+    fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(fd, 'wb') as out:
+        out.write(_INDEX_HEADER.pack(_INDEX_MAGIC, offset, len(records)))
+        for record in records:
+            out.write(_INDEX_RECORD.pack(*record))
+    os.chmod(tmp, os.stat(path).st_mode & 0o666)
+    os.rename(tmp, path + INDEX_EXTENSION)
+
+    logger.info('Indexed %d items of %s', len(records), path)
+    return len(records)
+
+
+def _indexable_files(location):
+    """ Lists the uncompressed jsonlines files in the given location """
+    if os.path.isfile(location):
+        return [location]
+
+    paths = []
+    for name in sorted(os.listdir(location)):
+        if not is_jsonlines(name):
+            continue
+        elif compression_of(name):
+            logger.warn('cannot index the compressed file %s, skipping it', name)
+        else:
+            paths.append(os.path.join(location, name))
+    return paths
+
+
+def index_corpus(location, id_key='id'):
+    """ Indexes a jsonlines file or all the uncompressed jsonlines files in a
+        directory with :func:`build_index`
+
+        :return: The number of items indexed
+        :rtype: int
+    """
+    return sum(build_index(path, id_key) for path in _indexable_files(location))
+
+
+def _open_index(path, id_key):
+    """ Opens the index of a file, (re)building it when missing or outdated
+
+        :return: a :class:`_IndexHashes`
+    """
+    index_path = path + INDEX_EXTENSION
+    for attempt in xrange(2):
+        if os.path.exists(index_path):
+            with open(index_path, 'rb') as f:
+                data = _mmap_or_read(f, os.path.getsize(index_path))
+            try:
+                magic, size, count = _INDEX_HEADER.unpack_from(data)
+            except struct.error:
+                magic = size = count = None
+            if magic == _INDEX_MAGIC and size == os.path.getsize(path):
+                return _IndexHashes(data, count)
+            logger.info('The index of %s is outdated, rebuilding it', path)
+        else:
+            logger.info('%s is not indexed, indexing it', path)
+        build_index(path, id_key)
+    raise ValueError('cannot index %s' % path)
+
+
+def load_by_ids(location, ids, id_key='id'):
+    """ Loads the items with the given ids from a jsonlines file or a directory
+        of them, seeking directly to each item with the index built by
+        :func:`build_index`. Files which are not indexed are indexed on the fly.
+
+        :param location: A jsonlines file or a directory of them
+        :param ids: The ids of the items to load
+        :param str id_key: Key of the items holding their id
+        :return: The items found, in the same order as `ids`
+        :rtype: generator
+    """
+    wanted = [(item_id, _id_hash(item_id)) for item_id in ids]
+    found = {}
+
+    for path in _indexable_files(location):
+        missing = [(item_id, key) for item_id, key in wanted if unicode(item_id) not in found]
+        if not missing:
+            break
+
+        index = _open_index(path, id_key)
+        with open(path, 'rb') as f:
+            data = _mmap_or_read(f, os.path.getsize(path))
+            for item_id, key in missing:
+                # different ids may have the same hash, check all the candidates
+                i = bisect.bisect_left(index, key)
+                while i < len(index) and index[i] == key:
+                    _, offset, length = index.record(i)
+                    item = json_loads(data[offset:offset + length])
+                    if unicode(item.get(id_key)) == unicode(item_id):
+                        found[unicode(item_id)] = item
+                        break
+                    i += 1
+
+    for item_id, _ in wanted:
+        item = found.get(unicode(item_id))
+        if item is not None:
+            yield item
+        else:
+            logger.debug('item %s not found in %s', item_id, location)
+
+
 def get_and_cache(url, use_cache=True, **kwargs):
     """
     Perform an HTTP GET request to the given url and optionally cache the
@@ -116,11 +796,11 @@ def get_and_cache(url, use_cache=True, **kwargs):
 
     :param url: URL of the page to retrieve
     :param use_cache: Whether to use cache
-    :param \*\*kwargs: keyword arguments to pass to `requests.get`
+    :param \*\*kwargs: keyword arguments to pass to :func:`http.get`
     :return: The content page at the given URL, unicode
     """
     if not use_cache:
-        r = requests.get(url, **kwargs)
+        r = http.get(url, **kwargs)
         r.raise_for_status()
         content = r.text
     else:
@@ -128,5 +808,5 @@ def get_and_cache(url, use_cache=True, **kwargs):
         content = cache.get(key)
         if content is None:
             content = get_and_cache(url, use_cache=False, **kwargs)
-            cache.set(key, content)
+            cache.set(key, content, namespace=__name__ + '.get_and_cache')
     return content
@@ -0,0 +1,365 @@
+# -*- encoding: utf-8 -*-
+from __future__ import absolute_import
+
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import tempfile
+import threading
+from contextlib import contextmanager
+from Queue import Queue, Empty
+from SocketServer import StreamRequestHandler, ThreadingMixIn, UnixStreamServer
+
+import click
+
+logger = logging.getLogger(__name__)
+
+# Unix socket of the daemon used by the POS tagger, the sentence splitter and
+# the date normalizer instead of loading their resources in every process.
+# `None` to always load them locally
+SOCKET = os.environ.get('STREPHIT_NLP_DAEMON') or None
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), 'strephit-nlp.sock')
+
+# Seconds to wait for the reply to a request
+TIMEOUT = 600
+
+# How many TreeTagger processes the daemon runs at most for each language and
+# options, so that concurrent clients are tagged in parallel. By default one per
+# CPU, like the pool of :meth:`TTPosTagger.tag_many`
+TAGGERS = multiprocessing.cpu_count()
+
+
+class DaemonError(Exception):
+    """ Raised when the daemon fails to process a request or cannot be reached """
+    pass
+
+
+_local = threading.local()
+_unreachable = set()
+
+
+def _connection():
+    """ Returns the connection to the daemon of the current thread, opening it if needed
+
+        :return: tuple (socket, file to read the replies from)
+    """
+    config = os.getpid(), SOCKET
+    if getattr(_local, 'config', None) != config:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(TIMEOUT)
+        sock.connect(SOCKET)
+        _local.config, _local.connection = config, (sock, sock.makefile('rb'))
+    return _local.connection
+
+
+def _disconnect():
+    if getattr(_local, 'config', None) is not None:
+        sock, reader = _local.connection
+        reader.close()
+        sock.close()
+        _local.config = _local.connection = None
+
+
+def available():
+    """ Whether the daemon is configured and reachable. When it cannot be reached
+        a warning is logged and the resources are loaded locally by this process
+
+        :rtype: bool
+    """
+    if not SOCKET or (os.getpid(), SOCKET) in _unreachable:
+        return False
+    elif getattr(_local, 'serving', False):
+        return False  # the daemon itself uses the local resources
+
+    try:
+        _connection()
+    except socket.error as e:
+        logger.warn('cannot connect to the NLP daemon at %s, loading the resources '
+                    'locally: %s', SOCKET, e)
+        _unreachable.add((os.getpid(), SOCKET))
+        return False
+    return True
+
+
+def _lost(reason):
+    """ Forgets the connection to the daemon, which is not used anymore by this process """
+    _disconnect()
+    _unreachable.add((os.getpid(), SOCKET))
+    logger.warn('lost the connection to the NLP daemon at %s, loading the resources '
+                'locally: %s', SOCKET, reason)
+    return DaemonError('lost the connection to the daemon: %s' % reason)
+
+
+def call(method, *args, **kwargs):
+    """ Asks the daemon to perform a method, see :data:`METHODS`. When the daemon
+        cannot be reached anymore it is not used by this process from then on,
+        i.e. :func:`available` is false, so that callers can fall back to the
+        local resources
+
+        :param str method: Name of the method
+        :param args: Positional arguments of the method, must be JSON-serializable
+        :param kwargs: Keyword arguments of the method, must be JSON-serializable
+        :return: The result of the method, decoded from JSON
+        :raises DaemonError: If the method raised an exception or the daemon
+         cannot be reached
+    """
+    try:
+        sock, reader = _connection()
+        sock.sendall(json.dumps({'method': method, 'args': args, 'kwargs': kwargs}) + '\n')
+        line = reader.readline()
+    except socket.error as e:
+        raise _lost(e)
+
+    if not line:
+        raise _lost('the daemon closed the connection')
+
+    reply = json.loads(line)
+    if 'error' in reply:
+        raise DaemonError(reply['error'])
+    return reply['result']
+
+
+METHODS = {}
+
+
+def method(function):
+    """ Decorator registering a function which the daemon performs on request """
+    METHODS[function.__name__] = function
+    return function
+
+
+_resources = {}
+_resources_lock = threading.Lock()
+
+
+def _resource(factory, *args):
+    """ Returns the instance of the resource created with the given arguments,
+        creating it on first use
+
+        :param factory: Class of the resource
+        :param args: Arguments of the class, must be JSON-serializable
+    """
+    key = factory.__name__, json.dumps(args, sort_keys=True)
+    with _resources_lock:
+        if key not in _resources:
+            logger.info('Loading %s%s', factory.__name__, repr(args))
+            _resources[key] = factory(*args)
+        return _resources[key]
+
+
+class _Pool(object):
+    """ Instances of a resource which are used by one request at a time,
+        created on demand up to a maximum
+    """
+
+    def __init__(self, factory, args, size):
+        self.factory = factory
+        self.args = args
+        self.size = size
+        self.created = 0
+        self.free = Queue()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Returns a free instance, creating it if all are busy and the pool is not full,
+            otherwise waiting for one to be released
+        """
+        try:
+            return self.free.get_nowait()
+        except Empty:
+            pass
+
+        with self.lock:
+            create = self.created < self.size
+            if create:
+                self.created += 1
+        if not create:
+            return self.free.get()
+
+        logger.info('Loading %s%s, instance %d', self.factory.__name__, repr(self.args), self.created)
+        try:
+            return self.factory(*self.args)
+        except Exception:
+            with self.lock:
+                self.created -= 1
+            raise
+
+    def release(self, instance):
+        self.free.put(instance)
+
+
+_pools = {}
+
+
+@contextmanager
+def _pooled(factory, size, *args):
+    """ Lends an instance of the resource created with the given arguments
+        for the exclusive use of the caller, see :class:`_Pool`
+
+        :param factory: Class of the resource
+        :param int size: How many instances to create at most
+        :param args: Arguments of the class, must be JSON-serializable
+    """
+    key = factory.__name__, json.dumps(args, sort_keys=True)
+    with _resources_lock:
+        if key not in _pools:
+            _pools[key] = _Pool(factory, args, size)
+        pool = _pools[key]
+
+    instance = pool.acquire()
+    try:
+        yield instance
+    finally:
+        pool.release(instance)
+
+
+def _tagger(language, tt_home, options):
+    from strephit.commons.pos_tag import TTPosTagger
+    return TTPosTagger(language, tt_home, use_store=False, **options)
+
+
+def _splitter(language):
+    from strephit.commons.split_sentences import PunktSentenceSplitter
+    return PunktSentenceSplitter(language)
+
+
+def _normalizer(language):
+    from strephit.commons.date_normalizer import DateNormalizer
+    return DateNormalizer(language)
+
+
+@method
+def ping():
+    return 'pong'
+
+
+@method
+def tag_text(language, tt_home, options, text, **kwargs):
+    """ Tags the text with TreeTagger, see :meth:`treetaggerwrapper.TreeTagger.tag_text`.
+        Each of the :data:`TAGGERS` processes tags one text at a time
+    """
+    with _pooled(_tagger, TAGGERS, language, tt_home, options) as tagger:
+        return tagger.tagger.tag_text(text, **kwargs)
+
+
+@method
+def split(language, text):
+    """ Splits the text into sentences, see :meth:`PunktSentenceSplitter.split` """
+    return list(_resource(_splitter, language).split(text))
+
+
+@method
+def normalize_one(language, expression, conflict='longest'):
+    """ See :meth:`DateNormalizer.normalize_one` """
+    return _resource(_normalizer, language).normalize_one(expression, conflict)
+
+
+@method
+def normalize_many(language, expression):
+    """ See :meth:`DateNormalizer.normalize_many` """
+    return list(_resource(_normalizer, language).normalize_many(expression))
+
+
+class _RequestHandler(StreamRequestHandler):
+    """ Reads requests from the connection, one JSON object per line,
+        and writes back the replies in the same way
+    """
+
+    def handle(self):
+        _local.serving = True
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+
+            try:
+                request = json.loads(line)
+                function = METHODS[request['method']]
+                reply = {'result': function(*request['args'], **request['kwargs'])}
+            except Exception as e:
+                logger.exception('cannot process request %s', line.strip())
+                reply = {'error': '%s: %s' % (type(e).__name__, e)}
+
+            self.wfile.write(json.dumps(reply) + '\n')
+            self.wfile.flush()
+
+
+class Server(ThreadingMixIn, UnixStreamServer):
+    """ Serves each connection in a separate thread, sharing the resources """
+    daemon_threads = True
+
+    def __init__(self, path):
+        if os.path.exists(path):
+            try:
+                probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                probe.connect(path)
+            except socket.error:
+                os.remove(path)  # left behind by a daemon which was killed
+            else:
+                probe.close()
+                raise ValueError('another daemon is listening on %s' % path)
+
+        old_umask = os.umask(0o077)  # only the current user can connect
+        try:
+            UnixStreamServer.__init__(self, path, _RequestHandler)
+        finally:
+            os.umask(old_umask)
+
+    def server_close(self):
+        UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+@click.group()
+def main():
+    """ Daemon keeping the NLP resources loaded, so that short runs do not
+        pay for loading them. Use it with the root option --nlp-daemon
+    """
+    pass
+
+
+@main.command()
+@click.option('--socket', '-s', 'path', default=DEFAULT_SOCKET, type=click.Path(dir_okay=False),
+              help='Where to listen for connections')
+@click.option('--preload', '-l', multiple=True, help='Load the resources of these languages upfront')
+@click.option('--tt-home', type=click.Path(exists=True, resolve_path=True),
+              help='home directory for TreeTagger')
+@click.option('--taggers', '-t', type=int, default=TAGGERS,
+              help='How many TreeTagger processes to run at most for each language, '
+                   'by default one per CPU')
+def serve(path, preload, tt_home, taggers):
+    """ Runs the daemon until interrupted
+    """
+    global TAGGERS
+    TAGGERS = taggers
+    _local.serving = True
+    server = Server(path)
+    try:
+        for language in preload:
+            _resource(_splitter, language)
+            _resource(_normalizer, language)
+            with _pooled(_tagger, TAGGERS, language, tt_home, {}) as tagger:
+                tagger.tagger.tag_text(u'warm up')
+        logger.info('Listening on %s', path)
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+@main.command(name='ping')
+@click.option('--socket', '-s', 'path', default=DEFAULT_SOCKET, type=click.Path(dir_okay=False))
+def ping_daemon(path):
+    """ Checks whether the daemon is running
+    """
+    global SOCKET
+    SOCKET = path
+    if not available():
+        raise click.ClickException('the daemon is not running')
+    call('ping')
+    logger.info('The daemon at %s is running', path)
@@ -1,10 +1,83 @@
 from __future__ import absolute_import
 import logging
 import multiprocessing as mp
+import os
+import Queue
+import select
 import signal
+import struct
+import threading
+from itertools import islice
+from time import time
+
+import click
+
+from strephit.commons import io
 
 logger = logging.getLogger(__name__)
 
+# per-process (or per-thread) state created by the initializer passed to `map`
+_worker_state = None
+_thread_local = threading.local()
+
+# length prefix of the results sent with the bytes transport
+_FRAME_HEADER = struct.Struct('!I')
+PIPE_WRITE_SIZE = 64 * 1024
+PIPE_READ_SIZE = 1024 * 1024
+
+# tuning of the adaptive batch size
+ADAPTIVE_TARGET_OVERHEAD = 0.05  # max fraction of time workers should spend waiting for tasks
+ADAPTIVE_MAX_BATCH_SECONDS = 1.0  # max time spent processing a single batch
+ADAPTIVE_MAX_BATCH_SIZE = 10000
+ADAPTIVE_SINGLE_PROCESS_BATCH_SIZE = 100
+
+# how many items per process to use to evaluate each candidate number of processes
+WARM_UP_ITEMS = 200
+WARM_UP_MIN_GAIN = 0.2
+WARM_UP_MAX_PROCESSES_PER_CPU = 4  # I/O-bound tasks can benefit from more processes than CPUs
+WARM_UP_MAX_THREADS = 256
+
+# default number of threads of the `threads` backend, which is meant for tasks
+# mostly waiting for I/O and thus can run many more workers than CPUs
+THREADS_PER_CPU = 8
+MAX_THREADS = 64
+
+# sharding of the input of `map_lines`
+SHARDS_PER_PROCESS = 4
+MIN_SHARD_SIZE = 1024 * 1024
+
+
+class ProcessesParamType(click.ParamType):
+    """ Command line parameter for the number of processes, either an integer
+        or `auto` to pick it automatically, see :func:`map`
+    """
+    name = 'processes'
+
+    def convert(self, value, param, ctx):
+        if value == 'auto':
+            return value
+
+        try:
+            return int(value)
+        except ValueError:
+            self.fail('%s is neither an integer nor "auto"' % value, param, ctx)
+
+
+PROCESSES = ProcessesParamType()
+
+
+class _ThreadStats(list):
+    """ Statistics collected by worker threads, has the same interface
+        as the shared array used by worker processes
+    """
+
+    def __init__(self):
+        super(_ThreadStats, self).__init__([0.0, 0.0, 0.0])
+        self.lock = threading.Lock()
+
+    def get_lock(self):
+        return self.lock
+
 
 def make_batches(iterable, size):
     if size > 0:
@@ -21,22 +94,189 @@ def make_batches(iterable, size):
             yield each
 
 
-def _master(function, iterable, processes, task_queue, result_queue, flatten, batch_size):
-    """ Controls the computation. Starts/stops the workers and assigns tasks """
+class _PipeWriter(object):
+    """ Sends byte strings back to the consumer through a pipe. Each string is
+        prefixed with its length and strings are buffered and written in batches,
+        avoiding the pickling and locking overhead of a queue
+    """
+
+    def __init__(self, fd, all_fds):
+        """
+        :param int fd: write end of the pipe used by this writer
+        :param list all_fds: all the descriptors of all the pipes, they are closed
+         by the worker so that the consumer sees the end of the pipes when workers exit
+        """
+        self.fd = fd
+        self.all_fds = all_fds
+        self.buffer = []
+        self.size = 0
+        self.last_flush = time()
+
+    def start(self):
+        """ To be called in the worker process before writing anything """
+        for fd in self.all_fds:
+            if fd != self.fd:
+                os.close(fd)
+
+    def put(self, result):
+        if isinstance(result, unicode):
+            result = result.encode('utf8')
+        elif not isinstance(result, str):
+            logger.error('only strings can be sent with the bytes transport, '
+                         'discarding result of type %s', type(result))
+            return
+
+        self.buffer.append(_FRAME_HEADER.pack(len(result)))
+        self.buffer.append(result)
+        self.size += _FRAME_HEADER.size + len(result)
+        if self.size >= PIPE_WRITE_SIZE or time() - self.last_flush > 1:
+            self.flush()
+
+    def flush(self):
+        data = memoryview(''.join(self.buffer))
+        while data:
+            data = data[os.write(self.fd, data):]
+        self.buffer, self.size, self.last_flush = [], 0, time()
+
+    def close(self):
+        self.flush()
+        os.close(self.fd)
+
+
+def _read_frames(fds):
+    """ Reads the byte strings sent by the :class:`_PipeWriter` s
+        until all the pipes are closed
+    """
+    pending = dict((fd, '') for fd in fds)
+    try:
+        while pending:
+            ready, _, _ = select.select(pending.keys(), [], [])
+            for fd in ready:
+                chunk = os.read(fd, PIPE_READ_SIZE)
+                if not chunk:
+                    if pending.pop(fd):
+                        logger.error('a worker exited in the middle of sending a result')
+                    os.close(fd)
+                    continue
+
+                data, offset = pending[fd] + chunk, 0
+                while len(data) - offset >= _FRAME_HEADER.size:
+                    size, = _FRAME_HEADER.unpack_from(data, offset)
+                    start = offset + _FRAME_HEADER.size
+                    if len(data) - start < size:
+                        break
+                    yield data[start:start + size]
+                    offset = start + size
+                pending[fd] = data[offset:]
+    finally:
+        for fd in pending:
+            os.close(fd)
+
+
+def _adaptive_batches(iterable, stats, processes):
+    """ Groups the iterable in batches whose size is adjusted based on the statistics
+        collected by the workers: batches grow when workers spend too much time waiting
+        for new tasks and shrink when a single batch takes too long to process
+    """
+    size, last, batches = 1, (0.0, 0.0, 0.0), 0
+    bulk = []
+    for each in iterable:
+        bulk.append(each)
+        if len(bulk) < size:
+            continue
+
+        yield bulk
+        bulk = []
+
+        # adjust once every round of tasks
+        batches += 1
+        if batches % processes != 0:
+            continue
+
+        with stats.get_lock():
+            current = tuple(stats)
+        busy, items, wait = [c - l for c, l in zip(current, last)]
+        if not items:
+            continue
+
+        last = current
+        per_item = busy / items
+        overhead = wait / (busy + wait) if busy + wait > 0 else 0
+        if overhead > ADAPTIVE_TARGET_OVERHEAD and size < ADAPTIVE_MAX_BATCH_SIZE \
+                and per_item * size * 2 <= ADAPTIVE_MAX_BATCH_SECONDS:
+            size = min(2 * size, ADAPTIVE_MAX_BATCH_SIZE)
+            logger.debug('workers waited %.1f%% of the time, batch size increased to %d',
+                         100 * overhead, size)
+        elif size > 1 and per_item * size > ADAPTIVE_MAX_BATCH_SECONDS:
+            size = max(size / 2, 1)
+            logger.debug('a batch takes %.2f seconds, batch size decreased to %d',
+                         per_item * size * 2, size)
+
+    if bulk:
+        yield bulk
+
+
+def _report_stats(stats, processes, elapsed):
+    """ Logs how busy the workers have been and whether using more processes could help
+    """
+    busy, items, wait = tuple(stats)
+    if elapsed <= 0 or busy <= 0:
+        return
+
+    parallelism = busy / elapsed
+    logger.info('processed %d items in %.1f seconds, on average %.1f out of %d workers were busy',
+                items, elapsed, parallelism, processes)
+    if parallelism < 0.8 * processes:
+        logger.info('workers spent %.0f%% of the time waiting for tasks, using more than %d '
+                    'processes is unlikely to help', 100 * wait / (busy + wait),
+                    int(parallelism) + 1)
+
+
+def _submit_tasks(iterable, workers, batch_size, task_queue, window, stats):
+    """ Groups the iterable in batches and puts them in the task queue, tagging
+        them with their sequence number if there is a reorder window
+    """
+    if batch_size == 'auto':
+        batches = _adaptive_batches(iterable, stats, workers)
+    else:
+        batches = make_batches(iterable, batch_size)
+
+    seq = 0
+    for each in batches:
+        if each is None:
+            logger.debug('received None task, ignoring it')
+        elif window is not None:
+            window.acquire()
+            task_queue.put((seq, each))
+            seq += 1
+        else:
+            task_queue.put(each)
+
+
+def _master(function, iterable, processes, task_queue, result_queue, flatten, batch_size,
+            window=None, initializer=None, initargs=(), pipes=None, stats=None):
+    """ Controls the computation. Starts/stops the workers and assigns tasks.
+        When a `window` semaphore is given tasks are tagged with their sequence
+        number and a slot of the window must be acquired before submitting each of them.
+        When `pipes` are given each worker sends its results through its own pipe
+        instead of the result queue. When `stats` are given workers collect timing
+        statistics there, which are used to adapt the batch size
+    """
+    start = time()
+    outputs = pipes or [result_queue] * processes
     workers = [mp.Process(target=_worker,
-                          args=(function, task_queue, result_queue, flatten))
-               for _ in xrange(processes)]
+                          args=(function, task_queue, outputs[i], flatten, window is not None,
+                                initializer, initargs, stats))
+               for i in xrange(processes)]
     [p.start() for p in workers]
+    [os.close(pipe.fd) for pipe in pipes or []]
 
     try:
-        for each in make_batches(iterable, batch_size):
-            if each is None:
-                logger.debug('received None task, ignoring it')
-            else:
-                task_queue.put(each)
+        _submit_tasks(iterable, processes, batch_size, task_queue, window, stats)
     except KeyboardInterrupt:
         logger.error('caught KeyboardInterrupt, brutally slaughtering workers')
-        result_queue.cancel_join_thread()
+        if result_queue is not None:
+            result_queue.cancel_join_thread()
         task_queue.cancel_join_thread()
         [p.terminate() for p in workers]
     else:
@@ -44,22 +284,148 @@ def _master(function, iterable, processes, task_queue, result_queue, flatten, ba
             task_queue.put(None)
         [p.join() for p in workers]
 
-    result_queue.put(None)
+        if stats is not None:
+            _report_stats(stats, processes, time() - start)
+
+    if result_queue is not None:
+        result_queue.put(None)
 
 
-def _worker(function, task_queue, result_queue, flatten):
+def _worker(function, task_queue, result_queue, flatten, ordered, initializer=None, initargs=(),
+            stats=None):
     """ Worker process: gets tasks, applies the function and sends back results
-        Stop with a `None` task.
+        Stop with a `None` task. When `ordered` tasks are tuples (sequence number, task)
+        and all the results of a task are sent back together with its sequence number,
+        even when there are none. Results are sent to `result_queue`, which can also
+        be a :class:`_PipeWriter`. If given, `stats` is a shared array where the time
+        spent processing tasks, the number of processed items and the time spent
+        waiting for new tasks are accumulated
     """
+    global _worker_state
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
+    if isinstance(result_queue, _PipeWriter):
+        result_queue.start()
+
+    if initializer is not None:
+        _worker_state = initializer(*initargs)
+
+    _process_tasks(function, task_queue, result_queue, flatten, ordered, stats)
+
+    if isinstance(result_queue, _PipeWriter):
+        result_queue.close()
+
+
+def _process_tasks(function, task_queue, result_queue, flatten, ordered, stats):
+    """ Gets tasks from the queue and processes them until a `None` task, see :func:`_worker`
+    """
+    waiting = time()
     task = task_queue.get()
     while task is not None:
-        for result in _process_task(function, task, flatten, False):
-            result_queue.put(result)
+        started = time()
+        if ordered:
+            seq, task = task
+            result_queue.put((seq, list(_process_task(function, task, flatten, False))))
+        else:
+            for result in _process_task(function, task, flatten, False):
+                result_queue.put(result)
+
+        if stats is not None:
+            with stats.get_lock():
+                stats[0] += time() - started
+                stats[1] += len(task) if isinstance(task, list) else 1
+                stats[2] += started - waiting
+
+        waiting = time()
         task = task_queue.get()
 
 
+def _thread_worker(function, task_queue, result_queue, flatten, ordered, initializer, initargs,
+                   stats):
+    """ Worker thread, same as :func:`_worker` but the state created
+        by the initializer is local to the thread
+    """
+    if initializer is not None:
+        _thread_local.state = initializer(*initargs)
+
+    _process_tasks(function, task_queue, result_queue, flatten, ordered, stats)
+
+
+def _thread_master(iterable, workers, task_queue, result_queue, batch_size, window, stats):
+    """ Submits the tasks to the worker threads and waits for them to finish
+    """
+    start = time()
+    try:
+        _submit_tasks(iterable, len(workers), batch_size, task_queue, window, stats)
+    except:
+        logger.exception('caught exception while submitting tasks, stopping')
+    finally:
+        for _ in workers:
+            task_queue.put(None)
+        [t.join() for t in workers]
+
+        if stats is not None:
+            _report_stats(stats, len(workers), time() - start)
+        result_queue.put(None)
+
+
+def _default_threads():
+    """ Number of threads used by the `threads` backend when none is specified
+    """
+    return min(THREADS_PER_CPU * mp.cpu_count(), MAX_THREADS)
+
+
+def _map_threads(function, iterable, threads, flatten, batch_size, ordered, window,
+                 initializer, initargs, transport):
+    """ Same as :func:`map` but uses a pool of threads in the current process
+    """
+    task_queue = Queue.Queue(max(50, 2 * threads))
+    result_queue = Queue.Queue(max(50, 2 * threads))
+    window = threading.BoundedSemaphore(window) if ordered else None
+    stats = _ThreadStats() if batch_size == 'auto' else None
+
+    workers = [threading.Thread(target=_thread_worker,
+                                args=(function, task_queue, result_queue, flatten, ordered,
+                                      initializer, initargs, stats))
+               for _ in xrange(threads)]
+    master = threading.Thread(target=_thread_master,
+                              args=(iterable, workers, task_queue, result_queue,
+                                    batch_size, window, stats))
+    for thread in workers + [master]:
+        thread.daemon = True
+        thread.start()
+
+    if ordered:
+        results = _reorder(result_queue, window)
+    else:
+        results = iter(result_queue.get, None)
+
+    for result in results:
+        if transport == 'bytes' and isinstance(result, unicode):
+            result = result.encode('utf8')
+        yield result
+
+    master.join()
+
+
+def _reorder(result_queue, window):
+    """ Re-emits the results coming from the workers in the same order as their
+        tasks were submitted, releasing a slot of the window for each completed task
+    """
+    pending = {}
+    expected = 0
+    result = result_queue.get()
+    while result is not None:
+        seq, results = result
+        pending[seq] = results
+        while expected in pending:
+            for each in pending.pop(expected):
+                yield each
+            window.release()
+            expected += 1
+        result = result_queue.get()
+
+
 def _process_task(function, task, flatten, raise_exc):
     """ Actually processes a task, flattening the results if needed and logging or
         raising exceptions.
@@ -82,7 +448,16 @@ def _process_task(function, task, flatten, raise_exc):
             logger.exception('caught exception in worker process')
 
 
-def map(function, iterable, processes=0, flatten=False, raise_exc=True, batch_size=0):
+def worker_state():
+    """ Returns the state created by the initializer of the current worker,
+        see :func:`map`. It is `None` if no initializer was given.
+    """
+    return getattr(_thread_local, 'state', _worker_state)
+
+
+def map(function, iterable, processes=0, flatten=False, raise_exc=True, batch_size=0,
+        ordered=False, window=100, initializer=None, initargs=(), transport='queue',
+        backend='processes'):
     """ Applies the given function to each element of the iterable in parallel.
         `None` values are not allowed in the iterable nor as return values, they will
         simply be discarded. Can be "safely" stopped with a keboard interrupt.
@@ -90,7 +465,9 @@ def map(function, iterable, processes=0, flatten=False, raise_exc=True, batch_si
         :param function: the function used to transform the elements of the iterable
         :param processes: how many items to process in parallel. Use zero or a negative
          number to use all the available processors. No additional processes will be used
-         if the value is 1.
+         if the value is 1. Use `auto` to pick the number of processes with a short
+         warm-up: the first items are processed with 1, 2, 4, ... processes until the
+         throughput stops growing significantly, and the rest with the best number found
         :param flatten: If the mapping function return an iterable flatten the resulting
          iterables into a single one.
         :param raise_exc: Only when `processes` equals 1, controls whether to propagate
@@ -99,45 +476,279 @@ def map(function, iterable, processes=0, flatten=False, raise_exc=True, batch_si
          parameter is not used.
         :param batch_size: If larger than 0, the input iterable will be grouped in groups
          of this size and the resulting list passed to as argument to the worker.
+         Use `auto` to let the size of the batches adapt at runtime, based on how long
+         tasks take and how long workers wait for them, so that workers are kept busy
+         while the time spent in inter-process communication stays low. A summary of
+         how busy the workers were is logged at the end.
+        :param ordered: Emit the results in the same order as the corresponding elements
+         of the iterable. Results of a task which completed early are held back until
+         all preceding tasks complete.
+        :param window: Only when `ordered` is true, how many tasks (or batches) can be
+         in flight or waiting to be emitted. When the window is full no more tasks are
+         submitted until the oldest one completes, so that a single slow task does not
+         make the memory usage grow unbounded.
+        :param initializer: Function called once in each worker process, before it
+         starts processing tasks, with `initargs` as arguments. Use it to load expensive
+         resources, e.g. models or taggers, once per process rather than sharing them
+         with the parent. Whatever it returns is available to the mapping function
+         through :func:`worker_state`
+        :param initargs: Arguments for the `initializer`
+        :param transport: How results are sent back from the workers. `queue` (the default)
+         pickles them one by one into a shared queue; `bytes` requires the results to be
+         strings, e.g. JSON-encoded documents, and writes them in length-prefixed batches
+         into a pipe per worker, which is much faster for many small results. Unicode
+         results are encoded in utf8, and results are always returned as `str`.
+         Cannot be used together with `ordered`
+        :param backend: Either `processes` (the default) or `threads`. Threads are
+         preferable when the function spends most of its time waiting for I/O, e.g.
+         HTTP requests, since many of them can run concurrently in the current
+         process; `processes` is then the number of threads, and zero or a negative
+         number uses :data:`THREADS_PER_CPU` threads per processor, at most
+         :data:`MAX_THREADS`. The semantics of all
+         other parameters are the same, and each thread runs its own `initializer`
         :returns: iterable with the results. Order is not guaranteed to be preserved
+         unless `ordered` is true
 
         Sample usage:
 
         >>> from strephit.commons import parallel
         >>> list(parallel.map(lambda x: 2*x, range(10)))
         [0, 8, 10, 12, 14, 16, 18, 2, 4, 6]
+        >>> list(parallel.map(lambda x: 2*x, range(10), ordered=True))
+        [0, 2, 4, 6, 8, 10, 12, 14, 16, 18]
+        >>> list(parallel.map(lambda x: parallel.worker_state() * x, range(5),
+        ...                   initializer=lambda k: k, initargs=(3,), ordered=True))
+        [0, 3, 6, 9, 12]
 
     """
-    if processes == 1:
-        for task in make_batches(iterable, batch_size):
-            if task is not None:
-                for each in _process_task(function, task, flatten, raise_exc):
-                    yield each
+    global _worker_state
+
+    if transport not in {'queue', 'bytes'}:
+        raise ValueError('unknown transport: %s' % transport)
+    elif transport == 'bytes' and ordered:
+        raise ValueError('the bytes transport cannot preserve the order of the results')
+    elif backend not in {'processes', 'threads'}:
+        raise ValueError('unknown backend: %s' % backend)
+
+    if processes == 'auto':
+        kwargs = dict(flatten=flatten, raise_exc=raise_exc, batch_size=batch_size,
+                      ordered=ordered, window=window, initializer=initializer,
+                      initargs=initargs, transport=transport, backend=backend)
+        for each in _warm_up_map(function, iterable, **kwargs):
+            yield each
+    elif processes == 1:
+        previous_state = _worker_state
+        if initializer is not None:
+            _worker_state = initializer(*initargs)
+
+        if batch_size == 'auto':
+            batch_size = ADAPTIVE_SINGLE_PROCESS_BATCH_SIZE
+
+        try:
+            for task in make_batches(iterable, batch_size):
+                if task is not None:
+                    for each in _process_task(function, task, flatten, raise_exc):
+                        if transport == 'bytes' and isinstance(each, unicode):
+                            each = each.encode('utf8')
+                        yield each
+        finally:
+            _worker_state = previous_state
+    elif backend == 'threads':
+        for each in _map_threads(function, iterable, processes if processes > 0 else _default_threads(),
+                                 flatten, batch_size, ordered, window, initializer, initargs,
+                                 transport):
+            yield each
     else:
         if processes <= 0:
             processes = mp.cpu_count()
 
         task_queue = mp.Queue(50)
-        result_queue = mp.Queue(50)
+        window = mp.BoundedSemaphore(window) if ordered else None
+        if transport == 'bytes':
+            result_queue = None
+            pipe_fds = [os.pipe() for _ in xrange(processes)]
+            all_fds = [fd for fds in pipe_fds for fd in fds]
+            pipes = [_PipeWriter(write_fd, all_fds) for _, write_fd in pipe_fds]
+        else:
+            result_queue = mp.Queue(50)
+            pipes = None
+        stats = mp.Array('d', 3) if batch_size == 'auto' else None
 
         master = mp.Process(target=_master,
                             args=(function, iterable, processes, task_queue,
-                                  result_queue, flatten, batch_size))
+                                  result_queue, flatten, batch_size, window,
+                                  initializer, initargs, pipes, stats))
         master.start()
 
-        result = result_queue.get()
-        while result is not None:
-            yield result
+        if pipes:
+            [os.close(pipe.fd) for pipe in pipes]
+            for result in _read_frames([read_fd for read_fd, _ in pipe_fds]):
+                yield result
+        elif ordered:
+            for result in _reorder(result_queue, window):
+                yield result
+        else:
             result = result_queue.get()
+            while result is not None:
+                yield result
+                result = result_queue.get()
 
         master.join()
 
 
-def execute(processes=0, *specs):
+def _warm_up_map(function, iterable, batch_size, backend, **kwargs):
+    """ Maps the first items of the iterable with an increasing number of processes,
+        measuring the throughput, and the remaining ones with the number of processes
+        after which the throughput did not improve significantly
+    """
+    items_per_task = batch_size if isinstance(batch_size, int) and batch_size > 0 else 1
+    iterator = iter(iterable)
+    best, best_rate = 1, None
+
+    if backend == 'threads':
+        limit = WARM_UP_MAX_THREADS
+    else:
+        limit = WARM_UP_MAX_PROCESSES_PER_CPU * mp.cpu_count()
+
+    processes = 1
+    while processes <= limit:
+        sample = list(islice(iterator, WARM_UP_ITEMS * processes * items_per_task))
+        if not sample:
+            return
+
+        start = time()
+        for each in map(function, sample, processes, batch_size=batch_size,
+                        backend=backend, **kwargs):
+            yield each
+        rate = len(sample) / max(time() - start, 1e-6)
+        logger.debug('warm-up: %d processes handled %.1f items/s', processes, rate)
+
+        if best_rate is not None and rate < best_rate * (1 + WARM_UP_MIN_GAIN):
+            logger.info('adding processes stopped helping at %d processes (%.1f items/s '
+                        'against %.1f items/s)', processes, rate, best_rate)
+            break
+
+        best, best_rate = processes, rate
+        processes *= 2
+
+    logger.info('using %d processes', best)
+    for each in map(function, iterator, best, batch_size=batch_size, backend=backend, **kwargs):
+        yield each
+
+
+def _line_files(source):
+    """ Lists the files with the lines of the given source, or returns `None`
+        if the source cannot be read by the workers on their own
+    """
+    name = source if isinstance(source, basestring) else getattr(source, 'name', None)
+    if not isinstance(name, basestring):
+        return None
+    elif os.path.isfile(name):
+        return [name]
+    elif os.path.isdir(name):
+        return [os.path.join(name, each) for each in sorted(os.listdir(name))
+                if io.is_jsonlines(each)]
+    else:
+        return None
+
+
+def _line_shards(paths, processes):
+    """ Splits the files in byte ranges (path, start, end) of roughly the same size.
+        Compressed files cannot be seeked, so they are a single range with no end
+    """
+    plain = [path for path in paths if not io.sniff_compression(path)]
+    total = sum(os.path.getsize(path) for path in plain)
+    shard_size = max(total / (processes * SHARDS_PER_PROCESS), MIN_SHARD_SIZE)
+
+    for path in paths:
+        if path not in plain:
+            yield path, 0, None
+            continue
+
+        size = os.path.getsize(path)
+        for start in xrange(0, size, shard_size):
+            yield path, start, min(start + shard_size, size)
+
+
+def _read_shard(path, start, end):
+    """ Reads the lines starting in the given byte range of a file. The line
+        crossing the start of the range belongs to the previous range
+    """
+    if end is None:
+        with io.open_file(path) as f:
+            for line in f:
+                yield line
+        return
+
+    with open(path, 'rb') as f:
+        if start > 0:
+            f.seek(start - 1)
+            f.readline()
+        position = f.tell()
+        for line in f:
+            if position >= end:
+                break
+            position += len(line)
+            yield line
+
+
+def map_lines(function, source, processes=0, flatten=False, raise_exc=True, batch_size=0,
+              **kwargs):
+    """ Same as :func:`map`, but applies the function to the lines of a file
+        or of the jsonlines files in a directory. Instead of having the lines read
+        by a single process and sent to the workers, each worker reads its own
+        newline-aligned byte range of the input, so that only the results go
+        through inter-process communication. Compressed files are read as a whole
+        by a single worker.
+
+        When the source is not a file or a directory, e.g. the standard input or a
+        generator, this is the same as :func:`map`. It is the same also when `processes`
+        is `auto`, since the warm-up needs the lines to be handed out one task at a time.
+
+        :param function: the function used to transform the lines, or batches of
+         lines when `batch_size` is given
+        :param source: a path or an opened file
+        :param raise_exc: As with :func:`map`, only used when `processes` equals 1.
+         Otherwise exceptions are logged and the lines of the failed task are skipped
+        :param batch_size: If larger than 0, the lines are grouped in batches of this
+         size. With `auto` batches of a fixed size are used, since workers read their
+         own input there is no communication overhead to adapt to
+        :param kwargs: other parameters of :func:`map`. When `ordered`, a whole byte
+         range is processed before its results are emitted
+        :return: iterable with the results
+    """
+    paths = _line_files(source)
+    if paths is None or processes in {1, 'auto'}:
+        if paths is not None:
+            source = (line for path, start, end in _line_shards(paths, 1)
+                      for line in _read_shard(path, start, end))
+        for each in map(function, source, processes, flatten, raise_exc, batch_size, **kwargs):
+            yield each
+        return
+
+    if processes <= 0:
+        processes = mp.cpu_count()
+
+    if batch_size == 'auto':
+        batch_size = ADAPTIVE_SINGLE_PROCESS_BATCH_SIZE
+
+    def process_shard(shard):
+        for task in make_batches(_read_shard(*shard), batch_size):
+            for each in _process_task(function, task, flatten, False):
+                yield each
+
+    shards = list(_line_shards(paths, processes))
+    logger.debug('reading the input in %d shards', len(shards))
+    for each in map(process_shard, shards, processes, flatten=True, **kwargs):
+        yield each
+
+
+def execute(processes=0, *specs, **kwargs):
     """ Execute the given functions parallelly
 
         :param processes: Number of functions to execute at the same time
         :param specs: a sequence of functions, each followed by its arguments (arguments as a tuple or list)
+        :param backend: keyword-only, either `processes` (the default) or `threads`, see :func:`map`
         :return: the results that the functions returned, in the same order as they were specified
         :rtype: list
 
@@ -150,8 +761,12 @@ def execute(processes=0, *specs):
         ... ))
         [0, 10]
     """
+    backend = kwargs.pop('backend', 'processes')
+    if kwargs:
+        raise TypeError('unexpected keyword arguments: %s' % ', '.join(kwargs))
+
     functions, arguments = specs[::2], specs[1::2]
     res = list(map(lambda (i, args): (i, functions[i](*args)),
                    enumerate(arguments),
-                   processes))
+                   processes, backend=backend))
     return [result for _, result in sorted(res, key=lambda (i, _): i)]
@@ -2,55 +2,338 @@
 # -*- encoding: utf-8 -*-
 from __future__ import absolute_import
 
-import json
+import hashlib
 import logging
+import multiprocessing
+import threading
+from collections import deque
+from multiprocessing.pool import ThreadPool
 from sys import exit
 
 import click
 import treetaggerwrapper
 from treetaggerpoll import TaggerProcessPoll
-from treetaggerwrapper import make_tags, NotTag, TreeTagger
+from treetaggerwrapper import make_tags, NotTag, Tag, TreeTagger
 from nltk import pos_tag, word_tokenize, pos_tag_sents
 
+from strephit.commons import cache, io, nlp_daemon
 from strephit.commons.io import load_scraped_items
 from strephit.commons.tokenize import Tokenizer
 
 logger = logging.getLogger(__name__)
 treetaggerwrapper.logger.setLevel(logging.WARN)  # they are too verbose
 
+# Explicit TAGOPT: the default has the '-no-unknown' option,
+# which prints the token rather than '<unknown>' for unknown lemmas
+# We'd rather skip unknown lemmas, as they are likely to be wrong tags
+TAGOPT = u'-token -lemma -sgml -quiet'
 
+# Separates the sentences given to TreeTagger at once. Thanks to the '-sgml' option
+# it is copied to the output untouched, so that the tags can be split back
+SENTENCE_MARKER = u'<strephit-sentence/>'
+
+# How many texts are sent to each TreeTagger process of :meth:`TTPosTagger.tag_many`
+# without waiting for the results, so that it never sits idle
+WINDOW_PER_WORKER = 4
+
+# Whether taggers keep the tags of the sentences in the :class:`TagStore` by default,
+# set with the root option --tag-store. With the `files` cache backend each sentence
+# becomes a file, so the store is best used with the `sqlite` one
+USE_STORE = False
+
+
+class TagStore(object):
+    """ Persistent store of the tags of the sentences, kept in the cache so that
+        a sentence is tagged only once across the stages of the pipeline and
+        across runs. Sentences are identified by the hash of their text, together
+        with the language and the options of the tagger which produced the tags.
+
+        The raw output of the tagger is stored, including the unknown lemmas,
+        so that the same entry can be used whether or not they are skipped.
+        Only sentences are stored, not whole documents, since they are what the
+        stages of the pipeline have in common. The tags expire as configured
+        in :data:`strephit.commons.cache.TTL`.
+    """
+
+    NAMESPACE = 'strephit.commons.pos_tag'
+
+    # Increase when the tokenization changes, so that old tags are not used
+    VERSION = 1
+
+    def __init__(self, language, options):
+        """
+            :param str language: Language of the sentences
+            :param dict options: Options of the tagger which affect the tags
+        """
+        self.language = language
+        self.options = options
+
+    def key_for(self, text, **kwargs):
+        """ Key of the tags of the given text in the cache
+
+            :param kwargs: Options passed to the tagger for this text only
+        """
+        digest = hashlib.sha1(text.encode('utf8')).hexdigest()
+        options = dict(self.options, **kwargs)
+        return cache.key_for(self.NAMESPACE, [self.language, options, self.VERSION, digest])
+
+    @staticmethod
+    def _decode(stored):
+        return [Tag(*tag) if len(tag) == 3 else NotTag(*tag) for tag in stored]
+
+    def get(self, text, **kwargs):
+        """ Retrieves the tags of the given text
+
+            :return: list of tags, or `None` if the text was never tagged
+        """
+        stored = cache.get(self.key_for(text, **kwargs))
+        return self._decode(stored) if stored is not None else None
+
+    def get_many(self, texts, **kwargs):
+        """ Retrieves the tags of many texts at once, see :meth:`get`
+
+            :return: list with the tags of each text, or `None` for texts never tagged
+        """
+        stored = cache.get_many([self.key_for(text, **kwargs) for text in texts])
+        return [self._decode(tags) if tags is not None else None for tags in stored]
+
+    def set(self, text, tags, **kwargs):
+        """ Stores the tags of the given text, as produced by :func:`make_tags` """
+        self.set_many([(text, tags)], **kwargs)
+
+    def set_many(self, tagged, **kwargs):
+        """ Stores the tags of many texts at once
+
+            :param tagged: pairs (text, tags)
+        """
+        cache.set_many([(self.key_for(text, **kwargs), [list(tag) for tag in tags])
+                        for text, tags in tagged], namespace=self.NAMESPACE)
+
+
+class _DaemonTreeTagger(object):
+    """ Stand-in for :class:`TreeTagger` which has the texts tagged by the
+        NLP daemon, see :mod:`strephit.commons.nlp_daemon`. When the daemon
+        fails, a local TreeTagger is started and used from then on
+    """
+
+    def __init__(self, tagger):
+        self.owner = tagger
+        self.args = tagger.language, tagger.tt_home, tagger.kwargs
+        self.local = None
+        self.lock = threading.Lock()
+
+    def call(self, text, **kwargs):
+        """ Has the text tagged by the daemon
+
+            :raises nlp_daemon.DaemonError: If the daemon fails
+        """
+        return nlp_daemon.call('tag_text', *(self.args + (text,)), **kwargs)
+
+    def tag_text(self, text, **kwargs):
+        if self.local is None:
+            try:
+                return self.call(text, **kwargs)
+            except nlp_daemon.DaemonError as e:
+                logger.warn('the NLP daemon cannot tag the text, using a local TreeTagger: %s', e)
+                with self.lock:
+                    if self.local is None:
+                        self.local = self.owner._start_tagger()
+        return self.local.tag_text(text, **kwargs)
+
+
+class _DaemonJob(object):
+    """ Stand-in for the jobs of :class:`TaggerProcessPoll` """
+
+    def __init__(self, async_result):
+        self.async_result = async_result
+
+    @property
+    def finished(self):
+        return self.async_result.ready()
+
+    def wait_finished(self):
+        self.async_result.wait()
+
+    @property
+    def result(self):
+        return self.async_result.get()
+
+
+class _DaemonTaggerPool(object):
+    """ Stand-in for :class:`TaggerProcessPoll` which has the texts tagged by the NLP
+        daemon, sending as many texts at the same time as the workers of the pool.
+        When the daemon fails, a local pool of TreeTagger processes of the same
+        size is started and used from then on
+    """
+
+    def __init__(self, tagger, pool_size):
+        self.owner = tagger
+        self.pool_size = pool_size
+        self.tagger = _DaemonTreeTagger(tagger)
+        self.threads = ThreadPool(pool_size)
+        self.local = None
+        self.lock = threading.Lock()
+
+    def _local_pool(self):
+        with self.lock:
+            if self.local is None:
+                self.local = self.owner._start_local_pool(self.pool_size)
+        return self.local
+
+    def _tag_text(self, text, kwargs):
+        if self.local is None:
+            try:
+                return self.tagger.call(text, **kwargs)
+            except nlp_daemon.DaemonError as e:
+                logger.warn('the NLP daemon cannot tag the text, using local TreeTagger '
+                            'processes: %s', e)
+
+        job = self._local_pool().tag_text_async(text, **kwargs)
+        job.wait_finished()
+        return job.result
+
+    def tag_text_async(self, text, **kwargs):
+        if self.local is not None:
+            return self.local.tag_text_async(text, **kwargs)
+        return _DaemonJob(self.threads.apply_async(self._tag_text, (text, kwargs)))
+
+    def stop_poll(self):
+        self.threads.close()
+        self.threads.join()
+        if self.local is not None:
+            self.local.stop_poll()
+
+
+TAGGERS = {}
+
+# Name of the tagger used when none is specified, see :func:`get_pos_tagger`
+DEFAULT_TAGGER = 'tt'
+
+
+def register(name):
+    """ Class decorator making a POS tagger available under the given name.
+
+        Taggers are initialized with the language code and optional keyword
+        arguments, ignoring those they do not understand, and implement `tag_one`
+        and `tag_many` with the same signature and results of :class:`TTPosTagger`
+
+        :param str name: Name of the tagger in :data:`TAGGERS`
+    """
+    def decorator(cls):
+        TAGGERS[name] = cls
+        return cls
+    return decorator
+
+
+@register('nltk')
 class NLTKPosTagger(object):
-    """part-of-speech tagger implemented using the NLTK library"""
+    """ part-of-speech tagger implemented using the NLTK library. It does not
+        lemmatize, so the lemma of each token is the token itself
+    """
+
+    # NLTK codes of the languages which have a pre-trained model
+    languages = {
+        'en': 'eng',
+    }
 
-    def __init__(self, language):
+    def __init__(self, language, tagset=None, **kwargs):
+        """
+            :param str language: Language of the texts
+            :param str tagset: Tagset of the results, e.g. 'universal', by default the
+             one of the model
+            :param kwargs: Options of other taggers, ignored
+        """
+        if language not in self.languages:
+            raise ValueError("Invalid or unsupported language: '%s'. Please use one of the currently supported ones: %s" % (
+                language, self.languages.keys()))
         self.language = language
+        self.tagset = tagset
 
-    def tag_many(self, documents, tagset=None, **kwargs):
-        """ POS-Tag many documents. """
-        return pos_tag_sents((word_tokenize(d) for d in documents), tagset)
+    def tokenize(self, text):
+        """ Splits a text into tokens
+        """
+        return word_tokenize(text)
 
-    def tag_one(self, text, tagset, **kwargs):
-        """ POS-Tags the given text """
-        return pos_tag(word_tokenize(text, tagset))
+    @staticmethod
+    def _make_tags(tagged):
+        return [Tag(word, pos, word) for word, pos in tagged]
 
+    def tag_one(self, text, skip_unknown=True, **kwargs):
+        """ POS-Tags the given text
 
+            :param unicode text: Text to be tagged
+            :param bool skip_unknown: Ignored, all the tokens are tagged
+        """
+        return self._make_tags(pos_tag(self.tokenize(text), self.tagset, self.languages[self.language]))
+
+    def tag_many(self, items, document_key, pos_tag_key, batch_size=1000, **kwargs):
+        """ POS-Tags many text documents of the given items, see :meth:`TTPosTagger.tag_many`
+
+            :param int batch_size: How many texts to give to NLTK at once
+        """
+        batch = []
+        for item in items:
+            if not item.get(document_key):
+                continue
+
+            batch.append(item)
+            if len(batch) >= batch_size:
+                for each in self._tag_batch(batch, document_key, pos_tag_key):
+                    yield each
+                batch = []
+        for each in self._tag_batch(batch, document_key, pos_tag_key):
+            yield each
+
+    def _tag_batch(self, batch, document_key, pos_tag_key):
+        tokens = [self.tokenize(item[document_key]) for item in batch]
+        for item, tagged in zip(batch, pos_tag_sents(tokens, self.tagset, self.languages[self.language])):
+            item[pos_tag_key] = self._make_tags(tagged)
+            yield item
+
+
+@register('tt')
 class TTPosTagger(object):
     """ part-of-speech tagger implemented using tree tagger and treetaggerwrapper """
 
-    def __init__(self, language, tt_home=None, **kwargs):
+    def __init__(self, language, tt_home=None, use_store=None, **kwargs):
+        """ Initializes the tagger. TreeTagger itself is started only when a
+            sentence which is not in the :class:`TagStore` needs to be tagged
+
+            :param str language: Language of the texts
+            :param str tt_home: Home directory of TreeTagger
+            :param bool use_store: Whether to keep the tags of the sentences in the
+             :class:`TagStore`, by default :data:`USE_STORE`
+            :param kwargs: Other options of :class:`TreeTagger`
+        """
+        if use_store is None:
+            use_store = USE_STORE
+
         self.language = language
         self.tt_home = tt_home
+        self.kwargs = kwargs
         self.tokenizer = Tokenizer(language)
-        self.tagger = TreeTagger(
-            TAGLANG=language,
-            TAGDIR=tt_home,
-            # Explicit TAGOPT: the default has the '-no-unknown' option,
-            # which prints the token rather than '<unknown>' for unknown lemmas
-            # We'd rather skip unknown lemmas, as they are likely to be wrong tags
-            TAGOPT=u'-token -lemma -sgml -quiet',
+        self.store = TagStore(language, dict(kwargs, TAGOPT=TAGOPT)) if use_store else None
+        self._tagger = None
+
+    @property
+    def tagger(self):
+        """ The :class:`TreeTagger` instance, started on first use. When the
+            NLP daemon is available it is used instead, see :mod:`strephit.commons.nlp_daemon`
+        """
+        if self._tagger is None and nlp_daemon.available():
+            self._tagger = _DaemonTreeTagger(self)
+        elif self._tagger is None:
+            self._tagger = self._start_tagger()
+        return self._tagger
+
+    def _start_tagger(self):
+        return TreeTagger(
+            TAGLANG=self.language,
+            TAGDIR=self.tt_home,
+            TAGOPT=TAGOPT,
             # Use our tokenization logic (CHUNKERPROC here)
             CHUNKERPROC=self._tokenizer_wrapper,
-            **kwargs
+            **self.kwargs
         )
 
     def _tokenizer_wrapper(self, tagger, text_list):
@@ -78,7 +361,8 @@ class TTPosTagger(object):
         return self.tokenizer.tokenize(text)
 
     def tag_one(self, text, skip_unknown=True, **kwargs):
-        """ POS-Tags the given text, optionally skipping unknown lemmas
+        """ POS-Tags the given text, optionally skipping unknown lemmas.
+            The tags are looked up in the :class:`TagStore` first
 
             :param unicode text: Text to be tagged
             :param bool skip_unknown: Automatically emove unrecognized tags from the result
@@ -94,15 +378,85 @@ class TTPosTagger(object):
              Tag(word=u'be', pos=u'VB', lemma=u'be'),
              Tag(word=u'tagged', pos=u'VVN', lemma=u'tag')]
         """
-        return self._postprocess_tags(make_tags(self.tagger.tag_text(text, **kwargs)),
-                                      skip_unknown)
+        tags = self.store.get(text, **kwargs) if self.store else None
+        if tags is None:
+            tags = make_tags(self.tagger.tag_text(text, **kwargs))
+            if self.store:
+                self.store.set(text, tags, **kwargs)
+        return self._postprocess_tags(tags, skip_unknown)
+
+    def tag_sentences(self, sentences, skip_unknown=True, **kwargs):
+        """ POS-Tags many sentences, for example those of a document, with a single
+            round-trip to TreeTagger. The sentences are tokenized beforehand and sent
+            one after the other, separated by :data:`SENTENCE_MARKER`. The tags are
+            the same as :meth:`tag_one`, and sentences already in the :class:`TagStore`
+            are not sent at all
+
+            :param list sentences: Unicode sentences to be tagged
+            :param bool skip_unknown: Remove unrecognized tags from the result
+            :return: The tags of each sentence
+            :rtype: list of lists
 
-    def tag_many(self, items, document_key, pos_tag_key, batch_size=10000, **kwargs):
-        """ POS-Tags many text documents of the given items. Use this for massive text tagging
+            Sample usage:
+
+            >>> from strephit.commons.pos_tag import TTPosTagger
+            >>> from pprint import pprint
+            >>> pprint(TTPosTagger('en').tag_sentences([u'First sentence', u'Then another']))
+            [[Tag(word=u'First', pos=u'JJ', lemma=u'first'),
+              Tag(word=u'sentence', pos=u'NN', lemma=u'sentence')],
+             [Tag(word=u'Then', pos=u'RB', lemma=u'then'),
+              Tag(word=u'another', pos=u'DT', lemma=u'another')]]
+        """
+        sentences = list(sentences)
+        if self.store:
+            tagged = self.store.get_many(sentences, **kwargs)
+        else:
+            tagged = [None] * len(sentences)
+
+        missing = [i for i, tags in enumerate(tagged) if tags is None]
+        if missing:
+            lines = []
+            for i in missing:
+                lines.append(SENTENCE_MARKER)
+                lines.extend(self.tokenize(sentences[i]))
+
+            output = self.tagger.tag_text(lines, tagonly=True, **kwargs)
+            split = []
+            for line in output:
+                if line == SENTENCE_MARKER:
+                    split.append([])
+                else:
+                    split[-1].append(line)
+
+            if len(split) != len(missing):
+                raise ValueError('expected the tags of %d sentences from TreeTagger, got %d'
+                                 % (len(missing), len(split)))
+
+            for i, result in zip(missing, split):
+                tagged[i] = make_tags(result)
+            if self.store:
+                self.store.set_many([(sentences[i], tagged[i]) for i in missing], **kwargs)
+
+        return [self._postprocess_tags(tags, skip_unknown) for tags in tagged]
+
+    def tag_many(self, items, document_key, pos_tag_key, batch_size=1000, window=None,
+                 pool_size=None, **kwargs):
+        """ POS-Tags many text documents of the given items. Use this for massive text tagging.
+            The documents are given to a pool of TreeTagger processes. They are not kept
+            in the :class:`TagStore`, which only holds sentences.
+
+            At most `window` items are kept in memory while being tagged, and they are
+            yielded in order as soon as the oldest one is done, so that memory usage
+            does not depend on the size of the corpus.
 
             :param items: Iterable of items to tag. Generator preferred
             :param document_key: Where to find the text to tag inside each item. Text must be unicode
             :param pos_tag_key: Where to put pos tagged text
+            :param int batch_size: Ignored, taggers which work in batches use it
+             as the number of texts in each batch
+            :param int window: How many items can be tagged at the same time, by default
+             :data:`WINDOW_PER_WORKER` for each TreeTagger process
+            :param int pool_size: How many TreeTagger processes to use, by default one per CPU
 
             Sample usage:
 
@@ -128,67 +482,104 @@ class TTPosTagger(object):
                          Tag(word=u'two', pos=u'CD', lemma=u'two')],
               'text': u'In the second position is item two'}]
         """
-        tt_pool = TaggerProcessPoll(
-            TAGLANG=self.language,
-            TAGDIR=self.tt_home,
-            TAGOPT=u'-token -lemma -sgml -quiet',
-            CHUNKERPROC=self._tokenizer_wrapper
-        )
-        logging.getLogger('TreeTagger').setLevel(logging.WARNING)
+        pool_size = pool_size or multiprocessing.cpu_count()
+        window = window or WINDOW_PER_WORKER * pool_size
+        pool = self._start_pool(pool_size)
+        queue = deque()  # pairs (item, job) in input order
         try:
-            jobs = []
-            for i, item in enumerate(items):
+            for item in items:
                 if not item.get(document_key):
                     continue
 
-                jobs.append((item, tt_pool.tag_text_async(item[document_key], **kwargs)))
-                if i % batch_size == 0:
-                    for each in self._finalize_batch(jobs, pos_tag_key):
+                if len(queue) >= window:
+                    for each in self._finalize(queue, pos_tag_key, wait=1):
                         yield each
-                    jobs = []
-            for each in self._finalize_batch(jobs, pos_tag_key):
+
+                queue.append((item, pool.tag_text_async(item[document_key], **kwargs)))
+                for each in self._finalize(queue, pos_tag_key):
+                    yield each
+
+            for each in self._finalize(queue, pos_tag_key, wait=len(queue)):
                 yield each
         finally:
-            tt_pool.stop_poll()
+            pool.stop_poll()
+
+    def _start_pool(self, pool_size):
+        if nlp_daemon.available():
+            return _DaemonTaggerPool(self, pool_size)
+        return self._start_local_pool(pool_size)
+
+    def _start_local_pool(self, pool_size):
+        pool = TaggerProcessPoll(
+            workerscount=pool_size,
+            TAGLANG=self.language,
+            TAGDIR=self.tt_home,
+            TAGOPT=TAGOPT,
+            CHUNKERPROC=self._tokenizer_wrapper,
+            **self.kwargs
+        )
+        logging.getLogger('TreeTagger').setLevel(logging.WARNING)
+        return pool
+
+    def _finalize(self, queue, pos_tag_key, wait=0):
+        """ Yields the oldest items of the window as soon as their tags are available
+
+            :param deque queue: Pairs (item, job) in input order
+            :param int wait: Wait for the tags of at least this many items
+        """
+        while queue:
+            item, job = queue[0]
+            if wait <= 0 and not job.finished:
+                break
 
-    def _finalize_batch(self, jobs, pos_tag_key):
-        for item, job in jobs:
             job.wait_finished()
+            queue.popleft()
+            wait -= 1
             item[pos_tag_key] = self._postprocess_tags(make_tags(job.result))
             yield item
 
 
-def get_pos_tagger(language, **kwargs):
-    """ Returns an initialized instance of the preferred POS tagger for the given language """
-    return TTPosTagger(language, **kwargs)
+def get_pos_tagger(language, name=None, **kwargs):
+    """ Returns an initialized instance of a POS tagger for the given language
+
+        :param str language: Language of the texts
+        :param str name: Name of the tagger in :data:`TAGGERS`, by default :data:`DEFAULT_TAGGER`
+        :param kwargs: Options of the tagger
+    """
+    return TAGGERS[name or DEFAULT_TAGGER](language, **kwargs)
 
 
 @click.command()
 @click.argument('corpus', type=click.Path(exists=True, file_okay=True, resolve_path=True))
 @click.argument('document-key')
 @click.argument('language-code')
-@click.option('-t', '--tagger', type=click.Choice(['tt', 'nltk']), default='tt')
-@click.option('-o', '--outfile', type=click.File('w'), default='output/pos_tagged.jsonlines')
+@click.option('-t', '--tagger', type=click.Choice(TAGGERS), default=DEFAULT_TAGGER)
+@click.option('-o', '--outfile', type=io.CompressedFile('w'), default='output/pos_tagged.jsonlines')
 @click.option('-T', '--pos-tag-key', default='pos_tag')
 @click.option('--tt-home', type=click.Path(exists=True, resolve_path=True),
               help="home directory for TreeTagger")
-@click.option('--batch-size', '-b', default=10000)
-def main(corpus, document_key, pos_tag_key, language_code, tagger, outfile, tt_home, batch_size):
+@click.option('--batch-size', '-b', default=1000, help='How many items to give at once to taggers '
+              'working in batches')
+@click.option('--pool-size', '-p', type=int, help='How many TreeTagger processes to use, by default one per CPU')
+@click.option('--window', '-w', type=int, help='How many items to tag at the same time, by default '
+              '%d for each TreeTagger process' % WINDOW_PER_WORKER)
+@click.option('--read-processes', default=1, help='How many files of the corpus to read concurrently')
+@click.option('--interleave', is_flag=True, help='Read the files of the corpus in turn')
+def main(corpus, document_key, pos_tag_key, language_code, tagger, outfile, tt_home, batch_size,
+         pool_size, window, read_processes, interleave):
     """ Perform part-of-speech (POS) tagging over an input corpus.
     """
-    if tagger == 'tt':
-        pos_tagger = TTPosTagger(language_code, tt_home)
-        logger.info("About to perform part-of-speech tagging with TreeTagger ...")
-    else:
-        pos_tagger = NLTKPosTagger(language_code)
-        logger.info("About to perform part-of-speech tagging with NLTK tagger ...")
-
-    corpus = load_scraped_items(corpus)
+    pos_tagger = get_pos_tagger(language_code, tagger, tt_home=tt_home)
+    logger.info("About to perform part-of-speech tagging with %s ...", pos_tagger.__class__.__name__)
+
+    corpus = load_scraped_items(corpus, read_processes, interleave)
     
     total = 0
-    for i, tagged_document in enumerate(pos_tagger.tag_many(corpus, document_key, pos_tag_key, batch_size)):
+    tagged_documents = pos_tagger.tag_many(corpus, document_key, pos_tag_key, batch_size,
+                                           window=window, pool_size=pool_size)
+    for i, tagged_document in enumerate(tagged_documents):
         total += 1
-        outfile.write(json.dumps(tagged_document) + '\n')
+        outfile.write(io.json_dumps(tagged_document) + '\n')
         if (i + 1) % 10000 == 0:
             logger.info('processed %d items', i + 1)
     
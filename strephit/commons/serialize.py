@@ -6,7 +6,8 @@ import json
 
 import click
 
-from strephit.commons import wikidata, parallel
+from strephit.commons import io, wikidata, parallel
+from strephit.commons.checkpoint import Checkpoint, check_options
 
 logger = logging.getLogger(__name__)
 
@@ -103,7 +104,7 @@ class ClassificationSerializer:
              is true else it is a named entity which could not be resolved
             :type: generator
         """
-        data = json.loads(data) if input_encoded else data
+        data = io.json_loads(data) if input_encoded else data
 
         url = data.get('url')
         if not url:
@@ -166,17 +167,25 @@ def map_url_to_wid(semistructured):
 
 
 @click.command()
-@click.argument('classified', type=click.File('r'))
-@click.argument('lexical-db', type=click.File('r'))
+@click.argument('classified', type=io.CompressedFile('r'))
+@click.argument('lexical-db', type=io.CompressedFile('r'))
 @click.argument('language')
-@click.option('--outfile', '-o', type=click.File('w'), default='output/serialized.qs')
-@click.option('--semistructured', type=click.File('r'))
-@click.option('--processes', '-p', default=0)
-@click.option('--dump-unresolved', type=click.File('w'))
+@click.option('--outfile', '-o', type=io.CompressedFile('w', lazy=True), default='output/serialized.qs')
+@click.option('--semistructured', type=io.CompressedFile('r'))
+@click.option('--processes', '-p', default=0, type=parallel.PROCESSES)
+@click.option('--dump-unresolved', type=io.CompressedFile('w', lazy=True))
+@click.option('--backend', type=click.Choice(['processes', 'threads']), default='threads',
+              help='Mostly waiting for web APIs, so threads are used by default')
+@click.option('--checkpoint', type=click.Path(dir_okay=False),
+              help='Keep track of the progress in this file')
+@click.option('--resume', is_flag=True, help='Skip the items processed by a previous run, '
+                                             'requires --checkpoint')
 def main(classified, lexical_db, outfile, language,
-         semistructured, processes, dump_unresolved):
+         semistructured, processes, dump_unresolved, backend, checkpoint, resume):
     """ Serialize classification results into quickstatements
     """
+    check_options(checkpoint, resume, ('--outfile', outfile),
+                  ('--dump-unresolved', dump_unresolved))
 
     if semistructured:
         url_to_wid = map_url_to_wid(semistructured)
@@ -189,23 +198,33 @@ def main(classified, lexical_db, outfile, language,
 
     lexical_db = json.load(lexical_db)
 
-    count = skipped = 0
     serializer = ClassificationSerializer(language, lexical_db, url_to_wid)
-    for success, item in parallel.map(serializer.to_statements, classified,
-                                       processes=processes, flatten=True):
-        if success:
-            outfile.write(item.encode('utf8'))
-            outfile.write('\n')
+    with Checkpoint(checkpoint, resume) as checkpoint:
+        outfile = checkpoint.open(outfile)
+        dump_unresolved = checkpoint.open(dump_unresolved)
+
+        count = checkpoint.state.get('count', 0)
+        skipped = checkpoint.state.get('skipped', 0)
+        for i, results in checkpoint.map(serializer.to_statements, classified,
+                                         processes=processes, flatten=True,
+                                         backend=backend):
+            for success, item in results or []:
+                if success:
+                    outfile.write(item.encode('utf8'))
+                    outfile.write('\n')
+
+                    count += 1
+                else:
+                    skipped += 1
+                    if dump_unresolved:
+                        dump_unresolved.write(io.json_dumps(item))
+                        dump_unresolved.write('\n')
 
-            count += 1
-        else:
-            skipped += 1
-            if dump_unresolved:
-                dump_unresolved.write(json.dumps(item))
-                dump_unresolved.write('\n')
+                if count % 1000 == 0 and count > 0:
+                    logger.info('Produced %d statements so far, skipped %d names', count, skipped)
 
-        if count % 1000 == 0 and count > 0:
-            logger.info('Produced %d statements so far, skipped %d names', count, skipped)
+            checkpoint.state.update(count=count, skipped=skipped)
+            checkpoint.done(i)
 
     logger.info('Done, produced %d statements, skipped %d names', count, skipped)
     logger.info("Dataset serialized to '%s'" % outfile.name)
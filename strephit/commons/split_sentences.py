@@ -4,14 +4,13 @@
 from __future__ import absolute_import
 
 import logging
-import json
 from sys import exit
 
 import click
 from nltk.data import load
 
 from strephit.commons.io import load_corpus
-from strephit.commons import parallel
+from strephit.commons import io, nlp_daemon, parallel
 
 logger = logging.getLogger(__name__)
 
@@ -46,13 +45,19 @@ class PunktSentenceSplitter(object):
         :param str language: ISO 639-1 language code. See https://en.wikipedia.org/wiki/List_of_ISO_639-1_codes
         """
         self.language = language
-        model = self.supported_models.get(language)
-        if model:
-            self.splitter = load(model)
-        else:
+        self.model = self.supported_models.get(language)
+        if not self.model:
             raise ValueError(
                 "Invalid or unsupported language: '%s'. Please use one of the currently supported ones: %s" % (
                     language, self.supported_models.keys()))
+        self._splitter = None
+
+    @property
+    def splitter(self):
+        """ The Punkt model, loaded on first use """
+        if self._splitter is None:
+            self._splitter = load(self.model)
+        return self._splitter
 
     def split(self, text):
         """
@@ -60,6 +65,8 @@ class PunktSentenceSplitter(object):
         Leading and trailing spaces are stripped.
         Newline characters are first interpreted as sentence boundaries.
         Then, the sentence splitter is run.
+        The text is split by the NLP daemon, if available, see :mod:`strephit.commons.nlp_daemon`,
+        and locally when the daemon fails
 
         :param str text: Text to be split
         :return: the sentences in the text
@@ -75,6 +82,16 @@ class PunktSentenceSplitter(object):
 
         """
         logger.debug("Splitting text into sentences: %s" % text)
+        if nlp_daemon.available():
+            try:
+                sentences = nlp_daemon.call('split', self.language, text)
+            except nlp_daemon.DaemonError as e:
+                logger.warn('the NLP daemon cannot split the text, splitting it locally: %s', e)
+            else:
+                for sentence in sentences:
+                    yield sentence
+                return
+
         sentences_by_newline = text.strip().split('\n')
         logger.debug(
             "%d sentences split by the newline character: %s" % (len(sentences_by_newline), sentences_by_newline))
@@ -108,8 +125,8 @@ class PunktSentenceSplitter(object):
 @click.argument('corpus', type=click.Path(exists=True, dir_okay=True, resolve_path=True))
 @click.argument('document-key')
 @click.argument('language-code')
-@click.option('--outfile', '-o', type=click.File('w'), default='output/split_sentences.jsonlines')
-@click.option('--processes', '-p', default=0)
+@click.option('--outfile', '-o', type=io.CompressedFile('w'), default='output/split_sentences.jsonlines')
+@click.option('--processes', '-p', default=0, type=parallel.PROCESSES)
 def main(corpus, document_key, language_code, outfile, processes):
     """ Split an input corpus into sentences """
     corpus = load_corpus(corpus, document_key, text_only=True)
@@ -118,12 +135,12 @@ def main(corpus, document_key, language_code, outfile, processes):
     logger.info("Starting sentence splitting of the input corpus ...")
 
     def worker((i, text)):
-        sentences = list(s.split(text))
-        return json.dumps({i: sentences}) if sentences else None
+        return i, list(s.split(text))
 
-    for sentences in parallel.map(worker, enumerate(corpus), processes):
-        outfile.write(sentences)
-        outfile.write('\n')
+    for i, sentences in parallel.map(worker, enumerate(corpus), processes, ordered=True):
+        if sentences:
+            outfile.write(io.json_dumps({i: sentences}))
+            outfile.write('\n')
 
     return 0
 
@@ -101,8 +101,8 @@ def identity_resolver(property, value, language, **kwargs):
     return '%s:"%s"' % (language, unicode(value).replace('"', '\\"')) if value else None
 
 
-@cache.cached
 @resolver('P21')
+@cache.cached(exclude=['kwargs'])
 def gender_resolver(property, value, language, **kwargs):
     """ Resolve gender """
     results = search(value, language, type_=4369513)
@@ -112,8 +112,8 @@ def gender_resolver(property, value, language, **kwargs):
         return ''  # cache, but do not serialize
 
 
-@cache.cached
 @resolver('P569', 'P570')
+@cache.cached(exclude=['kwargs'])
 def date_resolver(property, value, language, **kwargs):
     """ Resolves dates """
     value = value.lower().replace('(circa)', '').replace('(probable)', '') \
@@ -129,6 +129,7 @@ def date_resolver(property, value, language, **kwargs):
 
 
 # @resolver('P26', 'P40', 'P1038')
+@cache.cached(exclude=['property'])
 def resolver_with_hints(property, value, language, **kwargs):
     """ Resolves people names. Works better if generic biographic
         information, such as birth/death dates, is provided.
@@ -210,8 +211,8 @@ def resolver_with_hints(property, value, language, **kwargs):
             return ''
 
 
-@cache.cached
 # @resolver('P108', 'P97', 'P106', 'P166')
+@cache.cached(exclude=['kwargs'])
 def generic_search_resolver(property, value, language, **kwargs):
     """ Last-hope resolver, searches wikidata hoping to find something
         which exactly matches the given value
@@ -220,8 +221,8 @@ def generic_search_resolver(property, value, language, **kwargs):
     return results[0]['id'] if results else ''
 
 
-@cache.cached
 @resolver('P27')
+@cache.cached(exclude=['kwargs'])
 def nationality_resolver(property, value, language, **kwargs):
     """ Resolves nationalities (French --> France)
     """
@@ -255,8 +256,8 @@ def nationality_resolver(property, value, language, **kwargs):
     return country
 
 
-@cache.cached
 # @resolver('P19', 'P20')
+@cache.cached(exclude=['kwargs'])
 def place_resolver(property, value, language, **kwargs):
     """ Resolves place names
     """
@@ -295,7 +296,7 @@ def call_api(action, cache=True, **kwargs):
     kwargs['format'] = 'json'
     kwargs['action'] = action
     resp = io.get_and_cache(WIKIDATA_API_URL, use_cache=cache, params=kwargs)
-    return json.loads(resp)
+    return io.json_loads(resp)
 
 
 def search(term, language, type_=None, label_exact=True, limit='15'):
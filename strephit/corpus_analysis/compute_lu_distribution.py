@@ -13,8 +13,31 @@ from strephit.commons.pos_tag import TTPosTagger
 from strephit.commons import parallel
 
 logger = logging.getLogger(__name__)
-# some globals for the workers (some of them cannot be pickled)
-splitter = tagger = all_verbs = parser = None
+
+
+def init_worker(all_verbs, sub_sentences):
+    """ Loads the resources needed by the workers, once per process
+        (some of them cannot be pickled)
+
+        :param set all_verbs: The verbs to look for
+        :param bool sub_sentences: Whether to prepare for analyzing sub-sentences
+         with the syntactic parser or simple sentences with the POS tagger
+        :return: The state of the worker
+        :type: dict
+    """
+    state = {
+        'splitter': PunktSentenceSplitter('en'),
+        'all_verbs': all_verbs,
+    }
+
+    if sub_sentences:
+        state['parser'] = StanfordParser(path_to_jar='dev/stanford-corenlp-3.6.0.jar',
+                                         path_to_models_jar='dev/stanford-corenlp-3.6.0-models.jar',
+                                         java_options=' -mx1G -Djava.ext.dirs=dev/')  # no way to make classpath work
+    else:
+        state['tagger'] = TTPosTagger('en')
+
+    return state
 
 
 def worker_with_sub_sentences(bio):
@@ -45,6 +68,9 @@ def worker_with_sub_sentences(bio):
                 for each in find_verbs(child):
                     yield each
 
+    state = parallel.worker_state()
+    splitter, parser, all_verbs = state['splitter'], state['parser'], state['all_verbs']
+
     counter = defaultdict(int)
     for root in parser.raw_parse_sents(splitter.split(bio)):
         root = root.next()
@@ -67,13 +93,14 @@ def worker_with_sentences(bio):
         :return: histogram of frequenties
         :type: dict
     """
-    counter = defaultdict(int)
-    for sent in splitter.split(bio):
-        sent = sent.strip().lower()
-        if len(sent) < 5:
-            continue
+    state = parallel.worker_state()
+    splitter, tagger, all_verbs = state['splitter'], state['tagger'], state['all_verbs']
+
+    sentences = [sent.strip().lower() for sent in splitter.split(bio)]
+    sentences = [sent for sent in sentences if len(sent) >= 5]
 
-        tagged = tagger.tag_one(sent)
+    counter = defaultdict(int)
+    for tagged in tagger.tag_sentences(sentences):
         if not tagged:
             continue
 
@@ -87,17 +114,11 @@ def worker_with_sentences(bio):
 @click.argument('corpus', type=click.Path(exists=True))
 @click.argument('verbs', type=click.File('r'))
 @click.option('--sub-sentences/--simple-sentences', default=False)
-@click.option('--processes', '-p', default=0)
+@click.option('--processes', '-p', default=0, type=parallel.PROCESSES)
 @click.option('--outfile', '-o', default='output/lus_per_sent.json', type=click.File('w'))
 def main(corpus, verbs, processes, outfile, sub_sentences):
     """ Compute the LU distribution in the corpus, i.e. how many LUs per sentence
     """
-    global splitter, tagger, parser, all_verbs
-    splitter = PunktSentenceSplitter('en')
-    tagger = TTPosTagger('en')
-    parser = StanfordParser(path_to_jar='dev/stanford-corenlp-3.6.0.jar',
-                            path_to_models_jar='dev/stanford-corenlp-3.6.0-models.jar',
-                            java_options=' -mx1G -Djava.ext.dirs=dev/')  # no way to make classpath work
     all_verbs = reduce(lambda x, y: x.union(y), imap(set, json.load(verbs).values()), set())
     all_verbs.discard('be')
     all_verbs.discard('have')
@@ -106,7 +127,8 @@ def main(corpus, verbs, processes, outfile, sub_sentences):
     worker = worker_with_sub_sentences if sub_sentences else worker_with_sentences
     counter = defaultdict(int)
 
-    for i, counts in enumerate(parallel.map(worker, args, processes)):
+    for i, counts in enumerate(parallel.map(worker, args, processes, initializer=init_worker,
+                                            initargs=(all_verbs, sub_sentences))):
         for k, v in counts.iteritems():
             counter[k] += v
 
@@ -202,7 +202,7 @@ def harmonic_ranking(*rankings):
 @click.option('--dump-stdev', type=click.File('w'), default='output/stdev_ranking.json')
 @click.option('--dump-popularity', type=click.File('w'), default='output/popularity_ranking.json')
 @click.option('--dump-final', type=click.File('w'), default='output/verb_ranking.json')
-@click.option('--processes', '-p', default=0)
+@click.option('--processes', '-p', default=0, type=parallel.PROCESSES)
 def main(pos_tagged, document_key, pos_tag_key, language, dump_verbs, dump_tf_idf,
          dump_stdev, dump_popularity, dump_final, processes):
     """ Computes the three verb rankings: average TF-IDF, average of TF-IDF
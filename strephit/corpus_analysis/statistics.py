@@ -20,7 +20,7 @@ def main():
 @main.command()
 @click.argument('corpus', type=click.Path(exists=True))
 @click.option('--with-bio', '-b', is_flag=True)
-@click.option('--processes', '-p', default=0)
+@click.option('--processes', '-p', default=0, type=parallel.PROCESSES)
 def about_sources(corpus, processes, with_bio):
     """ Items' sources
     """
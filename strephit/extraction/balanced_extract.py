@@ -1,9 +1,8 @@
 import logging
 from collections import defaultdict
 from urlparse import urlparse
-import json
 import click
-from strephit.commons import parallel
+from strephit.commons import io, parallel
 import random
 
 
@@ -13,7 +12,7 @@ logger = logging.getLogger(__name__)
 def lu_count(sentences, processes=0, input_encoded=False):
     """ Count how many sentences per LU there are for each source
 
-        :param iterable sentences: Corpus with the POS-tagged sentences
+        :param sentences: Corpus with the POS-tagged sentences, or its path
         :param int processes: how many processes to use for parallel execution
         :param bool input_encoded: whether the corpus is an iterable of dictionaries
          or an iterable of JSON-input_encoded documents. JSON-input_encoded
@@ -26,7 +25,7 @@ def lu_count(sentences, processes=0, input_encoded=False):
     def worker(batch):
         freqs = defaultdict(lambda: 0)
         for row in batch:
-            sentence = json.loads(row) if input_encoded else row
+            sentence = io.json_loads(row) if input_encoded else row
 
             parsed = urlparse(sentence['url'])
             if not parsed.netloc:
@@ -39,8 +38,8 @@ def lu_count(sentences, processes=0, input_encoded=False):
         return freqs.items()
 
     frequencies = defaultdict(lambda: defaultdict(lambda: 0))
-    for (source, lemma), count in parallel.map(worker, sentences, processes,
-                                               batch_size=100, flatten=True):
+    for (source, lemma), count in parallel.map_lines(worker, sentences, processes,
+                                                     batch_size='auto', flatten=True):
         frequencies[source][lemma] += count
     return frequencies
 
@@ -48,7 +47,7 @@ def lu_count(sentences, processes=0, input_encoded=False):
 def extract_sentences(sentences, probabilities, processes=0, input_encoded=False, output_encoded=False):
     """ Extracts some sentences from the corpus following the given probabilities
 
-        :param iterable sentences: Extracted sentences
+        :param sentences: Extracted sentences, or their path
         :param dict probabilities: Conditional probabilities of extracting a sentence containing
          a specific LU given the source of the sentence. It is therefore a mapping
          source -> probabilities, where probabilities is itself a mapping LU -> probability
@@ -63,7 +62,7 @@ def extract_sentences(sentences, probabilities, processes=0, input_encoded=False
 
     def worker(batch):
         for row in batch:
-            sentence = json.loads(row) if input_encoded else row
+            sentence = io.json_loads(row) if input_encoded else row
             parsed = urlparse(sentence['url'])
             if not parsed.netloc:
                 logger.warn('cannot parse URL: %s', sentence['url'])
@@ -73,11 +72,11 @@ def extract_sentences(sentences, probabilities, processes=0, input_encoded=False
             p = probabilities[(parsed.netloc, lu)]
 
             if random.random() < p:
-                yield parsed.netloc, lu, json.dumps(sentence) if output_encoded else sentence
+                yield parsed.netloc, lu, io.json_dumps(sentence) if output_encoded else sentence
 
     counts = defaultdict(lambda: 0)
-    for source, lu, sentence in parallel.map(worker, sentences, processes,
-                                             batch_size=100, flatten=True):
+    for source, lu, sentence in parallel.map_lines(worker, sentences, processes,
+                                                   batch_size='auto', flatten=True):
         counts[(source, lu)] += 1
         yield sentence
 
@@ -92,14 +91,15 @@ def extract_sentences(sentences, probabilities, processes=0, input_encoded=False
 
 
 @click.command()
-@click.argument('sentences', type=click.File('r'))
+@click.argument('sentences', type=click.Path(exists=True, dir_okay=False))
 @click.argument('sentences-per-lu', type=click.FLOAT)
-@click.option('--processes', '-p', default=0)
-@click.option('--outfile', '-o', type=click.File('w'),
+@click.option('--processes', '-p', default=0, type=parallel.PROCESSES)
+@click.option('--outfile', '-o', type=io.CompressedFile('w'),
               default='output/sentences_balanced.jsonlines')
 def main(sentences, sentences_per_lu, processes, outfile):
     """ Stochastically extracts sentences so that there are a given number
-        of sentences for each LU equally spread amongst the different sources
+        of sentences for each LU equally spread amongst the different sources.
+        The corpus is read twice, and can be compressed
     """
 
     logger.info('Obtaining the LU distribution amongst sources')
@@ -127,7 +127,6 @@ def main(sentences, sentences_per_lu, processes, outfile):
     logger.debug('Expect roughly %d sentences, unless some sources are lacking',
                  sentences_per_lu * number_of_lus)
 
-    sentences.seek(0)
     count = 0
     for i, sentence in enumerate(extract_sentences(sentences, probabilities, processes,
                                                    input_encoded=True, output_encoded=True)):
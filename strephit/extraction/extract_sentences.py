@@ -11,11 +11,12 @@ from nltk import RegexpParser
 from nltk.parse.stanford import StanfordParser
 from nltk.tree import Tree
 
+from strephit.commons.checkpoint import Checkpoint, check_options
 from strephit.commons.tokenize import Tokenizer
 from strephit.commons.pos_tag import TTPosTagger
 from strephit.commons.io import load_scraped_items
 from strephit.commons.split_sentences import PunktSentenceSplitter
-from strephit.commons import parallel
+from strephit.commons import io, parallel
 
 logger = logging.getLogger(__name__)
 
@@ -40,11 +41,11 @@ class SentenceExtractor:
         self.language = language
         self.lemma_to_token = lemma_to_token if match_base_form else self._filter_base_form(lemma_to_token)
         self.tokenizer = Tokenizer(self.language)
-        self.tagger = TTPosTagger(self.language)
+        self.tagger = None
 
     def extract_from_item(self, item):
         """ Extract sentences from an item. Relies on `setup_extractor`
-            having been called
+            and `setup_worker` having been called
 
             :param dict item: Item from which to extract sentences
             :return: The original item and list of extracted sentences
@@ -57,28 +58,46 @@ class SentenceExtractor:
         """
         pass
 
+    def setup_worker(self):
+        """ Setup code run once in each worker process, before it
+            starts extracting sentences. Loads the POS tagger by default
+        """
+        self.tagger = TTPosTagger(self.language)
+
     def teardown_extractor(self):
         """ Optional teardown code, run after the extraction
         """
         pass
 
-    def extract(self, processes=0):
+    def extract(self, processes=0, checkpoint=None):
         """ Processes the corpus extracting sentences from each item
-            and storing them in the item itself.
+            and storing them in the item itself. Items are processed in
+            parallel but sentence IDs are assigned following the order
+            of the corpus, so that they are the same across runs.
 
             :param int processes: how many processes to use for parallel tagging
+            :param checkpoint: Optional :class:`Checkpoint` used to skip the items
+             processed by a previous run. An item is marked as done once all
+             its sentences have been consumed
             :return: the extracted sentences
             :type: generator of dicts
         """
+        checkpoint = checkpoint or Checkpoint()
         self.setup_extractor()
 
         try:
-            count = 0
-            for i, (item, extracted) in enumerate(parallel.map(self.extract_from_item,
-                                                               self.corpus, processes)):
+            count = checkpoint.state.get('sentences', 0)
+            for i, result in checkpoint.map(self.extract_from_item, self.corpus,
+                                            processes=processes, ordered=True,
+                                            initializer=self.setup_worker):
+                if result is None:
+                    checkpoint.done(i)
+                    continue
 
+                item, extracted = result
                 if not item.get('name') or not item.get('url'):
                     logger.warn('Skipping item without name or URL')
+                    checkpoint.done(i)
                     continue
 
                 # assign an unique incremental ID to each sentence
@@ -91,6 +110,9 @@ class SentenceExtractor:
 
                     yield each
 
+                checkpoint.state['sentences'] = count
+                checkpoint.done(i)
+
                 if (i + 1) % 10000 == 0:
                     logger.info('Processed %d items, extracted %d sentences',
                                 i + 1, count)
@@ -142,9 +164,9 @@ class OneToOneExtractor(SentenceExtractor):
         elif isinstance(document, list):
             document = '\n'.join(document)
 
-        sentences = self.splitter.split(document)
-        for sentence in sentences:
-            tagged = self.tagger.tag_one(sentence, skip_unknown=False)
+        sentences = list(self.splitter.split(document))
+        all_tagged = self.tagger.tag_sentences(sentences, skip_unknown=False)
+        for sentence, tagged in zip(sentences, all_tagged):
             sentence_verbs = [token for token, pos, lemma in tagged if pos.startswith('V')]
 
             matched = []
@@ -188,9 +210,9 @@ class ManyToManyExtractor(SentenceExtractor):
         elif isinstance(text, list):
             text = '\n'.join(text)
 
-        sentences = self.splitter.split(text)
-        for sentence in sentences:
-            tagged = self.tagger.tag_one(sentence, skip_unknown=False)
+        sentences = list(self.splitter.split(text))
+        all_tagged = self.tagger.tag_sentences(sentences, skip_unknown=False)
+        for sentence, tagged in zip(sentences, all_tagged):
             sentence_verbs = {token.lower() for token, pos, lemma in tagged if pos.startswith('V')}
 
             for lemma, match_tokens in self.lemma_to_token.iteritems():
@@ -232,6 +254,10 @@ class SyntacticExtractor(SentenceExtractor):
                 self.token_to_lemma[t] = lemma
         self.all_verbs = set(self.token_to_lemma.keys())
 
+    def setup_worker(self):
+        # sentences are parsed, not tagged
+        pass
+
     def extract_from_item(self, item):
         extracted = []
         bio = item.get(self.document_key, '').lower()
@@ -350,10 +376,10 @@ class GrammarExtractor(SentenceExtractor):
             document = '\n'.join(document)
 
         # Sentence splitting
-        sentences = self.splitter.split(document)
+        sentences = list(self.splitter.split(document))
         tokens = 0
-        for sentence in sentences:
-            tagged = [(token, pos) for token, pos, lemma in self.tagger.tag_one(sentence)]
+        for sentence, tags in zip(sentences, self.tagger.tag_sentences(sentences)):
+            tagged = [(token, pos) for token, pos, lemma in tags]
 
             # Parsing via grammar
             parsed = self.parser.parse(tagged)
@@ -390,7 +416,7 @@ class GrammarExtractor(SentenceExtractor):
 
 
 def extract_sentences(corpus, sentences_key, document_key, language,
-                      lemma_to_tokens, strategy, match_base_form, processes=0):
+                      lemma_to_tokens, strategy, match_base_form, processes=0, checkpoint=None):
     """
     Extract sentences from the given corpus by matching tokens against a given set.
 
@@ -402,6 +428,7 @@ def extract_sentences(corpus, sentences_key, document_key, language,
     :param str strategy: One of the 4 extraction strategies ['121', 'n2n', 'grammar', 'syntactic']
     :param bool match_base_form: whether to match verbs base form
     :param int processes: How many concurrent processes to use
+    :param checkpoint: Optional :class:`Checkpoint` to resume a previous run
     :return: the corpus, updated with the extracted sentences and the number of extracted sentences
     :rtype: generator of tuples
     """
@@ -427,29 +454,46 @@ def extract_sentences(corpus, sentences_key, document_key, language,
                          "please use one of ['121', 'n2n', 'grammar', or 'syntactic']")
 
     for each in extractor(corpus, document_key, sentences_key, language,
-                          lemma_to_tokens, match_base_form).extract(processes):
+                          lemma_to_tokens, match_base_form).extract(processes, checkpoint):
         yield each
 
 
 @click.command()
 @click.argument('corpus', type=click.Path(exists=True))
-@click.argument('lemma_to_tokens', type=click.File('r'))
+@click.argument('lemma_to_tokens', type=io.CompressedFile('r'))
 @click.argument('language_code')
 @click.option('--strategy', '-s', type=click.Choice(['n2n', '121', 'grammar', 'syntactic']), default='n2n')
-@click.option('--outfile', '-o', type=click.File('w'), default='output/sentences.jsonlines')
+@click.option('--outfile', '-o', type=io.CompressedFile('w', lazy=True), default='output/sentences.jsonlines')
 @click.option('--sentences-key', default='sentences')
 @click.option('--document-key', default='bio')
-@click.option('--processes', '-p', default=0)
+@click.option('--processes', '-p', default=0, type=parallel.PROCESSES)
 @click.option('--match-base-form', is_flag=True, default=False)
+@click.option('--checkpoint', type=click.Path(dir_okay=False),
+              help='Keep track of the progress in this file')
+@click.option('--resume', is_flag=True, help='Skip the items processed by a previous run, '
+                                             'requires --checkpoint')
+@click.option('--read-processes', default=1, help='How many files of the corpus to read '
+                                                  'concurrently, cannot be used with --checkpoint')
+@click.option('--interleave', is_flag=True, help='Read the files of the corpus in turn')
 def main(corpus, lemma_to_tokens, language_code, strategy, outfile, processes,
-         sentences_key, document_key, match_base_form):
+         sentences_key, document_key, match_base_form, checkpoint, resume, read_processes,
+         interleave):
     """ Extract corpus sentences containing at least one token in the given set. """
-    corpus = load_scraped_items(corpus)
-    updated = extract_sentences(corpus, sentences_key, document_key, language_code,
-                                json.load(lemma_to_tokens), strategy, match_base_form, processes)
-
-    for item in updated:
-        outfile.write(json.dumps(item) + '\n')
+    if checkpoint and read_processes != 1:
+        raise click.BadParameter('the order of the items read concurrently can change '
+                                 'across runs, so they cannot be checkpointed',
+                                 param_hint='--read-processes')
+    check_options(checkpoint, resume, ('--outfile', outfile))
+    corpus = load_scraped_items(corpus, read_processes, interleave)
+
+    with Checkpoint(checkpoint, resume) as checkpoint:
+        outfile = checkpoint.open(outfile)
+        updated = extract_sentences(corpus, sentences_key, document_key, language_code,
+                                    json.load(lemma_to_tokens), strategy, match_base_form,
+                                    processes, checkpoint)
+
+        for item in updated:
+            outfile.write(io.json_dumps(item) + '\n')
     logger.info("Dumped sentences to '%s'" % outfile.name)
     
     return 0
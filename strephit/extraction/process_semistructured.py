@@ -1,6 +1,5 @@
 # -*- encoding: utf-8 -*-
 from __future__ import absolute_import
-import json
 import logging
 from collections import defaultdict
 
@@ -27,7 +26,7 @@ class SemistructuredSerializer:
         """
 
         if isinstance(item, basestring):
-            item = json.loads(item)
+            item = io.json_loads(item)
 
         name = item.pop('name', '')
         other = item.pop('other', {})
@@ -43,7 +42,7 @@ class SemistructuredSerializer:
 
         data = {}
         try:
-            data = json.loads(other)
+            data = io.json_loads(other)
         except ValueError:
             pass
         except TypeError:
@@ -116,11 +115,13 @@ class SemistructuredSerializer:
             else:
                 yield False, {'chunk': each, 'additional': {'property': 'P1035', 'url': url}}
 
-    def process_corpus(self, items, output_file, dump_unresolved_file=None, genealogics=None, processes=0):
+    def process_corpus(self, items, output_file, dump_unresolved_file=None, genealogics=None,
+                       processes=0, backend='processes'):
         count = skipped = 0
 
         genealogics_url_to_id = {}
-        for success, item in parallel.map(self.serialize_item, items, processes, flatten=True):
+        for success, item in parallel.map(self.serialize_item, items, processes, flatten=True,
+                                          backend=backend):
             if success:
                 subj, prop, val, url = item
                 statement = wikidata.finalize_statement(
@@ -143,7 +144,7 @@ class SemistructuredSerializer:
             else:
                 skipped += 1
                 if dump_unresolved_file:
-                    dump_unresolved_file.write(json.dumps(item))
+                    dump_unresolved_file.write(io.json_dumps(item))
                     dump_unresolved_file.write('\n')
 
         logger.info('Produced %d statements so far, skipped %d names', count, skipped)
@@ -161,7 +162,7 @@ class SemistructuredSerializer:
         }
 
         for row in input_file:
-            data = json.loads(row)
+            data = io.json_loads(row)
 
             if 'url' not in data or data['url'] not in url_to_id:
                 continue
@@ -198,14 +199,16 @@ class SemistructuredSerializer:
 
 @click.command()
 @click.argument('corpus-dir', type=click.Path())
-@click.option('--outfile', '-o', type=click.File('w'), default='output/semi_structured.qs')
-@click.option('--genealogics', type=click.File('r'))
+@click.option('--outfile', '-o', type=io.CompressedFile('w'), default='output/semi_structured.qs')
+@click.option('--genealogics', type=io.CompressedFile('r'))
 @click.option('--sourced-only/--allow-unsourced', default=True)
 @click.option('--language', default='en', help='The names are searched in this language')
-@click.option('--processes', '-p', default=0)
-@click.option('--dump-unresolved', type=click.File('w'))
+@click.option('--processes', '-p', default=0, type=parallel.PROCESSES)
+@click.option('--dump-unresolved', type=io.CompressedFile('w'))
+@click.option('--backend', type=click.Choice(['processes', 'threads']), default='threads',
+              help='Mostly waiting for web APIs, so threads are used by default')
 def process_semistructured(corpus_dir, outfile, language, processes,
-                           sourced_only, genealogics, dump_unresolved):
+                           sourced_only, genealogics, dump_unresolved, backend):
     """ Processes the corpus and extracts semi-structured data serialized into QuickStatements.
         Needs a second pass on genealogics to correctly resolve family members.
     """
@@ -213,7 +216,7 @@ def process_semistructured(corpus_dir, outfile, language, processes,
     resolver = SemistructuredSerializer(language, sourced_only, )
 
     genealogics_url_to_id, count, skipped = resolver.process_corpus(
-        io.load_scraped_items(corpus_dir), outfile, dump_unresolved, genealogics, processes
+        io.load_scraped_items(corpus_dir), outfile, dump_unresolved, genealogics, processes, backend
     )
 
     logger.info('Done, produced %d statements, skipped %d names', count, skipped)
@@ -234,7 +237,7 @@ def process_semistructured(corpus_dir, outfile, language, processes,
         else:
             skipped += 1
             if dump_unresolved:
-                dump_unresolved.write(json.dumps(item))
+                dump_unresolved.write(io.json_dumps(item))
                 dump_unresolved.write('\n')
 
     logger.info('Done, produced %d statements, skipped %d names', count, skipped)
@@ -9,7 +9,7 @@ from collections import defaultdict
 import click
 
 from strephit.commons.date_normalizer import normalize_numerical_fes
-from strephit.commons import scoring, pos_tag, parallel
+from strephit.commons import io, scoring, pos_tag, parallel
 from strephit.commons.stopwords import StopWords
 from strephit.commons.classification import apply_custom_classification_rules
 
@@ -24,7 +24,7 @@ class RuleBasedClassifier:
         a suitable type
     """
     def __init__(self, frame_data, language):
-        self.tagger = pos_tag.TTPosTagger(language)
+        self.tagger = None  # loaded when needed, once per worker process
         self.language = language
         self.frame_data = frame_data
 
@@ -115,7 +115,12 @@ class RuleBasedClassifier:
             logger.warn('a sentence is missing the url, skipping it')
             return None
 
-        tagged = sentence['tagged'] if 'tagged' in sentence else self.tagger.tag_one(sentence['text'])
+        if 'tagged' in sentence:
+            tagged = sentence['tagged']
+        else:
+            if self.tagger is None:
+                self.tagger = pos_tag.TTPosTagger(self.language)
+            tagged = self.tagger.tag_one(sentence['text'])
 
         # Normalize + annotate numerical FEs
         numerical_fes = []
@@ -170,7 +175,8 @@ class RuleBasedClassifier:
         """ Process all the given sentences with the rule-based classifier,
             optionally giving a confidence score
 
-            :param sentences: List of sentence data
+            :param sentences: List of sentence data, or a file with one JSON-encoded
+             sentence per line, which is then read directly by the workers
             :param normalize_numerical: Whether to automatically
              normalize numerical expressions
             :param score_type: Which type of score (if any) to use to
@@ -187,24 +193,25 @@ class RuleBasedClassifier:
 
         def worker(item):
             if input_encoded:
-                item = json.loads(item)
+                item = io.json_loads(item)
 
             labeled = self.label_sentence(item, normalize_numerical,
                                           score_type, core_weight)
 
             if labeled:
-                return json.dumps(labeled) if output_encoded else labeled
+                return io.json_dumps(labeled) if output_encoded else labeled
 
-        for each in parallel.map(worker, sentences, processes):
+        transport = 'bytes' if output_encoded else 'queue'
+        for each in parallel.map_lines(worker, sentences, processes, transport=transport):
             yield each
 
 
 @click.command()
-@click.argument('sentences', type=click.File('r'))
-@click.argument('frame-data', type=click.File('r'))
+@click.argument('sentences', type=io.CompressedFile('r'))
+@click.argument('frame-data', type=io.CompressedFile('r'))
 @click.argument('language')
-@click.option('--outfile', '-o', type=click.File('w'), default='output/rule_based_classified.jsonlines')
-@click.option('--processes', '-p', default=0)
+@click.option('--outfile', '-o', type=io.CompressedFile('w'), default='output/rule_based_classified.jsonlines')
+@click.option('--processes', '-p', default=0, type=parallel.PROCESSES)
 @click.option('--score-type', type=click.Choice(scoring.AVAILABLE_SCORES))
 @click.option('--core-weight', default=2)
 @click.option('--normalize-numerical', is_flag=True, default=True)
@@ -1,12 +1,22 @@
 # -*- encoding: utf-8 -*-
+import json
 import os
 import shutil
+import subprocess
+import tarfile
 import tempfile
+import click
 import yaml
 import random
 import unittest
 import itertools
-from strephit.commons import pos_tag, cache, parallel, datetime, text, wikidata, split_sentences, date_normalizer
+import threading
+import time
+from click.testing import CliRunner
+from click.utils import LazyFile
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from strephit.commons import benchmark, io, http, nlp_daemon, pos_tag, cache, parallel, datetime, text, wikidata, serialize, split_sentences, date_normalizer
+from strephit.commons.checkpoint import Checkpoint, check_options
 from collections import Counter
 from treetaggerwrapper import Tag
 
@@ -86,6 +96,586 @@ class TestParallel(unittest.TestCase):
             data = range(batch_size * 5)
             self.assertTrue(all(parallel.map(consumer, data, processes=5, batch_size=batch_size)))
 
+    def test_ordered(self):
+        list_in = range(200)
+        list_out = list(parallel.map(self.function, list_in, processes=4, ordered=True))
+        self.assertEqual(list_out, map(self.function, list_in))
+
+    def test_ordered_small_window(self):
+        list_out = list(parallel.map(self.multi_function, self.list_in, processes=4,
+                                     flatten=True, ordered=True, window=2))
+        self.assertEqual(list_out, list(self.correct_multi))
+
+    def test_initializer(self):
+        def init(offset):
+            return {'offset': offset, 'pid': os.getpid()}
+
+        def function(x):
+            state = parallel.worker_state()
+            return state['pid'], x + state['offset']
+
+        for processes in [1, 3]:
+            list_out = list(parallel.map(function, self.list_in, processes=processes,
+                                         initializer=init, initargs=(100,)))
+            self.assertEqual(sorted(x for _, x in list_out), [x + 100 for x in self.list_in])
+            self.assertLessEqual(len(set(pid for pid, _ in list_out)), processes)
+        self.assertIsNone(parallel.worker_state())
+
+    def test_bytes_transport(self):
+        list_in = range(5000)
+        for processes in [1, 4]:
+            list_out = parallel.map(lambda x: str(x) * (x % 7), list_in, processes=processes,
+                                    transport='bytes')
+            self.assertEqual(Counter(list_out), Counter(str(x) * (x % 7) for x in list_in))
+
+    def test_bytes_transport_unicode(self):
+        list_out = list(parallel.map(lambda x: u'\u84c4' * x, range(1, 4), processes=2,
+                                     transport='bytes'))
+        self.assertEqual(sorted(x.decode('utf8') for x in list_out),
+                         [u'\u84c4', u'\u84c4' * 2, u'\u84c4' * 3])
+
+    def test_adaptive_batches(self):
+        list_in = range(3000)
+        for processes in [1, 3]:
+            list_out = parallel.map(lambda batch: [2 * x for x in batch], list_in,
+                                    processes=processes, batch_size='auto', flatten=True)
+            self.assertEqual(sorted(list_out), map(self.function, list_in))
+
+    def test_auto_processes(self):
+        list_in = range(1000)
+        list_out = list(parallel.map(self.function, list_in, processes='auto', ordered=True))
+        self.assertEqual(list_out, map(self.function, list_in))
+
+    def test_threads(self):
+        list_out = set(parallel.map(self.function, self.list_in_nones, processes=8,
+                                    backend='threads'))
+        self.assertEqual(list_out, self.correct_nones)
+
+    def test_threads_flatten_batches(self):
+        list_out = parallel.map(lambda batch: [x for b in batch for x in self.multi_function(b)],
+                                self.list_in, processes=3, flatten=True, batch_size=2,
+                                backend='threads')
+        self.assertEqual(Counter(list_out), Counter(self.correct_multi))
+
+    def test_threads_ordered(self):
+        list_in = range(300)
+        list_out = list(parallel.map(self.function, list_in, processes=16, ordered=True,
+                                     window=4, backend='threads'))
+        self.assertEqual(list_out, map(self.function, list_in))
+
+    def test_threads_execute(self):
+        funcs = reduce(lambda x, y: x + y,
+                       [(self.function, [x]) for x in xrange(10)])
+        self.assertEqual(parallel.execute(4, *funcs, backend='threads'),
+                         map(self.function, xrange(10)))
+
+    def test_threads_default(self):
+        def function(x):
+            time.sleep(0.05)
+            return threading.current_thread().ident
+
+        threads = set(parallel.map(function, xrange(2 * parallel.MAX_THREADS), processes=0,
+                                   backend='threads'))
+        self.assertGreater(len(threads), min(parallel.mp.cpu_count(), parallel.MAX_THREADS - 1))
+        self.assertLessEqual(len(threads), parallel.MAX_THREADS)
+
+    def test_ordered_with_nones(self):
+        list_out = list(parallel.map(self.function, self.list_in_nones, processes=3,
+                                     ordered=True))
+        self.assertEqual(list_out, map(self.function, filter(self.none_filter, self.list_in_nones)))
+
+
+class TestMapLines(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.lines = ['{"id": %d, "text": "%s"}\n' % (i, 'x' * (i % 37)) for i in xrange(5000)]
+        self.corpus = os.path.join(self.workdir, 'a.jsonlines')
+        with open(self.corpus, 'w') as f:
+            f.writelines(self.lines)
+
+        self.min_shard_size = parallel.MIN_SHARD_SIZE
+        parallel.MIN_SHARD_SIZE = 1000
+
+    def tearDown(self):
+        parallel.MIN_SHARD_SIZE = self.min_shard_size
+        shutil.rmtree(self.workdir)
+
+    def test_shards(self):
+        shards = list(parallel._line_shards([self.corpus], 4))
+        self.assertGreater(len(shards), 4)
+        lines = [line for shard in shards for line in parallel._read_shard(*shard)]
+        self.assertEqual(lines, self.lines)
+
+    def test_file(self):
+        with open(self.corpus) as f:
+            ids = parallel.map_lines(lambda line: json.loads(line)['id'], f, processes=3)
+            self.assertEqual(sorted(ids), range(5000))
+
+    def test_ordered_batches(self):
+        ids = parallel.map_lines(lambda batch: [json.loads(line)['id'] for line in batch],
+                                 self.corpus, processes=2, batch_size=7, flatten=True,
+                                 ordered=True)
+        self.assertEqual(list(ids), range(5000))
+
+    def test_directory(self):
+        with io.open_file(os.path.join(self.workdir, 'b.jsonlines.gz'), 'w') as f:
+            f.writelines(self.lines)
+        ids = parallel.map_lines(lambda line: json.loads(line)['id'], self.workdir,
+                                 processes=2, backend='threads')
+        self.assertEqual(Counter(ids), Counter(range(5000) * 2))
+
+    def test_not_a_file(self):
+        ids = parallel.map_lines(lambda line: json.loads(line)['id'], iter(self.lines),
+                                 processes=2)
+        self.assertEqual(sorted(ids), range(5000))
+
+    def test_errors(self):
+        def function(line):
+            item = json.loads(line)
+            if item['id'] == 3:
+                raise ValueError('failed on purpose')
+            return item['id']
+
+        ids = parallel.map_lines(function, self.corpus, processes=2)
+        self.assertEqual(sorted(ids), [i for i in xrange(5000) if i != 3])
+        self.assertRaises(ValueError, list, parallel.map_lines(function, self.corpus, processes=1))
+
+    def test_auto(self):
+        ids = parallel.map_lines(lambda line: json.loads(line)['id'], self.corpus,
+                                 processes='auto')
+        self.assertEqual(sorted(ids), range(5000))
+
+
+class TestJSONCodec(unittest.TestCase):
+    documents = [
+        u'{"name": "Jo\\u00e3o", "id": 123456789012345678901234567890, "score": 0.1, "x": [true, null]}',
+        u'{"url": "http://example.org/a\\/b", "text": "\\ud83d\\ude00 \\"quoted\\""}',
+        '{"nested": {"a": 1.5e-10, "b": -0.0, "c": {}}, "empty": ""}',
+    ]
+
+    def tearDown(self):
+        io.set_json_codec('auto')
+
+    def test_decoders_agree(self):
+        for name in io.JSON_DECODERS:
+            if name == 'ujson' and io.ujson is None:
+                continue
+            io.set_json_codec(name)
+            for doc in self.documents:
+                self.assertEqual(io.json_loads(doc), json.loads(doc))
+
+    def test_byte_identical_output(self):
+        for doc in self.documents:
+            obj = json.loads(doc)
+            self.assertEqual(io.json_dumps(obj), json.dumps(obj))
+            self.assertEqual(io.json_dumps(io.json_loads(doc)), json.dumps(obj))
+
+    def test_invalid_document(self):
+        for name in io.JSON_DECODERS:
+            if name == 'ujson' and io.ujson is None:
+                continue
+            io.set_json_codec(name)
+            self.assertRaises(ValueError, io.json_loads, '{"truncated": ')
+
+
+class TestCompression(unittest.TestCase):
+    items = [{'id': i, 'name': u'Jo\xe3o %d' % i} for i in xrange(5000)]
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def write(self, name):
+        path = os.path.join(self.workdir, name)
+        with io.open_file(path, 'w') as f:
+            io.dump_corpus(self.items, f)
+        return path
+
+    def test_round_trip(self):
+        for extension in ['.gz', '.bz2']:
+            path = self.write('items.jsonl' + extension)
+            self.assertEqual(io.sniff_compression(path), extension)
+            self.assertEqual(list(io.load_scraped_items(path)), self.items)
+
+    def test_detect_from_content(self):
+        path = self.write('items.jsonl.gz')
+        os.rename(path, os.path.join(self.workdir, 'items.jsonl'))
+        self.assertEqual(list(io.load_scraped_items(self.workdir)), self.items)
+
+    def test_directory(self):
+        self.write('a.jsonl.gz')
+        self.write('b.jsonlines.bz2')
+        self.write('c.jsonl')
+        self.write('ignored.txt.gz')
+        self.assertEqual(len(list(io.load_scraped_items(self.workdir))), 3 * len(self.items))
+
+    def test_append(self):
+        path = self.write('items.jsonl.gz')
+        self.assertRaises(ValueError, io.open_file, path, 'a')
+
+    def test_click_type(self):
+        @click.command()
+        @click.argument('infile', type=io.CompressedFile('r'))
+        @click.argument('outfile', type=io.CompressedFile('w', level=1))
+        def copy(infile, outfile):
+            for line in infile:
+                outfile.write(line)
+
+        source = self.write('in.jsonl.bz2')
+        target = os.path.join(self.workdir, 'out.jsonl.gz')
+        result = CliRunner().invoke(copy, [source, target])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(io.sniff_compression(target), '.gz')
+        self.assertEqual(list(io.load_scraped_items(target)), self.items)
+
+
+class TestLoadScrapedItems(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.corpus = os.path.join(self.workdir, 'corpus')
+        os.mkdir(self.corpus)
+        self.items = []
+        for source in xrange(4):
+            with open(os.path.join(self.corpus, 'spider%d.jsonlines' % source), 'w') as f:
+                for i in xrange(1000 * (source + 1)):
+                    item = {'source': source, 'i': i}
+                    f.write(json.dumps(item) + '\n')
+                    self.items.append(item)
+
+        self.tarball = os.path.join(self.workdir, 'corpus.tar.gz')
+        with tarfile.open(self.tarball, 'w:gz') as tar:
+            tar.add(self.corpus, arcname='corpus')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def key(self, item):
+        return item['source'], item['i']
+
+    def test_sequential(self):
+        for location in [self.corpus, self.tarball]:
+            self.assertEqual(sorted(io.load_scraped_items(location), key=self.key), self.items)
+
+    def test_parallel(self):
+        for location in [self.corpus, self.tarball]:
+            items = list(io.load_scraped_items(location, processes=3))
+            self.assertEqual(sorted(items, key=self.key), self.items)
+
+    def test_interleave(self):
+        for location in [self.corpus, self.tarball]:
+            items = list(io.load_scraped_items(location, processes=4, interleave=True))
+            self.assertEqual(sorted(items, key=self.key), self.items)
+            self.assertEqual(set(item['source'] for item in items[:4]), {0, 1, 2, 3})
+
+    def test_parallel_archive_read_once(self):
+        calls = os.path.join(self.workdir, 'calls')
+        scraped_files = io._scraped_files
+
+        def counting(location):
+            with open(calls, 'a') as f:
+                f.write('.')
+            return scraped_files(location)
+
+        io._scraped_files = counting
+        try:
+            items = list(io.load_scraped_items(self.tarball, processes=3, interleave=True))
+        finally:
+            io._scraped_files = scraped_files
+
+        self.assertEqual(sorted(items, key=self.key), self.items)
+        with open(calls) as f:
+            self.assertEqual(f.read(), '.')
+
+
+class TestIndex(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.corpus = os.path.join(self.workdir, 'corpus-0.jsonlines')
+        with open(self.corpus, 'w') as f:
+            for i in xrange(1000):
+                f.write(json.dumps({'id': i, 'text': u'sentence \xe8 %d' % i}) + '\n')
+            f.write('not json\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_load_by_ids(self):
+        self.assertEqual(io.build_index(self.corpus), 1000)
+        items = list(io.load_by_ids(self.corpus, [999, 3, 500]))
+        self.assertEqual([item['id'] for item in items], [999, 3, 500])
+        self.assertEqual(items[0]['text'], u'sentence \xe8 999')
+
+    def test_missing_ids(self):
+        items = list(io.load_by_ids(self.workdir, ['12', 'missing', 5000]))
+        self.assertEqual([item['id'] for item in items], [12])
+
+    def test_outdated_index(self):
+        io.build_index(self.corpus)
+        with open(self.corpus, 'a') as f:
+            f.write(json.dumps({'id': 'new'}) + '\n')
+        self.assertEqual(list(io.load_by_ids(self.corpus, ['new'])), [{'id': 'new'}])
+
+    def test_hash_collisions(self):
+        id_hash = io._id_hash
+        io._id_hash = lambda item_id: id_hash(int(item_id) % 7)
+        try:
+            items = list(io.load_by_ids(self.corpus, [15, 8, 1]))
+        finally:
+            io._id_hash = id_hash
+        self.assertEqual([item['id'] for item in items], [15, 8, 1])
+
+
+class TestHTTP(unittest.TestCase):
+    class Handler(BaseHTTPRequestHandler):
+        # list of (status, headers) to answer with, then 200
+        responses = []
+        requests = []
+
+        def respond(self):
+            self.requests.append((self.command, self.path))
+            status, headers = self.responses.pop(0) if self.responses else (200, {})
+            self.send_response(status)
+            for key, value in headers.iteritems():
+                self.send_header(key, value)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write('ok')
+
+        do_GET = do_POST = respond
+
+        def log_message(self, format, *args):
+            pass
+
+    def setUp(self):
+        self.Handler.responses = []
+        self.Handler.requests = []
+        self.server = HTTPServer(('127.0.0.1', 0), self.Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.host = '127.0.0.1:%d' % self.server.server_address[1]
+        self.url = 'http://%s/test' % self.host
+        self.backoff = http.BACKOFF_FACTOR
+        http.BACKOFF_FACTOR = 0.01
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        http.BACKOFF_FACTOR = self.backoff
+        http.RATE_LIMITS.pop(self.host, None)
+        http.MAXLAG.pop(self.host, None)
+
+    def test_retry(self):
+        self.Handler.responses = [(503, {'Retry-After': '0'}), (502, {})]
+        r = http.get(self.url)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.text, 'ok')
+        self.assertEqual(len(self.Handler.requests), 3)
+
+    def test_no_retry_not_idempotent(self):
+        self.Handler.responses = [(502, {})]
+        self.assertEqual(http.post(self.url, data={'a': 1}).status_code, 502)
+        self.assertEqual(len(self.Handler.requests), 1)
+
+    def test_give_up(self):
+        self.Handler.responses = [(500, {})] * (http.RETRIES + 1)
+        self.assertEqual(http.get(self.url).status_code, 500)
+        self.assertEqual(len(self.Handler.requests), http.RETRIES + 1)
+
+    def test_maxlag(self):
+        http.MAXLAG[self.host] = 5
+        self.Handler.responses = [(200, {'MediaWiki-API-Error': 'maxlag', 'Retry-After': '0'})]
+        self.assertEqual(http.get(self.url, params={'q': 'x'}).status_code, 200)
+        self.assertEqual(len(self.Handler.requests), 2)
+        self.assertIn('maxlag=5', self.Handler.requests[-1][1])
+
+        self.Handler.responses = [(200, {'MediaWiki-API-Error': 'maxlag'})] * (http.RETRIES + 1)
+        self.assertRaises(http.requests.HTTPError, http.get, self.url)
+
+    def test_rate_limit(self):
+        http.RATE_LIMITS[self.host] = 20
+        start = time.time()
+        for _ in xrange(5):
+            http.get(self.url)
+        self.assertGreaterEqual(time.time() - start, 0.2)
+
+    def test_session_reused(self):
+        self.assertIs(http.session(), http.session())
+
+
+class TestNLPDaemon(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.server = nlp_daemon.Server(os.path.join(self.workdir, 'nlp.sock'))
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        nlp_daemon.SOCKET = self.server.server_address
+
+    def tearDown(self):
+        nlp_daemon.SOCKET = None
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.workdir)
+
+    def test_call(self):
+        self.assertTrue(nlp_daemon.available())
+        self.assertEqual(nlp_daemon.call('ping'), 'pong')
+        self.assertRaises(nlp_daemon.DaemonError, nlp_daemon.call, 'missing')
+        self.assertEqual(nlp_daemon.call('ping'), 'pong')
+
+    def test_date_normalizer(self):
+        text = 'I was born on April 18th, and today is April 18th, 2016!'
+        remote = date_normalizer.DateNormalizer('en')
+        self.assertEqual(list(remote.normalize_many(text)), [
+            ((14, 24), 'Time', {'day': 18, 'month': 4}),
+            ((39, 55), 'Time', {'day': 18, 'month': 4, 'year': 2016}),
+        ])
+        self.assertIsNone(remote.regexes)
+
+        nlp_daemon.SOCKET = None
+        self.assertEqual(date_normalizer.DateNormalizer('en').normalize_one(text),
+                         remote.normalize_one(text))
+
+    def test_tagger(self):
+        def tag_text(language, tt_home, options, text, **kwargs):
+            self.assertTrue(kwargs['tagonly'])
+            return [line if line == pos_tag.SENTENCE_MARKER else '%s\tNN\t%s' % (line, line)
+                    for line in text]
+
+        original, nlp_daemon.METHODS['tag_text'] = nlp_daemon.METHODS['tag_text'], tag_text
+        try:
+            tagger = pos_tag.TTPosTagger('en', use_store=False)
+            tagged = tagger.tag_sentences([u'first sentence', u'second'])
+        finally:
+            nlp_daemon.METHODS['tag_text'] = original
+
+        self.assertEqual(tagged, [[Tag(u'first', u'NN', u'first'), Tag(u'sentence', u'NN', u'sentence')],
+                                  [Tag(u'second', u'NN', u'second')]])
+
+    def test_tagger_pool(self):
+        class Resource(object):
+            def __init__(self, name):
+                self.name = name
+
+        with nlp_daemon._pooled(Resource, 2, 'test') as first:
+            with nlp_daemon._pooled(Resource, 2, 'test') as second:
+                self.assertIsNot(first, second)
+        with nlp_daemon._pooled(Resource, 2, 'test') as third:
+            self.assertIn(third, [first, second])
+        self.assertEqual(nlp_daemon._pools[('Resource', '["test"]')].created, 2)
+        del nlp_daemon._pools[('Resource', '["test"]')]
+
+    def test_fallback(self):
+        def normalize_one(*args):
+            raise SystemExit  # kills the connection
+
+        text = 'Today is the 1st of June, 2016'
+        original, nlp_daemon.METHODS['normalize_one'] = nlp_daemon.METHODS['normalize_one'], normalize_one
+        try:
+            normalizer = date_normalizer.DateNormalizer('en')
+            self.assertTrue(nlp_daemon.available())
+            self.assertEqual(normalizer.normalize_one(text),
+                             ((13, 30), 'Time', {'month': 6, 'day': 1, 'year': 2016}))
+            self.assertFalse(nlp_daemon.available())
+        finally:
+            nlp_daemon.METHODS['normalize_one'] = original
+
+    def test_unreachable(self):
+        nlp_daemon.SOCKET = os.path.join(self.workdir, 'missing.sock')
+        self.assertFalse(nlp_daemon.available())
+        self.assertIsNotNone(date_normalizer.DateNormalizer('en').normalize_one('April 18th')[1])
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.journal = os.path.join(self.workdir, 'journal')
+        self.outfile = os.path.join(self.workdir, 'output')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def function(self, x):
+        return [str(x)] * x
+
+    def run_stage(self, checkpoint, stop_after=None):
+        out = checkpoint.open(LazyFile(self.outfile, 'w'))
+        for count, (i, results) in enumerate(checkpoint.map(self.function, xrange(10),
+                                                            processes=1, flatten=True)):
+            if count == stop_after:
+                # simulate a crash while writing the results
+                out.write('partial')
+                out.flush()
+                return
+            for each in results:
+                out.write(each + '\n')
+            checkpoint.done(i)
+        checkpoint.close()
+
+    def read_output(self):
+        with open(self.outfile) as f:
+            return sorted(f.read().split())
+
+    def test_resume(self):
+        self.run_stage(Checkpoint(self.journal, every=3), stop_after=7)
+
+        checkpoint = Checkpoint(self.journal, resume=True, every=3)
+        self.assertEqual(checkpoint.processed, 6)
+        self.run_stage(checkpoint)
+        self.assertEqual(self.read_output(), sorted(y for x in xrange(10) for y in self.function(x)))
+
+    def test_no_resume(self):
+        self.run_stage(Checkpoint(self.journal, every=3), stop_after=7)
+        self.run_stage(Checkpoint(self.journal, every=3))
+        self.assertEqual(self.read_output(), sorted(y for x in xrange(10) for y in self.function(x)))
+
+    def test_check_options(self):
+        check_options(self.journal, True, ('--outfile', LazyFile(self.outfile, 'w')))
+        check_options(None, False, ('--outfile', LazyFile('-', 'w')))
+        self.assertRaises(click.UsageError, check_options, None, True)
+        self.assertRaises(click.BadParameter, check_options, self.journal, False,
+                          ('--outfile', LazyFile('-', 'w')))
+        self.assertRaises(click.BadParameter, check_options, self.journal, False,
+                          ('--outfile', LazyFile(self.outfile, 'w')),
+                          ('--dump', LazyFile(self.outfile + '.gz', 'w')))
+
+    def test_cli_compressed_output(self):
+        inputs = os.path.join(self.workdir, 'input.jsonl')
+        with open(inputs, 'w') as f:
+            f.write('{}\n')
+
+        result = CliRunner().invoke(serialize.main, [inputs, inputs, 'en', '--checkpoint',
+                                                     self.journal, '-o', self.outfile + '.gz'])
+        self.assertEqual(result.exit_code, 2)
+        self.assertIn('--outfile', result.output)
+        self.assertFalse(os.path.exists(self.journal))
+
+    def test_out_of_order(self):
+        checkpoint = Checkpoint(self.journal)
+        checkpoint.done(3)
+        checkpoint.done(0)
+        checkpoint.close()
+
+        checkpoint = Checkpoint(self.journal, resume=True)
+        self.assertEqual(checkpoint.processed, 2)
+        self.assertEqual([i for i, _ in checkpoint.pending('abcde')], [1, 2, 4])
+
+    def test_compressed_output(self):
+        checkpoint = Checkpoint(self.journal)
+        self.assertRaises(ValueError, checkpoint.open, LazyFile(self.outfile + '.gz', 'w'))
+
+    def test_disabled(self):
+        checkpoint = Checkpoint()
+        self.assertEqual(list(checkpoint.pending('abc')), [(0, 'a'), (1, 'b'), (2, 'c')])
+        checkpoint.done(0)
+        self.assertEqual(checkpoint.processed, 0)
+        self.assertFalse(os.path.exists(self.journal))
+
+
 class TestCache(unittest.TestCase):
     def random_hex_string(self, length):
         return ''.join(random.choice('0123456789abcdef') for _ in xrange(6))
@@ -102,6 +692,7 @@ class TestCache(unittest.TestCase):
         os.makedirs(cache.BASE_DIR)
 
     def tearDown(self):
+        cache.flush()
         shutil.rmtree(cache.BASE_DIR)
         cache._hash_for = self.cache_hash_for
         cache._path_for = self.cache_path_for
@@ -128,6 +719,15 @@ class TestCache(unittest.TestCase):
         cache.set('key', 'something else', overwrite=False)
         self.assertEqual(cache.get('key'), 'another value')
 
+    def test_get_many(self):
+        cache.set_many([('key-%d' % i, i) for i in xrange(1200)])
+        keys = ['missing'] + ['key-%d' % i for i in xrange(1200)]
+        self.assertEqual(cache.get_many(keys, 'default'), ['default'] + range(1200))
+
+        cache.flush()
+        cache._instance = None  # forget the items kept in memory
+        self.assertEqual(cache.get_many(keys), [None] + range(1200))
+
     def test_decorator(self):
         val = self.not_entirely_random_hex_string(128)
         for _ in xrange(10):
@@ -179,6 +779,40 @@ class TestCache(unittest.TestCase):
 
         self.assertNotEqual(function1('value'), function2('value'))
 
+    def test_decorator_canonical_key(self):
+        calls = []
+
+        @cache.cached(exclude=['kwargs'])
+        def function(x, y, **kwargs):
+            calls.append(x)
+            return y
+
+        function({'a': 1, 'b': {2, 3}}, u'caf\xe9')
+        function(y=u'cafe\u0301', x={'b': {3, 2}, 'a': 1}, hints='ignored')
+        self.assertEqual(len(calls), 1)
+
+        function({'a': 1}, 'x' * 1000)
+        key = cache.key_for('tests.test_commons.function', {'x': {'a': 1}, 'y': 'x' * 1000})
+        self.assertLess(len(key), 100)
+        self.assertIsNotNone(cache.get(key))
+
+    def test_decorator_unusual_arguments(self):
+        @cache.cached
+        def function(x):
+            return len(x)
+
+        self.assertEqual(function({(1, 2): 'a', (3,): 'b'}), 2)
+        self.assertEqual(function({(3,): 'b', (1, 2): 'a'}), 2)
+        self.assertRaises(TypeError, function, object())
+
+    def test_decorator_key_function(self):
+        @cache.cached(key=lambda x, y: x)
+        def function(x, y):
+            return y
+
+        self.assertEqual(function(1, 'first'), 'first')
+        self.assertEqual(function(1, 'second'), 'first')
+
     def test_enabled(self):
         cache.ENABLED = False
         cache.set('key', 'value')
@@ -191,6 +825,289 @@ class TestCache(unittest.TestCase):
         self.assertEqual(obj, cache.get('obj'))
 
 
+    def test_memory_mutation(self):
+        obj = {'list': [1, 2]}
+        cache.set('obj', obj)
+        obj['list'].append(3)
+        cache.get('obj')['list'].append(4)
+        self.assertEqual(cache.get('obj'), {'list': [1, 2]})
+
+    def test_memory_hits(self):
+        cache.set('key', 'value')
+        before = cache.memory_stats()
+        self.assertEqual(cache.get('key'), u'value')
+        self.assertEqual(cache.memory_stats()['hits'], before['hits'] + 1)
+
+    def test_memory_bounds(self):
+        max_items, max_bytes = cache.MEMORY_MAX_ITEMS, cache.MEMORY_MAX_BYTES
+        try:
+            cache.MEMORY_MAX_ITEMS, cache.MEMORY_MAX_BYTES = 5, 1000
+            for i in xrange(10):
+                cache.set('key %d' % i, 'x' * 100)
+            stats = cache.memory_stats()
+            self.assertEqual(stats['items'], 5)
+
+            cache.set('large', 'x' * 1000)
+            stats = cache.memory_stats()
+            self.assertLessEqual(stats['bytes'], 1000)
+            self.assertEqual(cache.get('key 0'), 'x' * 100)
+            self.assertEqual(cache.get('large'), 'x' * 1000)
+        finally:
+            cache.MEMORY_MAX_ITEMS, cache.MEMORY_MAX_BYTES = max_items, max_bytes
+
+
+    def test_ttl(self):
+        cache.TTL['test.namespace'] = 60
+        try:
+            backend = cache._backend()
+            backend.set('old', '"value"', True, {'ns': 'test.namespace', 'created': time.time() - 120})
+            backend.set('new', '"value"', True, {'ns': 'test.namespace', 'created': time.time()})
+            backend.set('other', '"value"', True, {'ns': 'other', 'created': time.time() - 120})
+
+            self.assertIsNone(cache.get('old'))
+            self.assertEqual(cache.get('new'), 'value')
+            self.assertEqual(cache.get('other'), 'value')
+        finally:
+            del cache.TTL['test.namespace']
+
+    def test_namespace(self):
+        self.assertEqual(cache._namespace_of("['some.module']function(1, 2){}", {}),
+                         'some.module.function')
+        self.assertEqual(cache._namespace_of("['some.module']function(1, 2){}", {'ns': 'ns'}), 'ns')
+        self.assertIsNone(cache._namespace_of('key', {}))
+
+        cache.TTL['test'] = 1
+        cache.TTL['test.namespace'] = None
+        try:
+            self.assertEqual(cache._ttl_for('test.other'), 1)
+            self.assertIsNone(cache._ttl_for('test.namespace.function'))
+        finally:
+            del cache.TTL['test']
+            del cache.TTL['test.namespace']
+
+    def test_legacy_entries(self):
+        full, base, _ = cache._path_for(cache._hash_for('legacy key'))
+        os.makedirs(base)
+        with open(full, 'w') as f:
+            f.write('legacy key\n{"legacy": "value"}')
+        self.assertEqual(cache.get('legacy key'), {'legacy': 'value'})
+
+    def test_gc(self):
+        backend = cache._backend()
+        for i in xrange(5):
+            backend.set('key %d' % i, '"%s"' % ('x' * 100), True, {'created': time.time()})
+        backend.set("['strephit.commons.wikidata']place_resolver()", '"value"', True,
+                    {'created': time.time() - 100 * cache.DAY})
+        backend.flush()
+        # the most recently used items are kept
+        cache._backend().get('key 4')
+        if cache.BACKEND == 'files':
+            os.utime(cache._path_for(cache._hash_for('key 4'))[0], (time.time() + 10, time.time()))
+
+        cache.gc.callback(250, (), False)
+
+        self.assertIsNone(cache._backend().get("['strephit.commons.wikidata']place_resolver()"))
+        self.assertIsNone(cache._backend().get('key 0'))
+        self.assertIsNotNone(cache._backend().get('key 4'))
+        self.assertLessEqual(sum(size for _, _, size, _, _ in cache._backend().scan()), 250)
+
+    def test_export_import(self):
+        @cache.cached
+        def function(x):
+            return {'value': x}
+
+        function(1)
+        cache.set(u'\u84c4 key', u'\u304a value', namespace='other.namespace')
+        bundle = os.path.join(cache.BASE_DIR, 'bundle.gz')
+        cache.export.callback(bundle, ('tests.',), False)
+
+        base_dir, cache.BASE_DIR = cache.BASE_DIR, os.path.join(cache.BASE_DIR, 'imported')
+        try:
+            cache.import_.callback(bundle, False)
+            self.assertEqual(function(1), {'value': 1})
+            self.assertIsNone(cache.get(u'\u84c4 key'))
+        finally:
+            cache.flush()
+            cache.BASE_DIR = base_dir
+
+    def test_stats(self):
+        @cache.cached
+        def function(x):
+            return x * 100
+
+        function(1)
+        function(2)
+        cache.flush()
+
+        result = CliRunner().invoke(cache.stats)
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('tests.test_commons.function', result.output)
+
+        result = CliRunner().invoke(cache.top_keys, ['-n', '1'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(len(result.output.splitlines()), 2)
+
+    def test_compression(self):
+        large = {'text': u'\u304a\u75b2\u308c' * 1000}
+        cache.set('large', large)
+        cache.set('small', 'value')
+        cache.flush()
+
+        raw, meta = cache._backend().get('large')
+        self.assertEqual(meta['codec'], 'zlib')
+        self.assertLess(len(raw), cache.COMPRESSION_THRESHOLD)
+        self.assertNotIn('codec', cache._backend().get('small')[1])
+
+        cache._instance = None  # skip the in-memory cache
+        self.assertEqual(cache.get('large'), large)
+        self.assertEqual(cache.get('small'), 'value')
+
+    def test_corrupt_entries(self):
+        cache.set('key', {'some': 'value'})
+        cache.set('other key', 'other value')
+        cache.flush()
+        if cache.BACKEND == 'files':
+            with open(cache._path_for(cache._hash_for('key'))[0], 'r+') as f:
+                f.truncate(20)
+        else:
+            cache._backend().set('key', '{"some": "val', True, {})
+            cache.flush()
+        cache._instance = None  # skip the in-memory cache
+
+        self.assertIsNone(cache.get('key'))
+        cache.verify.callback(True)
+        self.assertEqual([key for _, key, _, _, _ in cache._backend().scan()], ['other key'])
+
+        cache.set('key', 'new value', overwrite=False)
+        cache.flush()
+        cache._instance = None
+        self.assertEqual(cache.get('key'), 'new value')
+
+    def write_once(self, x):
+        cache.set('shared', {'worker': x, 'padding': 'x' * 10000}, overwrite=False)
+
+    def test_concurrent_writes(self):
+        list(parallel.map(self.write_once, xrange(20), processes=4))
+        value = cache.get('shared')
+        self.assertIn(value['worker'], range(20))
+        self.assertFalse([name for _, _, files in os.walk(cache.BASE_DIR)
+                          for name in files if name.startswith('.tmp')])
+
+    def slow_search(self, x):
+        @cache.cached
+        def search(term):
+            with open(os.path.join(cache.BASE_DIR, 'calls'), 'a') as f:
+                f.write(term + '\n')
+            time.sleep(0.5)
+            return 'Q' + term
+
+        return search('Oxford')
+
+    def test_single_flight(self):
+        results = list(parallel.map(self.slow_search, xrange(4), processes=4))
+        self.assertEqual(results, ['QOxford'] * 4)
+        with open(os.path.join(cache.BASE_DIR, 'calls')) as f:
+            self.assertEqual(f.read(), 'Oxford\n')
+        self.assertEqual(os.listdir(os.path.join(cache.BASE_DIR, '.locks')), [])
+
+    def test_decorator_miss(self):
+        @cache.cached
+        def function(x):
+            return {'value': x}
+
+        before = cache.memory_stats()
+        function(1)
+        after = cache.memory_stats()
+        self.assertEqual(after['misses'], before['misses'] + 1)
+        self.assertEqual(after['items'], before['items'] + 1)
+
+        self.assertEqual(function(1), {'value': 1})
+        self.assertEqual(cache.memory_stats()['hits'], after['hits'] + 1)
+
+    def test_missing_locks_dir(self):
+        @cache.cached
+        def function(x):
+            return x * 2
+
+        self.assertEqual(function(1), 2)
+        locks = os.path.join(cache.BASE_DIR, '.locks')
+        shutil.rmtree(locks)
+        self.assertEqual(function(2), 4)
+
+        # the locks cannot be created at all
+        shutil.rmtree(locks)
+        open(locks, 'w').close()
+        self.assertEqual(function(3), 6)
+
+    def test_size_param(self):
+        self.assertEqual(cache.SIZE.convert('10', None, None), 10)
+        self.assertEqual(cache.SIZE.convert('1.5k', None, None), 1536)
+        self.assertEqual(cache.SIZE.convert('2 GB', None, None), 2 * 1024 ** 3)
+
+
+class TestSQLiteCache(TestCache):
+    def setUp(self):
+        super(TestSQLiteCache, self).setUp()
+        cache.BACKEND = 'sqlite'
+
+    def test_legacy_entries(self):
+        self.skipTest('only the files backend has legacy entries')
+
+    def tearDown(self):
+        super(TestSQLiteCache, self).tearDown()
+        cache.BACKEND = 'files'
+
+    def set_in_worker(self, x):
+        cache.set('key %d' % x, x)
+
+    def test_batched_writes(self):
+        cache.set('key', 'value')
+        other = cache.SQLiteBackend(cache.BASE_DIR)
+        self.assertIsNone(other.get('key'))
+        cache.flush()
+        self.assertEqual(other.get('key')[0], '"value"')
+
+    def test_decorator_flush(self):
+        @cache.cached
+        def function(x):
+            return x * 2
+
+        other = cache.SQLiteBackend(cache.BASE_DIR)
+        function(1)
+        self.assertIsNone(other.get(cache.key_for('tests.test_commons.function', {'x': 1})))
+
+        # somebody is waiting for the result, which has to be committed
+        _, waiting = cache._lock_paths(cache.key_for('tests.test_commons.function', {'x': 2}))
+        open(waiting, 'w').close()
+        function(2)
+        self.assertEqual(other.get(cache.key_for('tests.test_commons.function', {'x': 2}))[0], '4')
+
+    def test_flush_keys(self):
+        cache.set('first', 1)
+        cache.set('second', 2)
+        cache.flush(['first'])
+        other = cache.SQLiteBackend(cache.BASE_DIR)
+        self.assertEqual(other.get('first')[0], '1')
+        self.assertIsNone(other.get('second'))
+        self.assertEqual(cache.get('second'), 2)
+
+    def test_forked_workers(self):
+        list(parallel.map(self.set_in_worker, xrange(10), processes=2))
+        for x in xrange(10):
+            self.assertEqual(cache.get('key %d' % x), x)
+
+    def test_migrate(self):
+        cache.BACKEND = 'files'
+        cache.set(u'\u84c4 key', {'value': [1, 2]})
+        cache.set('other key', 'other value')
+
+        cache.migrate.callback('files', 'sqlite', False)
+
+        cache.BACKEND = 'sqlite'
+        self.assertEqual(cache.get(u'\u84c4 key'), {'value': [1, 2]})
+        self.assertEqual(cache.get('other key'), 'other value')
+
+
 class TestWikidata(unittest.TestCase):
 
     def setUp(self):
@@ -385,6 +1302,197 @@ class TestPosTag(unittest.TestCase):
                              each['correct'])
 
 
+class TestTagStore(unittest.TestCase):
+    class FakeTreeTagger(object):
+        def __init__(self):
+            self.tagged = []
+
+        def tag_text(self, text, tagonly=False, **kwargs):
+            self.tagged.append(text)
+            return [word if word == pos_tag.SENTENCE_MARKER else
+                    u'%s\tNN\t%s' % (word, word if word != 'xyz' else '<unknown>')
+                    for word in (text if tagonly else text.split())]
+
+    def setUp(self):
+        self.enabled, self.base_dir = cache.ENABLED, cache.BASE_DIR
+        cache.ENABLED = True
+        cache.BASE_DIR = tempfile.mkdtemp()
+        pos_tag.USE_STORE = True
+
+    def tearDown(self):
+        pos_tag.USE_STORE = False
+        cache.flush()
+        shutil.rmtree(cache.BASE_DIR)
+        cache.ENABLED, cache.BASE_DIR = self.enabled, self.base_dir
+
+    def tagger(self, **kwargs):
+        tagger = pos_tag.TTPosTagger('en', **kwargs)
+        tagger._tagger = self.FakeTreeTagger()
+        return tagger
+
+    def test_tag_one_uses_store(self):
+        first = self.tagger()
+        self.assertEqual(first.tag_one(u'some text xyz'),
+                         [Tag(u'some', u'NN', u'some'), Tag(u'text', u'NN', u'text')])
+
+        second = self.tagger()
+        self.assertEqual(second.tag_one(u'some text xyz'), first.tag_one(u'some text xyz'))
+        self.assertEqual(second._tagger.tagged, [])
+
+        other_language = pos_tag.TTPosTagger('it')
+        self.assertIsNone(other_language.store.get(u'some text xyz'))
+
+    def test_store_disabled_by_default(self):
+        pos_tag.USE_STORE = False
+        self.assertIsNone(self.tagger().store)
+        self.assertIsNotNone(self.tagger(use_store=True).store)
+
+    def test_disabled_store(self):
+        self.tagger().tag_one(u'some text')
+        tagger = self.tagger(use_store=False)
+        tagger.tag_one(u'some text')
+        self.assertEqual(tagger._tagger.tagged, [u'some text'])
+
+    def test_tag_sentences(self):
+        tagger = self.tagger()
+        tagger.tag_one(u'already tagged')
+        tagged = tagger.tag_sentences([u'first one', u'already tagged', u'', u'last xyz'])
+
+        self.assertEqual([[tag.word for tag in tags] for tags in tagged],
+                         [[u'first', u'one'], [u'already', u'tagged'], [], [u'last']])
+        self.assertEqual(len(tagger._tagger.tagged), 2)
+        self.assertEqual(tagger.tag_one(u'last xyz'), tagged[3])
+        self.assertEqual(len(tagger._tagger.tagged), 2)
+
+    def test_tag_many_skips_store(self):
+        tagger = self.tagger()
+        tagger.tag_one(u'first text')
+
+        class FakePool(object):
+            def __init__(self, fake):
+                self.fake, self.stopped = fake, False
+
+            def tag_text_async(self, text, **kwargs):
+                class Job(object):
+                    result = self.fake.tag_text(text)
+                    finished = True
+
+                    def wait_finished(self):
+                        pass
+                return Job()
+
+            def stop_poll(self):
+                self.stopped = True
+
+        pool = FakePool(self.FakeTreeTagger())
+        tagger._start_pool = lambda pool_size: pool
+        items = [{'text': u'first text'}, {'text': u''}, {'text': u'second text'}]
+        tagged = list(tagger.tag_many(items, 'text', 'tagged', batch_size=1))
+
+        self.assertEqual([item['tagged'][0].word for item in tagged], [u'first', u'second'])
+        self.assertEqual(pool.fake.tagged, [u'first text', u'second text'])
+        self.assertTrue(pool.stopped)
+        self.assertIsNone(tagger.store.get(u'second text'))
+
+    def test_tag_many_window(self):
+        class SlowJob(object):
+            def __init__(self, text, started):
+                self.text, self.finished = text, False
+                started.append(self)
+
+            def wait_finished(self):
+                self.finished = True
+
+            @property
+            def result(self):
+                return [u'%s\tNN\t%s' % (self.text, self.text)]
+
+        started = []
+        tagger = self.tagger(use_store=False)
+        tagger._start_pool = lambda pool_size: type('Pool', (object,), {
+            'tag_text_async': lambda _, text: SlowJob(text, started),
+            'stop_poll': lambda _: None,
+        })()
+
+        items = ({'text': unicode(i)} for i in xrange(20))
+        for i, item in enumerate(tagger.tag_many(items, 'text', 'tagged', window=3)):
+            self.assertEqual(item['tagged'][0].word, unicode(i))
+            self.assertLessEqual(len(started) - i, 3)
+        self.assertEqual(len(started), 20)
+
+
+class TestTaggerRegistry(unittest.TestCase):
+    class WhitespaceTagger(object):
+        def __init__(self, language, **kwargs):
+            self.language = language
+
+        def tag_one(self, text, skip_unknown=True, **kwargs):
+            return [Tag(word, u'NN' if word.istitle() else u'VV', word) for word in text.split()]
+
+    class LowerTagger(WhitespaceTagger):
+        def tag_one(self, text, skip_unknown=True, **kwargs):
+            return [Tag(word, u'NNS', word) for word in text.lower().split()]
+
+    def setUp(self):
+        self.taggers = dict(pos_tag.TAGGERS)
+        pos_tag.register('whitespace')(self.WhitespaceTagger)
+        pos_tag.register('lower')(self.LowerTagger)
+
+    def tearDown(self):
+        pos_tag.TAGGERS.clear()
+        pos_tag.TAGGERS.update(self.taggers)
+
+    def test_get_pos_tagger(self):
+        self.assertIsInstance(pos_tag.get_pos_tagger('en'), pos_tag.TTPosTagger)
+        self.assertIsInstance(pos_tag.get_pos_tagger('en', 'nltk'), pos_tag.NLTKPosTagger)
+        self.assertIsInstance(pos_tag.get_pos_tagger('en', 'whitespace', tt_home=None),
+                              self.WhitespaceTagger)
+        self.assertRaises(ValueError, pos_tag.get_pos_tagger, 'xx', 'nltk')
+
+    def test_agreement(self):
+        reference = [(u'A', u'NN'), (u'b', u'VV'), (u'C', u'NN')]
+        tagged = [(u'A', u'NNS'), (u'C', u'NN'), (u'd', u'VV')]
+        self.assertEqual(benchmark._agreement(reference, tagged), (2, 1, 2))
+
+    def test_benchmark(self):
+        workdir = tempfile.mkdtemp()
+        try:
+            corpus, report = os.path.join(workdir, 'corpus.jsonlines'), os.path.join(workdir, 'report.json')
+            with open(corpus, 'w') as f:
+                for text in [u'Some text here', u'', u'Another Text']:
+                    f.write(json.dumps({'bio': text}) + '\n')
+
+            result = CliRunner().invoke(benchmark.main, [
+                'pos_tag', '-c', corpus, '-t', 'whitespace', '-t', 'lower',
+                '-r', 'whitespace', '-o', report
+            ])
+            self.assertEqual(result.exit_code, 0, result.output)
+
+            with open(report) as f:
+                report = json.load(f)
+        finally:
+            shutil.rmtree(workdir)
+
+        self.assertEqual(report['documents'], 2)
+        self.assertEqual(sorted(report['taggers']), ['lower', 'whitespace'])
+        self.assertEqual(report['taggers']['whitespace']['tokens'], 5)
+        self.assertEqual(report['taggers']['whitespace']['agreement']['exact'], 1.0)
+        self.assertAlmostEqual(report['taggers']['lower']['agreement']['aligned'], 2 / 5.0)
+        self.assertEqual(report['taggers']['lower']['agreement']['coarse'], 0.0)
+        self.assertGreater(report['taggers']['lower']['peak_memory_kb'], 0)
+
+    @unittest.skipUnless(os.path.isdir('/proc'), 'needs /proc')
+    def test_children_peak_memory(self):
+        before = benchmark._children_peak_memory()
+        child = subprocess.Popen(['sleep', '10'])
+        try:
+            time.sleep(0.1)
+            self.assertGreater(benchmark._children_peak_memory(), before)
+        finally:
+            child.kill()
+            child.wait()
+
+
 class TestDateNormalizer(unittest.TestCase):
     def setUp(self):
         self.specs = {
@@ -1,7 +1,13 @@
 # -*- encoding: utf-8 -*-
+import gzip
+import json
+import os
+import shutil
+import tempfile
 import unittest
+from click.testing import CliRunner
 from treetaggerwrapper import Tag
-from strephit.extraction import process_semistructured, extract_sentences
+from strephit.extraction import process_semistructured, extract_sentences, balanced_extract
 from strephit.extraction.extract_sentences import *
 from strephit.commons import cache
 
@@ -133,3 +139,30 @@ class TestExtractSentences(unittest.TestCase):
         self.assertIn('lu', sentence)
         self.assertEqual(sentence['text'], self.text_real)
         self.assertIn(sentence['lu'], self.lemma_to_token_real.keys())
+
+
+class TestBalancedExtract(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.sentences = [{'url': 'http://source%d.org/%d' % (i % 2, i), 'lu': 'lu%d' % (i % 3),
+                           'text': 'sentence %d' % i} for i in xrange(30)]
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_compressed_input(self):
+        infile = os.path.join(self.workdir, 'sentences.jsonl.gz')
+        f = gzip.GzipFile(infile, 'wb')
+        for sentence in self.sentences:
+            f.write(json.dumps(sentence) + '\n')
+        f.close()
+
+        outfile = os.path.join(self.workdir, 'balanced.jsonl')
+        result = CliRunner().invoke(balanced_extract.main,
+                                    [infile, '100', '--processes', '1', '--outfile', outfile])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        # there are not enough sentences, all of them are extracted
+        with open(outfile) as f:
+            extracted = [json.loads(line) for line in f]
+        self.assertEqual(sorted(extracted), sorted(self.sentences))